@@ -1,5 +1,6 @@
 
-from .discovery import find_any, find_all
+from .discovery import find_any, find_all, find_any_async
 from .utils import Event, Logger, TimeoutError
 from .protocol import ChannelBrokenException, ChannelDamagedException
+from .remote_object import read_many, write_many
 from .shell import launch_shell
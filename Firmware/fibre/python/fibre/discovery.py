@@ -6,11 +6,13 @@ import sys
 import json
 import time
 import threading
+import asyncio
 import traceback
 import struct
 import fibre.protocol
 import fibre.utils
 import fibre.remote_object
+import fibre.schema_cache
 from fibre.utils import Event, Logger
 from fibre.protocol import ChannelBrokenException, TimeoutError
 import appdirs
@@ -44,111 +46,212 @@ try:
 except ImportError:
     pass
 
+try:
+    import fibre.loopback_transport
+    channel_types['loopback'] = fibre.loopback_transport.discover_channels
+except ImportError:
+    pass
+
 def noprint(text):
     pass
 
+def read_serial_number_str(channel, schema, timeout=None):
+    """
+    Reads the serial number of the device on the specified channel with a
+    single endpoint operation, without creating the object tree.
+    The result is formatted like fibre.utils.get_serial_number_str().
+    """
+    definition = schema.root.get_member('serial_number')
+    if not isinstance(definition, fibre.remote_object.PropertyDefinition) or not definition.can_read:
+        return "[unknown serial number]"
+    buffer = channel.remote_endpoint_operation(definition.id, None, True, definition.codec.get_length(), timeout)
+    return fibre.utils.format_serial_number(definition.codec.deserialize(buffer))
+
+# Locks by JSON version tag. They make sure that devices with the same
+# firmware that are initialized concurrently download the JSON only once.
+_schema_load_locks = {}
+_schema_load_locks_lock = threading.Lock()
+
+def init_channel(channel, serial_number, logger, timeout=None):
+    """
+    Gets the interface definition (Schema) of the device on the specified
+    channel. This queries the endpoint 0 on that channel unless the
+    definition is already known to this process or cached on disk.
+    Returns None if serial_number is not None and the device has a different
+    serial number. Otherwise the serial number of the device is stored in
+    channel.serial_number_str (if it has one) and the Schema is returned.
+    timeout: If not None, a TimeoutError is raised if the device is not
+             initialized within this many seconds.
+    """
+    logger.debug("Connecting to device on " + channel._name)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    def remaining_time():
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("device on {} not initialized within {} s".format(channel._name, timeout))
+        return remaining
+
+    # If the transport knows the serial number, non-matching devices
+    # can be ignored before talking to them
+    if serial_number != None and channel.serial_number_str != None and channel.serial_number_str != serial_number:
+        logger.debug("Ignoring device with serial number {}".format(channel.serial_number_str))
+        return None
+
+    cache_dir = appdirs.user_cache_dir("odrivetool")
+
+    # Fetch the json version tag to check cache (only supported on firmware v0.5 or later)
+    json_version_tag = None
+    try:
+        json_version_tag = channel.remote_endpoint_operation(0, struct.pack("<I", 0xffffffff), True, 4, remaining_time())
+        json_version_tag = struct.unpack("<I", json_version_tag)[0]
+        logger.debug("Device reported JSON version ID: {:08d}".format(json_version_tag))
+    except ChannelBrokenException:
+        raise
+    except:
+        json_version_tag = None
+        logger.debug("Failed to get JSON checksum")
+
+    # Devices with the same firmware share one schema. Check the
+    # schemas of this process first, then the cache on disk.
+    schema = None
+    load_lock = None
+    if not json_version_tag is None:
+        schema = fibre.remote_object.get_schema_by_version_tag(json_version_tag)
+        if schema is None:
+            _schema_load_locks_lock.acquire()
+            try:
+                load_lock = _schema_load_locks.setdefault(json_version_tag, threading.Lock())
+            finally:
+                _schema_load_locks_lock.release()
+            lock_timeout = remaining_time()
+            if not load_lock.acquire(timeout=-1 if lock_timeout is None else lock_timeout):
+                remaining_time()
+                raise TimeoutError()
+
+    try:
+        if schema is None and not load_lock is None:
+            # Another device may have loaded it while we were waiting
+            schema = fibre.remote_object.get_schema_by_version_tag(json_version_tag)
+            if schema is None:
+                schema = fibre.schema_cache.load(cache_dir, json_version_tag, logger)
+
+        # Fallback to loading JSON from device
+        if schema is None:
+            # Downloading json data
+            logger.info("Downloading json data from ODrive... (this might take a while)")
+            json_bytes = channel.remote_endpoint_read_buffer(0, timeout=remaining_time())
+            try:
+                json_bytes.decode("ascii")
+            except UnicodeDecodeError:
+                logger.debug("Device responded on endpoint 0 with something that is not ASCII")
+                raise
+
+            schema = fibre.remote_object.get_schema(json_bytes, logger=logger)
+            if not json_version_tag is None:
+                fibre.schema_cache.save(cache_dir, json_version_tag, schema, logger)
+
+        if not json_version_tag is None:
+            fibre.remote_object.set_schema_version_tag(json_version_tag, schema)
+    finally:
+        if not load_lock is None:
+            load_lock.release()
+
+    channel._interface_definition_crc = schema.json_crc
+
+    # Otherwise read only the serial number before initializing the
+    # device any further. The serial number is also needed to recognize
+    # the device when it reconnects (see wait_for_reconnect()).
+    if channel.serial_number_str == None:
+        device_serial_number = read_serial_number_str(channel, schema, remaining_time())
+        if serial_number != None and device_serial_number != serial_number:
+            logger.debug("Ignoring device with serial number {}".format(device_serial_number))
+            return None
+        if schema.root.get_member('serial_number') != None:
+            channel.serial_number_str = device_serial_number
+
+    return schema
+
+def start_discovery(path, serial_number, did_discover_channel, search_cancellation_token, channel_termination_token, logger):
+    """
+    Starts a discovery loop for each connection type in the path spec, which
+    calls did_discover_channel for each new channel.
+    """
+    for search_spec in path.split(','):
+        prefix = search_spec.split(':')[0]
+        the_rest = ':'.join(search_spec.split(':')[1:])
+        if prefix in channel_types:
+            t = threading.Thread(target=channel_types[prefix],
+                             args=(the_rest, serial_number, did_discover_channel, search_cancellation_token, channel_termination_token, logger))
+            t.daemon = True
+            t.start()
+        else:
+            raise Exception("Invalid path spec \"{}\"".format(search_spec))
+
 def find_all(path, serial_number,
          did_discover_object_callback,
          search_cancellation_token,
          channel_termination_token,
-         logger):
+         logger, max_parallel=8, init_timeout=30.0):
     """
     Starts scanning for Fibre nodes that match the specified path spec and calls
     the callback for each Fibre node that is found.
     This function is non-blocking.
+    max_parallel: Maximum number of devices that are initialized concurrently.
+                  The callback is invoked for one object at a time, so it
+                  doesn't need to be thread-safe.
+    init_timeout: Devices that are not initialized within this many seconds
+                  are ignored.
     """
+    init_slots = threading.BoundedSemaphore(max(max_parallel, 1))
+    callback_lock = threading.Lock()
 
     def did_discover_channel(channel):
+        """
+        Starts the initialization of a newly discovered channel on a worker
+        thread, so that the transport can go on with the next channel
+        """
+        t = threading.Thread(target=init_object, args=(channel,))
+        t.daemon = True
+        t.start()
+
+    def init_object(channel):
         """
         Inits an object from a given channel and then calls did_discover_object_callback
         with the created object
-        This queries the endpoint 0 on that channel to gain information
-        about the interface, which is then used to init the corresponding object.
         """
         try:
-            logger.debug("Connecting to device on " + channel._name)
+            init_slots.acquire()
+            try:
+                if search_cancellation_token.is_set():
+                    return
+                schema = init_channel(channel, serial_number, logger, init_timeout)
+            finally:
+                init_slots.release()
+            if schema is None:
+                return
 
-            cache_dir = appdirs.user_cache_dir("odrivetool")
-            cache_path = None
+            logger.debug("JSON: " + schema.json_bytes.decode("ascii").replace('{"name"', '\n{"name"'))
 
-            # Fetch the json version tag to check cache (only supported on firmware v0.5 or later)
-            try:
-                json_version_tag = channel.remote_endpoint_operation(0, struct.pack("<I", 0xffffffff), True, 4)
-                json_version_tag = struct.unpack("<I", json_version_tag)[0]
+            obj = fibre.remote_object.RemoteObject(schema.root, None, channel, logger)
 
-                logger.debug("Device reported JSON version ID: {:08d}".format(json_version_tag))
-                cache_path = os.path.join(cache_dir, 'fibre_schema_cache_{:08d}'.format(json_version_tag))
-            except:
-                logger.debug("Failed to get JSON checksum")
+            obj._schema = schema
+            obj._discovery = (path, channel_termination_token, logger)
 
-            # Check cache
-            json_data = None
+            callback_lock.acquire()
             try:
-                if not cache_path is None:
-                    with open(cache_path, 'rb') as fp:
-                        json_crc16 = fibre.protocol.calc_crc16(fibre.protocol.PROTOCOL_VERSION, fp.read())
-                        fp.seek(0)
-                        json_data = json.load(fp)
-            except:
-                logger.debug("Failed load JSON cache file {}".format(cache_path))
-
-            # Fallback to loading JSON from device
-            if json_data is None:
-                # Downloading json data
-                logger.info("Downloading json data from ODrive... (this might take a while)")
-                json_bytes = channel.remote_endpoint_read_buffer(0)
-                try:
-                    json_string = json_bytes.decode("ascii")
-                except UnicodeDecodeError:
-                    logger.debug("Device responded on endpoint 0 with something that is not ASCII")
-                    raise UnicodeDecodeError
-
-                json_crc16 = fibre.protocol.calc_crc16(fibre.protocol.PROTOCOL_VERSION, json_bytes)
-                json_data = json.loads(json_string)
-
-                # Save JSON to cache
-                if not cache_path is None:
-                    logger.debug("Creating new JSON cache file {}".format(cache_path))
-                    try:
-                        os.makedirs(cache_dir, exist_ok=True)
-                        with open(cache_path, 'w+') as json_cache:
-                            json_cache.write(json_string)
-                        logger.debug("Saved JSON to cache file {}".format(cache_path))
-                    except Exception as ex:
-                        logger.warn("Failed to cache JSON: {}".format(ex))
-
-            channel._interface_definition_crc = json_crc16
-
-            logger.debug("JSON: " + str(json_data).replace("{'name'", "\n{'name'"))
-
-            json_data = {"name": "fibre_node", "members": json_data}
-            obj = fibre.remote_object.RemoteObject(json_data, None, channel, logger)
-
-            obj.__dict__['_json_data'] = json_data['members']
-            obj.__dict__['_json_crc'] = json_crc16
-
-            device_serial_number = fibre.utils.get_serial_number_str(obj)
-            if serial_number != None and device_serial_number != serial_number:
-                logger.debug("Ignoring device with serial number {}".format(device_serial_number))
-                return
-            
-            did_discover_object_callback(obj)
-
+                did_discover_object_callback(obj)
+            finally:
+                callback_lock.release()
 
+        except TimeoutError:
+            logger.warn("Ignoring device on {}: it did not respond within {} s".format(channel._name, init_timeout))
         except Exception:
             logger.debug("Unexpected exception after discovering channel: " + traceback.format_exc())
 
     # For each connection type, kick off an appropriate discovery loop
-    for search_spec in path.split(','):
-        prefix = search_spec.split(':')[0]
-        the_rest = ':'.join(search_spec.split(':')[1:])
-        if prefix in channel_types:
-            t = threading.Thread(target=channel_types[prefix],
-                             args=(the_rest, serial_number, did_discover_channel, search_cancellation_token, channel_termination_token, logger))
-            t.daemon = True
-            t.start()
-        else:
-            raise Exception("Invalid path spec \"{}\"".format(search_spec))
+    start_discovery(path, serial_number, did_discover_channel, search_cancellation_token, channel_termination_token, logger)
 
 
 def find_any(path="usb", serial_number=None,
@@ -180,3 +283,84 @@ def find_any(path="usb", serial_number=None,
         return result
     else:
         return result[0] if len(result) > 0 else None
+
+async def find_any_async(path="usb", serial_number=None,
+        search_cancellation_token=None, channel_termination_token=None,
+        timeout=None, logger=Logger(verbose=False)):
+    """
+    Coroutine version of find_any().
+    The search itself runs on an executor thread. The channel of the returned
+    object is attached to the running event loop (see
+    Channel.attach_event_loop()), so awaiting operations on it doesn't
+    require a receiver thread if the transport supports it.
+    """
+    loop = asyncio.get_event_loop()
+    obj = await loop.run_in_executor(None, lambda: find_any(path, serial_number,
+            search_cancellation_token, channel_termination_token, timeout, logger))
+    if not obj is None:
+        await obj.__channel__.attach_event_loop()
+    return obj
+
+def wait_for_reconnect(obj, timeout=None, cancellation_token=None):
+    """
+    Blocks until the device of the specified object (as returned by find_any())
+    disconnects and reconnects, e.g. after a reboot, and then returns it.
+    The device is recognized by its serial number and searched on the same
+    path as before. Devices without a serial number (neither from the
+    transport nor as a property) can't be recognized, so a ValueError is
+    raised for them instead of taking any device on the path.
+    If the device still has the same interface (i.e. firmware), the existing
+    object tree is attached to the new channel without rebuilding it and the
+    object itself is returned, so references to its sub-objects stay valid.
+    Otherwise a new object is returned.
+    Raises a TimeoutError if the device doesn't reconnect within the timeout,
+    which covers both the disconnect and the reconnect.
+    Returns None if the cancellation token is set.
+    """
+    discovery = getattr(obj, '_discovery', None)
+    if discovery is None:
+        raise ValueError("wait_for_reconnect() is only supported on objects returned by find_any()")
+    path, channel_termination_token, logger = discovery
+    old_channel = obj.__channel__
+    serial_number = old_channel.serial_number_str
+    if serial_number is None:
+        raise ValueError("wait_for_reconnect() is not supported for devices without a serial number")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    remaining = lambda: None if deadline is None else max(deadline - time.monotonic(), 0)
+    done_signal = Event(cancellation_token)
+
+    # Don't pick up the device before it went away
+    fibre.utils.wait_any(remaining(), old_channel._channel_broken, done_signal)
+
+    result = []
+    lock = threading.Lock()
+    def did_discover_channel(channel):
+        try:
+            schema = init_channel(channel, serial_number, logger)
+            if schema is None:
+                return
+            lock.acquire()
+            try:
+                if done_signal.is_set():
+                    return
+                if schema is obj._schema:
+                    obj._rebind(channel)
+                    result.append(obj)
+                else:
+                    logger.debug("Device reconnected with a different interface")
+                    new_obj = fibre.remote_object.RemoteObject(schema.root, None, channel, logger)
+                    new_obj._schema = schema
+                    new_obj._discovery = discovery
+                    result.append(new_obj)
+                done_signal.set()
+            finally:
+                lock.release()
+        except Exception:
+            logger.debug("Unexpected exception after discovering channel: " + traceback.format_exc())
+
+    start_discovery(path, serial_number, did_discover_channel, done_signal, channel_termination_token, logger)
+    try:
+        done_signal.wait(timeout=remaining())
+    finally:
+        done_signal.set() # terminate discovery
+    return result[0] if len(result) > 0 else None
@@ -0,0 +1,279 @@
+"""
+Notifies device scanners (such as the discover_channels() functions of the
+transports) when devices are added or removed, so that they don't need to
+re-enumerate all devices periodically.
+
+The backend is pluggable (see set_backend()). By default, uevents from the
+Linux kernel (or from udev, if it is running) are used on Linux. On other
+platforms or if the uevent socket is not available, scanners fall back to
+polling.
+"""
+
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+class HotplugEvent():
+    """
+    action: 'add', 'remove', 'change', ...
+    subsystem: e.g. 'usb' or 'tty'
+    properties: dict of the uevent properties, e.g. BUSNUM and DEVNUM for USB
+                devices or DEVNAME for tty devices
+    """
+    __slots__ = ('action', 'subsystem', 'properties')
+
+    def __init__(self, action, subsystem, properties=None):
+        self.action = action
+        self.subsystem = subsystem
+        self.properties = {} if properties is None else properties
+
+    def __repr__(self):
+        return "HotplugEvent({}, {}, {})".format(self.action, self.subsystem, self.properties)
+
+class HotplugBackend():
+    """
+    Broadcasts hotplug events to any number of watchers (see watch()).
+    This base class never generates events by itself, so watchers simply poll
+    every poll_interval seconds.
+    """
+    # Watchers return at least this often, even without events. Event based
+    # backends use a long interval as a safety net against lost events.
+    # Can be overridden per backend with the poll_interval argument.
+    poll_interval = 1.0
+
+    # Time to wait for more events after the first one, so that a device that
+    # shows up as several events (device, interfaces, tty) causes only one
+    # scan
+    settle_time = 0.05
+
+    _max_backlog = 256
+
+    def __init__(self, poll_interval=None):
+        if not poll_interval is None:
+            self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._generation = 0 # number of events posted so far
+        self._backlog = [] # list of (generation, event) of the most recent events
+
+    def close(self):
+        pass
+
+    def post_event(self, event):
+        self._cond.acquire()
+        try:
+            self._generation += 1
+            self._backlog.append((self._generation, event))
+            if len(self._backlog) > self._max_backlog:
+                self._backlog.pop(0)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def watch(self, subsystems=None, cancellation_token=None):
+        """
+        Returns a HotplugWatcher that reports the events of the specified
+        subsystems (all subsystems if None) from now on.
+        """
+        return HotplugWatcher(self, subsystems, cancellation_token)
+
+class PollingBackend(HotplugBackend):
+    pass
+
+class HotplugWatcher():
+    def __init__(self, backend, subsystems, cancellation_token):
+        self._backend = backend
+        self._subsystems = subsystems
+        self._cancellation_token = cancellation_token
+        self._generation = backend._generation
+        if not cancellation_token is None:
+            cancellation_token.subscribe(self._wake_up)
+
+    def _wake_up(self):
+        self._backend._cond.acquire()
+        try:
+            self._backend._cond.notify_all()
+        finally:
+            self._backend._cond.release()
+
+    def _collect(self, events):
+        """
+        Appends the relevant events that were posted since the last call.
+        Returns False if events were lost.
+        """
+        backend = self._backend
+        complete = len(backend._backlog) == 0 or backend._backlog[0][0] <= self._generation + 1
+        for generation, event in backend._backlog:
+            if generation > self._generation and (self._subsystems is None or event.subsystem in self._subsystems):
+                events.append(event)
+        self._generation = backend._generation
+        return complete
+
+    def _is_cancelled(self):
+        return not self._cancellation_token is None and self._cancellation_token.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until relevant events occur, the poll interval of the backend
+        (or the specified timeout) elapses or the cancellation token is set.
+        Returns the list of events since the previous call, which is empty if
+        nothing happened. The caller should rescan in any case.
+        """
+        backend = self._backend
+        if timeout is None:
+            timeout = backend.poll_interval
+        deadline = None if timeout is None else time.monotonic() + timeout
+        events = []
+        backend._cond.acquire()
+        try:
+            while not self._is_cancelled():
+                if not self._collect(events):
+                    return events # some events were lost, just rescan
+                if len(events):
+                    break
+                if deadline is None:
+                    backend._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return events
+                    backend._cond.wait(remaining)
+
+            # Collect the events that belong to the same device
+            settle_deadline = time.monotonic() + backend.settle_time
+            while not self._is_cancelled():
+                remaining = settle_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                backend._cond.wait(remaining)
+                if not self._collect(events):
+                    break
+        finally:
+            backend._cond.release()
+        return events
+
+class NetlinkBackend(HotplugBackend):
+    """
+    Receives uevents through a NETLINK_KOBJECT_UEVENT socket (Linux only).
+    If udev is running, its events are used, because udev sends them after it
+    has created the device node and set up its permissions.
+    """
+    poll_interval = 10.0
+
+    _NETLINK_KOBJECT_UEVENT = 15
+    _GROUP_KERNEL = 1
+    _GROUP_UDEV = 2
+    _udev_header_struct = struct.Struct('!8sIIII') # prefix, magic, header size, properties offset, properties length
+    _udev_magic = 0xfeedcafe
+
+    def __init__(self, poll_interval=None):
+        super(NetlinkBackend, self).__init__(poll_interval)
+        group = self._GROUP_UDEV if os.path.exists('/run/udev/control') else self._GROUP_KERNEL
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self._NETLINK_KOBJECT_UEVENT)
+        try:
+            self._socket.bind((0, group))
+            self._socket.settimeout(1.0)
+        except:
+            self._socket.close()
+            raise
+        self._closed = False
+        t = threading.Thread(target=self._receive)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self._closed = True
+
+    @staticmethod
+    def parse_message(message):
+        """
+        Parses a uevent as sent by the kernel or by udev. Returns a
+        HotplugEvent or None if the message is not understood.
+        """
+        if message.startswith(b'libudev\0'):
+            if len(message) < NetlinkBackend._udev_header_struct.size:
+                return None
+            _, magic, _, offset, length = NetlinkBackend._udev_header_struct.unpack_from(message, 0)
+            if magic != NetlinkBackend._udev_magic:
+                return None
+            fields = message[offset:offset + length].split(b'\0')
+        else:
+            fields = message.split(b'\0')[1:] # the first field is "action@devpath"
+        properties = {}
+        for field in fields:
+            key, sep, value = field.partition(b'=')
+            if sep:
+                properties[key.decode('ascii', 'replace')] = value.decode('ascii', 'replace')
+        if not 'ACTION' in properties or not 'SUBSYSTEM' in properties:
+            return None
+        return HotplugEvent(properties['ACTION'], properties['SUBSYSTEM'], properties)
+
+    def _receive(self):
+        try:
+            while not self._closed:
+                try:
+                    message = self._socket.recv(65536)
+                except socket.timeout:
+                    continue
+                event = self.parse_message(message)
+                if not event is None:
+                    self.post_event(event)
+        except OSError:
+            pass # the watchers keep polling with the backend's poll interval
+        finally:
+            self._socket.close()
+
+class SyntheticBackend(HotplugBackend):
+    """
+    Backend for tests that only reports the events injected with add() and
+    remove(). Without events, watchers wait forever unless a poll interval is
+    specified.
+    """
+    def __init__(self, poll_interval=None):
+        super(SyntheticBackend, self).__init__()
+        self.poll_interval = poll_interval
+
+    def add(self, subsystem, **properties):
+        self.post_event(HotplugEvent('add', subsystem, dict(properties, ACTION='add', SUBSYSTEM=subsystem)))
+
+    def remove(self, subsystem, **properties):
+        self.post_event(HotplugEvent('remove', subsystem, dict(properties, ACTION='remove', SUBSYSTEM=subsystem)))
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """
+    Returns the hotplug backend of this process. The default backend is
+    created on first use.
+    """
+    global _backend
+    _backend_lock.acquire()
+    try:
+        if _backend is None:
+            if sys.platform.startswith('linux'):
+                try:
+                    _backend = NetlinkBackend()
+                except (OSError, AttributeError):
+                    pass
+            if _backend is None:
+                _backend = PollingBackend()
+        return _backend
+    finally:
+        _backend_lock.release()
+
+def set_backend(backend):
+    """
+    Replaces the hotplug backend of this process. Scanners that are already
+    running keep using the old backend until they are restarted.
+    """
+    global _backend
+    _backend_lock.acquire()
+    try:
+        if not _backend is None:
+            _backend.close()
+        _backend = backend
+    finally:
+        _backend_lock.release()
@@ -0,0 +1,170 @@
+"""
+In-process packet transport with configurable latency and fault injection.
+Useful to exercise the Channel logic (pipelining, resends, timeouts) without
+a device.
+
+Also provides the discovery of simulated devices (see fibre.simulator) for
+the path spec "loopback:".
+"""
+
+import heapq
+import random
+import threading
+import time
+import fibre.protocol
+import fibre.hotplug
+import fibre.simulator
+from fibre.utils import TimeoutError
+
+class LoopbackPipe(fibre.protocol.PacketSink, fibre.protocol.PacketSource):
+  """
+  Unidirectional packet pipe. Packets written with process_packet() can be
+  read with get_packet() after the configured latency.
+
+  latency: delay of each packet in seconds
+  jitter: additional random delay in seconds (uniformly distributed)
+  loss: probability with which a packet is dropped
+  duplication: probability with which a packet is delivered twice
+  seed: seed of the random number generator, for reproducible faults
+  """
+  def __init__(self, latency=0.0, jitter=0.0, loss=0.0, duplication=0.0, seed=None):
+    self.latency = latency
+    self.jitter = jitter
+    self.loss = loss
+    self.duplication = duplication
+    self.dropped = 0
+    self.duplicated = 0
+    self._random = random.Random(seed)
+    self._packets = [] # heap of (due time, counter, packet)
+    self._counter = 0
+    self._closed = False
+    self._cond = threading.Condition()
+
+  def _push(self, now, packet):
+    due = now + self.latency
+    if self.jitter:
+      due += self._random.uniform(0, self.jitter)
+    self._counter += 1
+    heapq.heappush(self._packets, (due, self._counter, packet))
+
+  def process_packet(self, packet):
+    packet = bytes(packet)
+    with self._cond:
+      if self._closed:
+        raise fibre.protocol.ChannelBrokenException()
+      if self.loss and self._random.random() < self.loss:
+        self.dropped += 1
+        return
+      now = time.monotonic()
+      self._push(now, packet)
+      if self.duplication and self._random.random() < self.duplication:
+        self.duplicated += 1
+        self._push(now, packet)
+      self._cond.notify_all()
+
+  def get_packet(self, deadline):
+    with self._cond:
+      while True:
+        if self._closed:
+          raise fibre.protocol.ChannelBrokenException()
+        now = time.monotonic()
+        if len(self._packets) and self._packets[0][0] <= now:
+          return heapq.heappop(self._packets)[2]
+        if not deadline is None and now >= deadline:
+          raise TimeoutError()
+        timeout = None if deadline is None else deadline - now
+        if len(self._packets):
+          due_in = self._packets[0][0] - now
+          timeout = due_in if timeout is None else min(timeout, due_in)
+        self._cond.wait(timeout)
+
+  def close(self):
+    """
+    Makes all pending and future operations on this pipe fail with a
+    ChannelBrokenException.
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+class LoopbackTransport(fibre.protocol.PacketSink, fibre.protocol.PacketSource):
+  """
+  One end of a bidirectional loopback link.
+  """
+  def __init__(self, tx_pipe, rx_pipe):
+    self.tx_pipe = tx_pipe
+    self.rx_pipe = rx_pipe
+
+  def process_packet(self, packet):
+    self.tx_pipe.process_packet(packet)
+
+  def get_packet(self, deadline):
+    return self.rx_pipe.get_packet(deadline)
+
+  def close(self):
+    self.tx_pipe.close()
+    self.rx_pipe.close()
+
+def create_pair(**link_params):
+  """
+  Creates a bidirectional loopback link and returns its two ends as a tuple
+  (host_end, device_end). The keyword arguments are passed to both
+  LoopbackPipe instances, so latency etc. apply to each direction.
+  """
+  host_to_device = LoopbackPipe(**link_params)
+  if 'seed' in link_params and not link_params['seed'] is None:
+    link_params = dict(link_params, seed=link_params['seed'] + 1)
+  device_to_host = LoopbackPipe(**link_params)
+  return (LoopbackTransport(host_to_device, device_to_host),
+          LoopbackTransport(device_to_host, host_to_device))
+
+def _open_channel(device, channel_termination_token, logger):
+  transport = device.connect()
+  channel = fibre.protocol.Channel(
+          "loopback device {}".format(device.serial_number_str or hex(id(device))),
+          fibre.protocol.PacketFromStreamConverter(transport),
+          fibre.protocol.StreamBasedPacketSink(transport),
+          channel_termination_token, logger)
+  # Like the USB descriptor, the serial number is known without asking the device
+  channel.serial_number_str = device.serial_number_str
+  channel._channel_broken.subscribe(transport.close)
+  return channel
+
+def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger):
+  """
+  Connects to simulated devices. If the path spec is empty, all devices that
+  are attached to this process (see fibre.simulator.attach()) are
+  discovered, including those that are attached later. Otherwise the path
+  spec is the name of an interface file (see
+  fibre.simulator.load_interface_file()) from which one device is created.
+  This function blocks until cancellation_token is set.
+  Channels spawned by this function run until channel_termination_token is set.
+  """
+  if path != None and path != "":
+    try:
+      device = fibre.simulator.SimulatedDevice.from_file(path, logger=logger)
+    except Exception as ex:
+      logger.warn("Cannot simulate a device for {}: {}".format(path, ex))
+      return
+    callback(_open_channel(device, channel_termination_token, logger))
+    cancellation_token.wait()
+    return
+
+  channels = {} # by device
+  watcher = fibre.hotplug.get_backend().watch(('loopback',), cancellation_token)
+  while not cancellation_token.is_set():
+    devices = fibre.simulator.get_attached_devices()
+    for device in devices:
+      channel = channels.get(device, None)
+      if not channel is None and not channel._channel_broken.is_set():
+        continue
+      if serial_number != None and device.serial_number_str != serial_number:
+        continue
+      channels[device] = _open_channel(device, channel_termination_token, logger)
+      callback(channels[device])
+
+    # Detached devices are discovered again when they are reattached
+    for device in list(channels.keys()):
+      if not device in devices:
+        channels.pop(device)
+    watcher.wait()
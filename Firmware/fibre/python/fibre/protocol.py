@@ -5,8 +5,10 @@ import struct
 import sys
 import threading
 import traceback
+import asyncio
+import weakref
 #import fibre.utils
-from fibre.utils import Event, wait_any, TimeoutError
+from fibre.utils import Event, LatencyHistogram, TimeoutError
 
 import abc
 if sys.version_info >= (3, 4):
@@ -43,26 +45,72 @@ def calc_crc(remainder, value, polynomial, bitwidth):
 
     return remainder & ((1 << bitwidth) - 1)
 
-def calc_crc8(remainder, value):
-    if isinstance(value, bytearray) or isinstance(value, bytes) or isinstance(value, list):
-        for byte in value:
-            if not isinstance(byte,int):
-                byte = ord(byte)
-            remainder = calc_crc(remainder, byte, CRC8_DEFAULT, 8)
-    else:
-        remainder = calc_crc(remainder, byte, CRC8_DEFAULT, 8)
+def make_crc_table(polynomial, bitwidth):
+    """
+    Returns a 256-entry lookup table that maps a byte to the remainder it
+    leaves when shifted through the specified CRC polynomial.
+    """
+    return tuple(calc_crc(0, byte, polynomial, bitwidth) for byte in range(256))
+
+CRC8_TABLE = make_crc_table(CRC8_DEFAULT, 8)
+CRC16_TABLE = make_crc_table(CRC16_DEFAULT, 16)
+
+def _to_buffer(value):
+    """
+    Brings the input of calc_crc8/calc_crc16 into a form that yields ints
+    when iterated (bytes, bytearray, memoryview or list of ints).
+    """
+    if isinstance(value, int):
+        return (value,)
+    if isinstance(value, memoryview):
+        return value.cast('B') if value.format != 'B' else value
+    if isinstance(value, list) and len(value) and not isinstance(value[0], int):
+        return [ord(byte) for byte in value]
+    return value
+
+def _calc_crc8_table(remainder, buffer):
+    table = CRC8_TABLE
+    for byte in buffer:
+        remainder = table[remainder ^ byte]
     return remainder
 
-def calc_crc16(remainder, value):
-    if isinstance(value, bytearray) or isinstance(value, bytes) or isinstance(value, list):
-        for byte in value:
-            if not isinstance(byte, int):
-                byte = ord(byte)
-            remainder = calc_crc(remainder, byte, CRC16_DEFAULT, 16)
-    else:
-        remainder = calc_crc(remainder, value, CRC16_DEFAULT, 16)
+def _calc_crc16_table(remainder, buffer):
+    table = CRC16_TABLE
+    for byte in buffer:
+        remainder = ((remainder << 8) & 0xffff) ^ table[(remainder >> 8) ^ byte]
     return remainder
 
+# The crcmod package (if installed) comes with a C extension that runs the same
+# table-driven algorithm considerably faster. binascii.crc_hqx is hardwired
+# to the CCITT polynomial so it can't be used here.
+try:
+    import crcmod
+    _crc8_fun = crcmod.mkCrcFun(0x100 | CRC8_DEFAULT, initCrc=0, rev=False)
+    _crc16_fun = crcmod.mkCrcFun(0x10000 | CRC16_DEFAULT, initCrc=0, rev=False)
+except ImportError:
+    _crc8_fun = None
+    _crc16_fun = None
+
+def calc_crc8(remainder, value):
+    """
+    Continues the CRC8 calculation from the specified remainder over value,
+    which can be a single byte (int) or a bytes-like object or list of bytes.
+    """
+    buffer = _to_buffer(value)
+    if _crc8_fun is not None and not isinstance(buffer, (list, tuple)):
+        return _crc8_fun(buffer, remainder)
+    return _calc_crc8_table(remainder, buffer)
+
+def calc_crc16(remainder, value):
+    """
+    Continues the CRC16 calculation from the specified remainder over value,
+    which can be a single byte (int) or a bytes-like object or list of bytes.
+    """
+    buffer = _to_buffer(value)
+    if _crc16_fun is not None and not isinstance(buffer, (list, tuple)):
+        return _crc16_fun(buffer, remainder)
+    return _calc_crc16_table(remainder, buffer)
+
 
 class DeviceInitException(Exception):
     pass
@@ -86,6 +134,21 @@ class StreamSource(ABC):
     def get_bytes(self, n_bytes, deadline):
         pass
 
+    def get_bytes_into(self, buffer, deadline):
+        """
+        Reads at least one and at most len(buffer) bytes into the provided
+        writable buffer and returns the number of bytes read. Raises a
+        TimeoutError if no data arrives before the deadline.
+        Stream sources should override this to return all bytes that are
+        already available in a single call. The default implementation
+        reads only one byte.
+        """
+        data = self.get_bytes(1, deadline)
+        if len(data) < 1:
+            raise TimeoutError()
+        buffer[0:1] = data
+        return 1
+
 class StreamSink(ABC):
     @abc.abstractmethod
     def process_bytes(self, bytes):
@@ -102,11 +165,89 @@ class PacketSink(ABC):
         pass
 
 
+class StreamPacketDecoder():
+    """
+    Finds packets in a byte stream.
+    Incoming bytes are accumulated in a fixed-size buffer that is reused for
+    the lifetime of the decoder. Packets are returned as memoryviews into this
+    buffer, so a packet is only valid until the next call to feed() or
+    get_free_space().
+    """
+    def __init__(self, size=4096):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # index of the first unprocessed byte
+        self._end = 0 # index one past the last valid byte
+        self.header_errors = 0 # invalid header after a sync byte (includes resync attempts)
+        self.crc_failures = 0 # valid header but payload CRC16 mismatch
+
+    def get_free_space(self):
+        """
+        Returns a writable memoryview into which new stream data can be
+        written. The caller must then call commit() with the number of bytes
+        that were actually written.
+        """
+        if self._start > 0 and (self._start == self._end or len(self._buffer) - self._end < MAX_PACKET_SIZE + 4):
+            # Move the remaining bytes to the front of the buffer
+            n_remaining = self._end - self._start
+            self._view[0:n_remaining] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = n_remaining
+        return self._view[self._end:]
+
+    def commit(self, n_bytes):
+        self._end += n_bytes
+
+    def feed(self, data):
+        """
+        Copies as many bytes as possible from data into the buffer and returns
+        the number of bytes that were consumed.
+        """
+        free_space = self.get_free_space()
+        n_copy = min(len(free_space), len(data))
+        free_space[0:n_copy] = data[0:n_copy]
+        self.commit(n_copy)
+        return n_copy
+
+    def get_packet(self):
+        """
+        Returns the next complete packet (without header and CRC16) or None
+        if the buffered data does not contain a complete packet.
+        Invalid data is skipped.
+        """
+        buffer = self._buffer
+        view = self._view
+        while True:
+            pos = buffer.find(SYNC_BYTE, self._start, self._end)
+            if pos < 0:
+                self._start = self._end
+                return None
+            self._start = pos
+            if self._end - pos < 3:
+                return None # header incomplete
+
+            if (buffer[pos + 1] & 0x80) or calc_crc8(CRC8_INIT, view[pos:pos + 3]) != 0:
+                # Packets larger than 128 bytes are not supported, or invalid header
+                self.header_errors += 1
+                self._start = pos + 1
+                continue
+
+            packet_end = pos + 3 + buffer[pos + 1] + 2
+            if self._end < packet_end:
+                return None # payload incomplete
+
+            if calc_crc16(CRC16_INIT, view[pos + 3:packet_end]) != 0:
+                self.crc_failures += 1
+                self._start = pos + 1
+                continue
+
+            self._start = packet_end
+            return view[pos + 3:packet_end - 2]
+
+
 class StreamToPacketSegmenter(StreamSink):
     def __init__(self, output):
-        self._header = []
-        self._packet = []
-        self._packet_length = 0
+        self._decoder = StreamPacketDecoder()
         self._output = output
 
     def process_bytes(self, bytes):
@@ -115,30 +256,14 @@ class StreamToPacketSegmenter(StreamSink):
         are received, they are sent to this instance's output PacketSink.
         Incomplete packets are buffered between subsequent calls to this function.
         """
-
-        for byte in bytes:
-            if (len(self._header) < 3):
-                # Process header byte
-                self._header.append(byte)
-                if (len(self._header) == 1) and (self._header[0] != SYNC_BYTE):
-                    self._header = []
-                elif (len(self._header) == 2) and (self._header[1] & 0x80):
-                    self._header = [] # TODO: support packets larger than 128 bytes
-                elif (len(self._header) == 3) and calc_crc8(CRC8_INIT, self._header):
-                    self._header = []
-                elif (len(self._header) == 3):
-                    self._packet_length = self._header[1] + 2
-            else:
-                # Process payload byte
-                self._packet.append(byte)
-
-            # If both header and packet are fully received, hand it on to the packet processor
-            if (len(self._header) == 3) and (len(self._packet) == self._packet_length):
-                if calc_crc16(CRC16_INIT, self._packet) == 0:
-                    self._output.process_packet(self._packet[:-2])
-                self._header = []
-                self._packet = []
-                self._packet_length = 0
+        bytes = memoryview(bytes)
+        while len(bytes):
+            bytes = bytes[self._decoder.feed(bytes):]
+            while True:
+                packet = self._decoder.get_packet()
+                if packet is None:
+                    break
+                self._output.process_packet(packet)
 
 
 class StreamBasedPacketSink(PacketSink):
@@ -149,85 +274,223 @@ class StreamBasedPacketSink(PacketSink):
         if (len(packet) >= MAX_PACKET_SIZE):
             raise NotImplementedError("packet larger than 127 currently not supported")
 
-        header = bytearray()
-        header.append(SYNC_BYTE)
-        header.append(len(packet))
-        header.append(calc_crc8(CRC8_INIT, header))
-
-        self._output.process_bytes(header)
-        self._output.process_bytes(packet)
+        # The whole frame is written at once so that it isn't split into
+        # several tiny writes (or TCP segments)
+        frame = bytearray()
+        frame.append(SYNC_BYTE)
+        frame.append(len(packet))
+        frame.append(calc_crc8(CRC8_INIT, frame))
+        frame += packet
 
         # append CRC in big endian
         crc16 = calc_crc16(CRC16_INIT, packet)
-        self._output.process_bytes(struct.pack('>H', crc16))
+        frame += struct.pack('>H', crc16)
+        self._output.process_bytes(frame)
 
 class PacketFromStreamConverter(PacketSource):
     def __init__(self, input):
         self._input = input
+        self._decoder = StreamPacketDecoder()
+
+    def fileno(self):
+        """
+        Returns the file descriptor of the underlying stream so that the
+        converter can be watched by an event loop or selector.
+        Raises AttributeError if the stream has no file descriptor.
+        """
+        return self._input.fileno()
     
     def get_packet(self, deadline):
         """
         Requests bytes from the underlying input stream until a full packet is
-        received or the deadline is reached, in which case None is returned. A
-        deadline before the current time corresponds to non-blocking mode.
+        received or the deadline is reached, in which case a TimeoutError is
+        raised. A deadline before the current time corresponds to non-blocking
+        mode.
+        The returned packet is only valid until the next call to get_packet().
         """
         while True:
-            header = bytes()
+            packet = self._decoder.get_packet()
+            if not packet is None:
+                return packet
+            free_space = self._decoder.get_free_space()
+            self._decoder.commit(self._input.get_bytes_into(free_space, deadline))
 
-            # TODO: sometimes this call hangs, even though the device apparently sent something
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if (header[0] != SYNC_BYTE):
-                #print("sync byte mismatch")
-                continue
 
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if (header[1] & 0x80):
-                #print("packet too large")
-                continue # TODO: support packets larger than 128 bytes
+class PendingOperation():
+    """
+    Future-like handle for an ACK-expecting endpoint operation that was sent
+    on a Channel. The ACK can arrive in any order relative to other pending
+    operations on the same channel.
+    """
+    def __init__(self, channel, seq_no, endpoint_id, packet, slot):
+        self._channel = channel
+        self._seq_no = seq_no
+        self._endpoint_id = endpoint_id
+        self._packet = packet
+        self._attempts = 0
+        self._expired_attempt = 0 # attempt whose resend timer expiry was handled
+        self._idempotent = True # False if a resend may execute the operation again with side effects
+        self._first_sent_at = None
+        self._sent_at = None
+        self._timeout = None # resend timeout of the most recent transmission
+        self._deadline = None # time after which the operation is abandoned
+        self._done = False
+        self._slot = slot # completion slot, locked until the operation completes
+        self._waiters = 0 # threads blocking on _slot
+        self._response = None
+        self._exception = None
+        self._callbacks = None
 
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if calc_crc8(CRC8_INIT, header) != 0:
-                #print("crc8 mismatch")
-                continue
+    def done(self):
+        return self._done
 
-            packet_length = header[1] + 2
-            #print("wait for {} bytes".format(packet_length))
-            packet = self._input.get_bytes_or_fail(packet_length, deadline)
-            if calc_crc16(CRC16_INIT, packet) != 0:
-                #print("crc16 mismatch")
-                continue
-            return packet[:-2]
+    def add_done_callback(self, callback):
+        """
+        Invokes callback(operation) once the operation is complete. The
+        callback runs on the thread that completes the operation or right away
+        if the operation is already complete.
+        """
+        _callback_lock.acquire()
+        try:
+            if not self._done:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(callback)
+                return
+        finally:
+            _callback_lock.release()
+        callback(self)
+
+    def result(self, timeout=None):
+        """
+        Blocks until the ACK for this operation arrives and returns the
+        response payload. Resends the request if the ACK is overdue.
+        Raises a TimeoutError if the timeout (in seconds) expires first and
+        a ChannelBrokenException if the operation failed permanently.
+        """
+        self._channel._wait_for_operation(self, timeout)
+        if not self._exception is None:
+            raise self._exception
+        return self._response
+
+    def _complete(self, response, exception=None):
+        self._response = response
+        self._exception = exception
+        _callback_lock.acquire()
+        try:
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = None
+            slot = self._slot
+            # If nobody is waiting the slot can be recycled right away,
+            # otherwise the last waiter returns it.
+            recycle = self._waiters == 0
+            if recycle:
+                self._slot = None
+        finally:
+            _callback_lock.release()
+        slot.release()
+        if recycle:
+            self._channel._completion_slots.append(slot)
+        for callback in callbacks or []:
+            callback(self)
+
+# Protects the completion state and callback lists of all PendingOperation
+# instances
+_callback_lock = threading.Lock()
+
+
+class ChannelStatistics():
+    """
+    Counters of a Channel. Counters only ever increase so that they can be
+    scraped periodically and differentiated by the consumer.
+    """
+    def __init__(self):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.resends = 0 # packets that were sent more than once
+        self.send_errors = 0 # transport errors while sending
+        self.timeouts = 0 # resend timer expirations
+        self.failed_operations = 0 # operations that ran out of send attempts
+        self.expired_operations = 0 # operations that exceeded their per-call timeout
+        self.unexpected_acks = 0 # ACKs for unknown or already completed operations
+        self.requests_handled = 0 # requests from the peer that were passed to the local node
+        self.requests_ignored = 0 # requests from the peer while there is no local node
+        self.rtt = {} # endpoint ID => LatencyHistogram
+
+    def to_dict(self):
+        result = {k: v for k, v in self.__dict__.items() if k != 'rtt'}
+        result['rtt'] = {endpoint_id: histogram.to_dict() for endpoint_id, histogram in list(self.rtt.items())}
+        return result
 
 
 class Channel(PacketSink):
     # Choose these parameters to be sensible for a specific transport layer
-    _resend_timeout = 5.0     # [s]
-    _send_attempts = 5
+    _resend_timeout = 1.0     # [s] initial resend timeout until a round trip time was measured
+    _min_resend_timeout = 0.01 # [s]
+    _max_resend_timeout = 5.0 # [s]
+    _send_attempts = 5        # min number of transmissions before an operation fails
+    _retry_budget = 5.0       # [s] min time after the first transmission before an operation fails
+    _non_idempotent_resend_timeout = 5.0 # [s] min resend timeout of non-idempotent operations (the former fixed timeout)
+    _window_size = 16         # max number of ACK-expecting operations in flight
+    _read_buffer_depth = 8    # number of chunk requests in flight in remote_endpoint_read_buffer()
+    _max_read_buffer_size = 4 * 1024 * 1024 # [bytes] guards against devices that never stop sending
 
-    def __init__(self, name, input, output, cancellation_token, logger):
+    # If set, incoming packets are processed by this fibre.reactor.Reactor
+    # instead of a dedicated receiver thread (see fibre.reactor.use_shared_reactor)
+    _reactor = None
+
+    _header_struct = struct.Struct('<HHH')
+    _trailer_struct = struct.Struct('<H')
+
+    def __init__(self, name, input, output, cancellation_token, logger, local_node=None):
         """
         Params:
         input: A PacketSource where this channel will source packets from on
                demand. Alternatively packets can be provided to this channel
                directly by calling process_packet on this instance.
         output: A PacketSink where this channel will put outgoing packets.
+        local_node: A fibre.server.LocalNode that answers requests from the
+               other end of the channel. If None, requests are ignored.
         """
         self._name = name
         self._input = input
         self._output = output
         self._logger = logger
+        self.local_node = local_node
+        self._local_session = None # state of local_node for this channel
         self._outbound_seq_no = 0
         self._interface_definition_crc = 0
+        # Serial number of the device as reported by the transport (e.g. in
+        # the USB descriptors) or None if the transport doesn't know it
+        self.serial_number_str = None
         self._expected_acks = {}
-        self._responses = {}
+        self._stats = ChannelStatistics()
+        self._srtt = None # smoothed round trip time
+        self._rttvar = None # round trip time variation
+        self._rto = self._resend_timeout # current resend timeout
+        self._window = threading.BoundedSemaphore(self._window_size)
+        # Pool of completion slots. A slot is a lock that is held while its
+        # operation is pending, which is cheaper than a threading.Event.
+        self._completion_slots = [threading.Lock() for _ in range(self._window_size)]
+        self._async_windows = weakref.WeakKeyDictionary() # asyncio.Semaphore by event loop
         self._my_lock = threading.Lock()
         self._channel_broken = Event(cancellation_token)
-        self.start_receiver_thread(Event(self._channel_broken))
+        self._channel_broken.subscribe(self._fail_all_operations)
+        self._receiver_thread = None
+        self._receiver_reactor = None
+        if not self._reactor is None and self._reactor.register(self):
+            self._receiver_reactor = self._reactor
+        else:
+            self.start_receiver_thread(Event(self._channel_broken))
 
     def start_receiver_thread(self, cancellation_token):
         """
         Starts the receiver thread that processes incoming messages.
-        The thread quits as soon as the channel enters a broken state.
+        The thread quits as soon as the channel enters a broken state or the
+        cancellation token is set.
         """
         def receiver_thread():
             error_ctr = 0
@@ -252,108 +515,559 @@ class Channel(PacketSink):
                 #print("receiver thread is exiting")
             except Exception:
                 self._logger.debug("receiver thread is exiting: " + traceback.format_exc())
-            finally:
                 self._channel_broken.set()
+            finally:
+                if not cancellation_token.is_set():
+                    self._channel_broken.set()
         t = threading.Thread(target=receiver_thread)
         t.daemon = True
         t.start()
+        self._receiver_thread = t
+        self._receiver_thread_token = cancellation_token
+
+    async def attach_event_loop(self):
+        """
+        Moves the processing of incoming packets from the receiver thread to
+        the running asyncio event loop. This only works if the channel's input
+        has a file descriptor that the loop can watch (loop.add_reader),
+        otherwise the receiver thread is kept.
+        From then on incoming packets are only processed while the event loop
+        runs, so blocking calls such as RemoteProperty.get_value() must not
+        be made from the event loop thread.
+        Returns True if the event loop now drives this channel.
+        """
+        loop = asyncio.get_event_loop()
+        self._get_async_window(loop)
+        try:
+            fd = self._input.fileno()
+        except (AttributeError, NotImplementedError, OSError):
+            return False
+
+        if not self._receiver_thread is None:
+            # Stop the receiver thread. It can take up to one get_packet() deadline to exit.
+            self._receiver_thread_token.set()
+            await loop.run_in_executor(None, self._receiver_thread.join)
+            self._receiver_thread = None
+        elif not self._receiver_reactor is None:
+            self._receiver_reactor.unregister(self)
+            self._receiver_reactor = None
+        if self._channel_broken.is_set():
+            return False
+
+        try:
+            loop.add_reader(fd, self._process_available_packets)
+        except NotImplementedError:
+            # e.g. the proactor event loop on Windows
+            self.start_receiver_thread(Event(self._channel_broken))
+            return False
+
+        def remove_reader():
+            try:
+                loop.call_soon_threadsafe(loop.remove_reader, fd)
+            except RuntimeError:
+                pass # event loop closed
+        self._channel_broken.subscribe(remove_reader)
+        return True
+
+    def _process_available_packets(self):
+        """
+        Processes all incoming packets that are available without blocking.
+        """
+        try:
+            while not self._channel_broken.is_set():
+                try:
+                    packet = self._input.get_packet(0) # deadline in the past: non-blocking
+                except TimeoutError:
+                    break
+                except ChannelDamagedException:
+                    break
+                self.process_packet(packet)
+        except Exception:
+            self._logger.debug("event loop receiver is exiting: " + traceback.format_exc())
+            self._channel_broken.set()
+
+    def _next_seq_no(self):
+        """
+        Returns a sequence number that is not currently waiting for an ACK.
+        Must be called with _my_lock held.
+        """
+        while True:
+            # FIXME: we hardwire one bit of the seq-no to 1 to avoid conflicts with the ascii protocol
+            self._outbound_seq_no = ((self._outbound_seq_no + 1) & 0x7fff) | 0x80
+            if not self._outbound_seq_no in self._expected_acks:
+                return self._outbound_seq_no
 
-    def remote_endpoint_operation(self, endpoint_id, input, expect_ack, output_length):
+    def _make_packet(self, seq_no, endpoint_id, input, expect_ack, output_length):
         if input is None:
             input = bytearray(0)
         if (len(input) >= 128):
             raise Exception("packet larger than 127 currently not supported")
 
+        if (endpoint_id & 0x7fff == 0):
+            trailer = PROTOCOL_VERSION
+        else:
+            trailer = self._interface_definition_crc
+
         if (expect_ack):
             endpoint_id |= 0x8000
 
+        return self._header_struct.pack(seq_no, endpoint_id, output_length) + input + self._trailer_struct.pack(trailer)
+
+    def remote_endpoint_operation(self, endpoint_id, input, expect_ack, output_length, timeout=None, idempotent=True):
+        """
+        Executes an operation on a remote endpoint. If expect_ack is True this
+        blocks until the response arrives and returns it.
+        timeout: If not None, the operation is abandoned with a TimeoutError
+                 if no ACK arrived within this many seconds, regardless of the
+                 remaining send attempts.
+        idempotent: Must be False for operations that have side effects when
+                 they are executed more than once, such as function calls.
+                 The device doesn't recognize resent requests, so these are
+                 resent no earlier than _non_idempotent_resend_timeout
+                 instead of after the measured round trip time.
+        """
+        if (expect_ack):
+            return self.start_remote_endpoint_operation(endpoint_id, input, output_length, timeout, idempotent).result()
+        if self._channel_broken.is_set():
+            raise ChannelBrokenException()
+        else:
+            # fire and forget
+            self._my_lock.acquire()
+            try:
+                seq_no = self._next_seq_no()
+                packet = self._make_packet(seq_no, endpoint_id, input, False, output_length)
+                self._stats.packets_sent += 1
+                self._stats.bytes_sent += len(packet)
+            finally:
+                self._my_lock.release()
+            self._output.process_packet(packet)
+            return None
+
+    def start_remote_endpoint_operation(self, endpoint_id, input, output_length, timeout=None, idempotent=True):
+        """
+        Sends an ACK-expecting endpoint operation without waiting for the ACK
+        and returns a PendingOperation that resolves to the response.
+        Up to _window_size operations can be in flight at the same time. If
+        the window is full, this function blocks until the oldest operations
+        are acknowledged (resending them if necessary).
+        timeout, idempotent: see remote_endpoint_operation()
+        """
+        if self._channel_broken.is_set():
+            raise ChannelBrokenException()
+        self._acquire_window()
+        return self._submit_operation(endpoint_id, input, output_length, timeout, idempotent)
+
+    async def remote_endpoint_operation_async(self, endpoint_id, input, output_length, timeout=None, idempotent=True):
+        """
+        Coroutine version of remote_endpoint_operation() for ACK-expecting
+        operations. Waiting for the ACK (and resending) happens on the event
+        loop, so it doesn't occupy a thread.
+        """
+        if self._channel_broken.is_set():
+            raise ChannelBrokenException()
+        loop = asyncio.get_event_loop()
+
+        async with self._get_async_window(loop):
+            if not self._window.acquire(False):
+                # The window is occupied by blocking callers on other threads
+                acquire = loop.run_in_executor(None, self._acquire_window)
+                try:
+                    await asyncio.shield(acquire)
+                except asyncio.CancelledError:
+                    # The executor thread goes on waiting for a slot, which
+                    # must be returned once it got one
+                    def release_slot(future):
+                        if not future.cancelled() and future.exception() is None:
+                            self._window.release()
+                    acquire.add_done_callback(release_slot)
+                    raise
+            operation = self._submit_operation(endpoint_id, input, output_length, timeout, idempotent)
+
+            future = loop.create_future()
+            def set_result():
+                if not future.done():
+                    future.set_result(None)
+            operation.add_done_callback(lambda op: loop.call_soon_threadsafe(set_result))
+
+            try:
+                while not future.done():
+                    wait_time = self._get_resend_time(operation) - time.monotonic()
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future), max(wait_time, 0))
+                    except asyncio.TimeoutError:
+                        # Resends happen when the link is in trouble, where
+                        # writing to the transport can block (e.g. a full USB
+                        # or serial buffer), so they don't run on the loop.
+                        # The first transmission is sent inline, because an
+                        # executor would add a thread hop to every operation.
+                        await loop.run_in_executor(None, self._timer_expired, operation)
+            finally:
+                # Returns the window slot if the coroutine was cancelled
+                if not operation.done():
+                    self._finish_operation(operation, None, ChannelBrokenException())
+
+        if not operation._exception is None:
+            raise operation._exception
+        return operation._response
+
+    def _get_async_window(self, loop):
+        """
+        Returns the semaphore that limits the number of coroutines of the
+        specified event loop that occupy the window. Each event loop that
+        uses the channel has its own semaphore, because asyncio primitives
+        are bound to one loop. The window itself is shared by all of them.
+        """
         self._my_lock.acquire()
         try:
-            self._outbound_seq_no = ((self._outbound_seq_no + 1) & 0x7fff)
-            seq_no = self._outbound_seq_no
+            window = self._async_windows.get(loop, None)
+            if window is None:
+                window = self._async_windows[loop] = asyncio.Semaphore(self._window_size)
+            return window
         finally:
             self._my_lock.release()
-        seq_no |= 0x80 # FIXME: we hardwire one bit of the seq-no to 1 to avoid conflicts with the ascii protocol
-        packet = struct.pack('<HHH', seq_no, endpoint_id, output_length)
-        packet = packet + input
 
-        crc16 = calc_crc16(CRC16_INIT, packet)
-        if (endpoint_id & 0x7fff == 0):
-            trailer = PROTOCOL_VERSION
+    def _acquire_window(self):
+        wait_time = self._rto
+        while not self._window.acquire(timeout=wait_time):
+            if self._channel_broken.is_set():
+                raise ChannelBrokenException()
+            # Resend overdue operations and sleep until the next one is due
+            wait_time = self._rto
+            for operation in list(self._expected_acks.values()):
+                if operation._sent_at is None:
+                    continue
+                remaining = self._get_resend_time(operation) - time.monotonic()
+                if remaining <= 0:
+                    self._timer_expired(operation)
+                else:
+                    wait_time = min(wait_time, remaining)
+
+    def _submit_operation(self, endpoint_id, input, output_length, timeout=None, idempotent=True):
+        """
+        Sends a new ACK-expecting operation. The caller must have acquired a
+        slot in the window.
+        """
+        self._my_lock.acquire()
+        try:
+            seq_no = self._next_seq_no()
+            try:
+                slot = self._completion_slots.pop()
+            except IndexError:
+                slot = threading.Lock()
+            slot.acquire()
+            operation = PendingOperation(self, seq_no, endpoint_id, self._make_packet(seq_no, endpoint_id, input, True, output_length), slot)
+            operation._idempotent = idempotent
+            if not timeout is None:
+                operation._deadline = time.monotonic() + timeout
+            self._expected_acks[seq_no] = operation
+        except:
+            self._window.release()
+            raise
+        finally:
+            self._my_lock.release()
+
+        if self._channel_broken.is_set():
+            self._finish_operation(operation, None, ChannelBrokenException())
         else:
-            trailer = self._interface_definition_crc
-        #print("append trailer " + trailer)
-        packet = packet + struct.pack('<H', trailer)
+            self._resend_or_fail(operation)
+        return operation
 
-        if (expect_ack):
-            ack_event = Event()
-            self._expected_acks[seq_no] = ack_event
+    def _send_operation(self, operation):
+        """
+        Sends the packet of a pending operation once. Returns False if the
+        transport reported a (temporary) failure.
+        """
+        operation._attempts += 1
+        operation._sent_at = time.monotonic()
+        if operation._first_sent_at is None:
+            operation._first_sent_at = operation._sent_at
+        if operation._idempotent:
+            operation._timeout = self._rto
+        else:
+            operation._timeout = max(self._rto, self._non_idempotent_resend_timeout)
+        self._my_lock.acquire()
+        try:
+            self._stats.packets_sent += 1
+            self._stats.bytes_sent += len(operation._packet)
+            if operation._attempts > 1:
+                self._stats.resends += 1
+            self._output.process_packet(operation._packet)
+        except ChannelDamagedException:
+            self._stats.send_errors += 1
+            return False
+        except TimeoutError:
+            self._stats.send_errors += 1
+            return False
+        finally:
+            self._my_lock.release()
+        return True
+
+    def _resend_or_fail(self, operation):
+        """
+        (Re)sends the specified operation or fails it with a
+        ChannelBrokenException if it ran out of send attempts.
+        An operation fails once it was sent at least _send_attempts times
+        and _retry_budget has elapsed since the first transmission. Both
+        conditions must hold, so that a short resend timeout on a fast link
+        doesn't shorten the time that the device has to respond.
+        """
+        send_errors = 0
+        while not operation.done():
+            exhausted = (operation._attempts >= self._send_attempts and
+                         time.monotonic() - operation._first_sent_at >= self._retry_budget)
+            if exhausted or send_errors >= self._send_attempts:
+                exception = ChannelBrokenException("no response from endpoint {} after {} attempts in {:.1f} s".format(
+                        operation._endpoint_id, operation._attempts, time.monotonic() - operation._first_sent_at))
+                if self._finish_operation(operation, None, exception): # Too many resend attempts
+                    self._stats.failed_operations += 1
+                break
+            elif self._send_operation(operation):
+                break
+            send_errors += 1
+
+    def _finish_operation(self, operation, response, exception=None):
+        """
+        Completes the operation unless it was already completed.
+        Returns True if this call completed the operation.
+        """
+        # Whoever removes the operation from _expected_acks completes it
+        if self._expected_acks.pop(operation._seq_no, None) is operation:
+            operation._complete(response, exception)
+            self._window.release()
+            return True
+        return False
+
+    def _get_resend_time(self, operation):
+        """
+        Returns the time at which the operation's resend timer expires
+        """
+        resend_time = operation._sent_at + operation._timeout
+        if not operation._deadline is None:
+            resend_time = min(resend_time, operation._deadline)
+        return resend_time
+
+    def _timer_expired(self, operation):
+        """
+        Called when the resend timer of an operation expires.
+        Every thread that waits for the operation and _acquire_window() watch
+        the same timer, but each expiry is handled only once.
+        """
+        if not operation._deadline is None and time.monotonic() >= operation._deadline:
+            if self._finish_operation(operation, None, TimeoutError()):
+                self._my_lock.acquire()
+                try:
+                    self._stats.expired_operations += 1
+                finally:
+                    self._my_lock.release()
+            return
+
+        self._my_lock.acquire()
+        try:
+            if operation._expired_attempt == operation._attempts or time.monotonic() < self._get_resend_time(operation):
+                return # already handled by another thread
+            operation._expired_attempt = operation._attempts
+            self._stats.timeouts += 1
+            # Exponential backoff (the timeout stays backed off until the next
+            # valid round trip time sample). Operations that were sent with an
+            # outdated or non-RTT-derived, longer timeout don't back off any
+            # further.
+            if operation._idempotent and operation._timeout >= self._rto:
+                self._rto = min(self._rto * 2, self._max_resend_timeout)
+        finally:
+            self._my_lock.release()
+        self._resend_or_fail(operation)
+
+    def _update_rtt(self, rtt):
+        """
+        Updates the resend timeout based on a round trip time sample
+        (see RFC 6298)
+        """
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        rto = self._srtt + max(0.001, 4 * self._rttvar)
+        self._rto = min(max(rto, self._min_resend_timeout), self._max_resend_timeout)
+
+    def stats(self):
+        """
+        Returns a snapshot of this channel's counters and the round trip time
+        histograms per endpoint ID as a plain dict (see ChannelStatistics).
+        Round trip times are only recorded for operations that were sent
+        exactly once, because for resent operations it is unknown which
+        transmission the ACK belongs to.
+        """
+        result = self._stats.to_dict()
+        result['srtt'] = self._srtt
+        result['rto'] = self._rto
+        decoder = getattr(self._input, '_decoder', None)
+        result['header_errors'] = decoder.header_errors if decoder else 0
+        result['crc_failures'] = decoder.crc_failures if decoder else 0
+        return result
+
+    def _fail_all_operations(self):
+        for operation in list(self._expected_acks.values()):
+            self._finish_operation(operation, None, ChannelBrokenException())
+
+    def _wait_for_operation(self, operation, timeout):
+        _callback_lock.acquire()
+        try:
+            if operation._done:
+                return
+            operation._waiters += 1
+            slot = operation._slot
+        finally:
+            _callback_lock.release()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                wait_until = self._get_resend_time(operation)
+                if not deadline is None:
+                    wait_until = min(wait_until, deadline)
+                # Wait for ACK until the resend timeout is exceeded. The slot
+                # is only released once the operation completes. Release it
+                # again right away to pass it on to other waiters.
+                if slot.acquire(timeout=max(wait_until - time.monotonic(), 0)):
+                    slot.release()
+                    break
+                if not deadline is None and time.monotonic() >= deadline:
+                    raise TimeoutError()
+                self._timer_expired(operation)
+        finally:
+            _callback_lock.acquire()
             try:
-                attempt = 0
-                while (attempt < self._send_attempts):
-                    self._my_lock.acquire()
-                    try:
-                        self._output.process_packet(packet)
-                    except ChannelDamagedException:
-                        attempt += 1
-                        continue # resend
-                    except TimeoutError:
-                        attempt += 1
-                        continue # resend
-                    finally:
-                        self._my_lock.release()
-                    # Wait for ACK until the resend timeout is exceeded
-                    try:
-                        if wait_any(self._resend_timeout, ack_event, self._channel_broken) != 0:
-                            raise ChannelBrokenException()
-                    except TimeoutError:
-                        attempt += 1
-                        continue # resend
-                    return self._responses.pop(seq_no)
-                    # TODO: record channel statistics
-                raise ChannelBrokenException() # Too many resend attempts
+                operation._waiters -= 1
+                recycle = operation._done and operation._waiters == 0 and not operation._slot is None
+                if recycle:
+                    operation._slot = None
             finally:
-                self._expected_acks.pop(seq_no)
-                self._responses.pop(seq_no, None)
-        else:
-            # fire and forget
-            self._output.process_packet(packet)
-            return None
+                _callback_lock.release()
+            if recycle:
+                self._completion_slots.append(slot)
     
-    def remote_endpoint_read_buffer(self, endpoint_id):
+    def remote_endpoint_read_buffer(self, endpoint_id, depth=None, max_size=None, progress_callback=None, timeout=None):
         """
-        Handles reads from long endpoints
+        Handles reads from long endpoints.
+        The buffer is read in chunks by requesting consecutive offsets until
+        the device returns an empty chunk. Up to depth requests are kept in
+        flight (1 reads one chunk at a time). The chunk size is learned from
+        the response to the first request.
+        max_size: Limit in bytes after which the read is aborted, so that a
+                  (malicious) device can't send an infinite stream
+        progress_callback: Called as progress_callback(n_bytes) whenever
+                           a chunk was received
+        timeout: If not None, a TimeoutError is raised if the whole buffer was
+                 not read within this many seconds
         """
-        # TODO: handle device that could (maliciously) send infinite stream
-        buffer = bytes()
+        depth = max(self._read_buffer_depth if depth is None else depth, 1)
+        max_size = self._max_read_buffer_size if max_size is None else max_size
+        chunk_length = 512
+        deadline = None if timeout is None else time.monotonic() + timeout
+        def request_chunk(offset):
+            remaining = None
+            if not deadline is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError()
+            return self.start_remote_endpoint_operation(endpoint_id, struct.pack("<I", offset), chunk_length, remaining)
+
+        buffer = bytearray(chunk_length * depth * 4)
+        length = 0 # number of contiguous bytes received so far
+        stride = None # chunk size used by the device
+        pending = []
+        next_offset = 0
+
         while True:
-            chunk_length = 512
-            chunk = self.remote_endpoint_operation(endpoint_id, struct.pack("<I", len(buffer)), True, chunk_length)
-            if (len(chunk) == 0):
+            if not pending:
+                next_offset = length
+            # Keep the pipeline full once the chunk size is known
+            while (not stride is None or not pending) and len(pending) < depth and next_offset <= max_size:
+                pending.append((next_offset, request_chunk(next_offset)))
+                next_offset += chunk_length if stride is None else stride
+            if not pending:
+                raise Exception("endpoint {} provides more than {} bytes".format(endpoint_id, max_size))
+
+            offset, operation = pending.pop(0)
+            chunk = operation.result()
+            if offset != length:
+                # A previous chunk was short. Discard the speculative requests
+                # and continue at the actual end of the data.
+                for _, operation in pending:
+                    operation.result()
+                pending = []
+                next_offset = length
+                continue
+            if len(chunk) == 0:
                 break
-            buffer += chunk
-        return buffer
+            if length + len(chunk) > max_size:
+                raise Exception("endpoint {} provides more than {} bytes".format(endpoint_id, max_size))
+
+            if length + len(chunk) > len(buffer):
+                buffer.extend(bytes(len(buffer)))
+            buffer[length:length + len(chunk)] = chunk
+            length += len(chunk)
+            if stride is None:
+                stride = len(chunk)
+            if not progress_callback is None:
+                progress_callback(length)
+
+        # Wait for the speculative requests beyond the end
+        for _, operation in pending:
+            operation.result()
+        return bytes(memoryview(buffer)[:length])
 
     def process_packet(self, packet):
         #print("process packet")
         packet = bytes(packet)
         if (len(packet) < 2):
             raise Exception("packet too short")
+        self._stats.packets_received += 1
+        self._stats.bytes_received += len(packet)
 
         seq_no = struct.unpack('<H', packet[0:2])[0]
 
         if (seq_no & 0x8000):
             seq_no &= 0x7fff
-            ack_signal = self._expected_acks.get(seq_no, None)
-            if (ack_signal):
-                self._responses[seq_no] = packet[2:]
-                ack_signal.set()
+            operation = self._expected_acks.get(seq_no, None)
+            if (operation) and self._finish_operation(operation, packet[2:]):
                 #print("received ack for packet " + str(seq_no))
+                if operation._attempts == 1:
+                    rtt = time.monotonic() - operation._sent_at
+                    # The response time of a function includes its execution
+                    # time, which says nothing about the link
+                    if operation._idempotent:
+                        self._update_rtt(rtt)
+                    histogram = self._stats.rtt.get(operation._endpoint_id, None)
+                    if histogram is None:
+                        histogram = self._stats.rtt[operation._endpoint_id] = LatencyHistogram()
+                    histogram.record(rtt)
             else:
-                print("received unexpected ACK: " + str(seq_no))
+                self._stats.unexpected_acks += 1
+                self._logger.debug("received unexpected ACK: " + str(seq_no))
 
         else:
-            #if (calc_crc16(CRC16_INIT, struct.pack('<HBB', PROTOCOL_VERSION, packet[-2], packet[-1]))):
-            #     raise Exception("CRC16 mismatch")
-            print("endpoint requested")
-            # TODO: handle local endpoint operation
+            local_node = self.local_node
+            if local_node is None:
+                self._stats.requests_ignored += 1
+                self._logger.debug("ignoring request on channel without local node: " + str(seq_no))
+                return
+            self._stats.requests_handled += 1
+            if self._local_session is None:
+                self._local_session = local_node.create_session()
+            # The node checks the trailer and drops requests with a wrong CRC
+            response = local_node.process_request(packet, self._local_session)
+            if response is None:
+                return
+            self._my_lock.acquire()
+            try:
+                self._stats.packets_sent += 1
+                self._stats.bytes_sent += len(response)
+                self._output.process_packet(response)
+            except (ChannelDamagedException, TimeoutError):
+                # the peer resends the request if the response is lost
+                self._stats.send_errors += 1
+            finally:
+                self._my_lock.release()
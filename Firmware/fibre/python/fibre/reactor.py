@@ -0,0 +1,144 @@
+"""
+Provides a reactor that services the inputs of many channels from a single
+thread instead of one receiver thread per channel.
+"""
+
+import socket
+import selectors
+import threading
+import traceback
+import fibre.protocol
+from fibre.utils import Logger
+
+class Reactor():
+    """
+    Waits on the file descriptors of all registered channels with a selector
+    and processes incoming packets on a single thread.
+    Only channels whose input has a file descriptor (e.g. TCP, UDP, serial on
+    POSIX) can be registered. Other channels keep their own receiver thread.
+    """
+    def __init__(self, logger=Logger(verbose=False)):
+        self._logger = logger
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._channels = {} # fd => channel
+        self._closed = False
+        # Used to interrupt select() when the set of channels changes
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, channel):
+        """
+        Makes the reactor process incoming packets of the specified channel.
+        Returns False if the channel's input can't be watched by this reactor,
+        in which case the caller should fall back to a receiver thread.
+        """
+        try:
+            fd = channel._input.fileno()
+        except (AttributeError, NotImplementedError, OSError):
+            return False
+
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return False
+            try:
+                self._selector.register(fd, selectors.EVENT_READ, channel)
+            except (ValueError, OSError):
+                return False # e.g. non-socket file descriptors on Windows
+            self._channels[fd] = channel
+        finally:
+            self._lock.release()
+
+        channel._channel_broken.subscribe(lambda: self.unregister(channel))
+        self._wakeup()
+        return True
+
+    def unregister(self, channel):
+        self._lock.acquire()
+        try:
+            for fd in [fd for fd, ch in self._channels.items() if ch is channel]:
+                self._channels.pop(fd)
+                try:
+                    self._selector.unregister(fd)
+                except (KeyError, ValueError, OSError):
+                    pass
+        finally:
+            self._lock.release()
+        self._wakeup()
+
+    def get_channel_count(self):
+        return len(self._channels)
+
+    def close(self):
+        """
+        Stops the reactor thread. Channels that are still registered are
+        marked as broken.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            channels = list(self._channels.values())
+        finally:
+            self._lock.release()
+        for channel in channels:
+            channel._channel_broken.set()
+        self._wakeup()
+        self._thread.join()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_sender.send(b'\x00')
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            while not self._closed:
+                for key, _ in self._selector.select():
+                    channel = key.data
+                    if channel is None:
+                        try:
+                            while self._wakeup_receiver.recv(512):
+                                pass
+                        except (BlockingIOError, OSError):
+                            pass
+                    elif key.fd in self._channels:
+                        # Sets the channel to broken if the input fails
+                        channel._process_available_packets()
+        except Exception:
+            self._logger.debug("reactor thread is exiting: " + traceback.format_exc())
+        finally:
+            self._selector.close()
+            self._wakeup_receiver.close()
+            self._wakeup_sender.close()
+
+
+_shared_reactor = None
+_shared_reactor_lock = threading.Lock()
+
+def get_shared_reactor(logger=Logger(verbose=False)):
+    """
+    Returns the process-wide reactor and starts it if necessary.
+    """
+    global _shared_reactor
+    _shared_reactor_lock.acquire()
+    try:
+        if _shared_reactor is None:
+            _shared_reactor = Reactor(logger)
+        return _shared_reactor
+    finally:
+        _shared_reactor_lock.release()
+
+def use_shared_reactor(enable=True, logger=Logger(verbose=False)):
+    """
+    If enabled, all channels that are created from now on use the shared
+    reactor instead of their own receiver thread, provided that their
+    transport exposes a file descriptor.
+    Channels that already exist are not affected.
+    """
+    fibre.protocol.Channel._reactor = get_shared_reactor(logger) if enable else None
@@ -5,7 +5,9 @@ Provides functions for the discovery of Fibre nodes
 import sys
 import json
 import struct
+import time
 import threading
+import asyncio
 import fibre.protocol
 
 class ObjectDefinitionError(Exception):
@@ -18,64 +20,201 @@ class StructCodec():
     Generic serializer/deserializer based on struct pack
     """
     def __init__(self, struct_format, target_type):
-        self._struct_format = struct_format
+        self._struct = struct.Struct(struct_format)
         self._target_type = target_type
     def get_length(self):
-        return struct.calcsize(self._struct_format)
+        return self._struct.size
     def serialize(self, value):
         value = self._target_type(value)
-        return struct.pack(self._struct_format, value)
+        return self._struct.pack(value)
     def deserialize(self, buffer):
-        value = struct.unpack(self._struct_format, buffer)
+        value = self._struct.unpack(buffer)
         value = value[0] if len(value) == 1 else value
         return self._target_type(value)
 
+# Kinds of records in an InterfaceTable
+KIND_OBJECT = 0
+KIND_FUNCTION = 1
+KIND_PROPERTY = 2
+
+# Bits of the access field of InterfaceTable records
+ACCESS_READ = 0x1
+ACCESS_WRITE = 0x2
+
+class InterfaceTable():
+    """
+    Flattened interface definition.
+    records is a list of (kind, access, id, name_index, type_index, size,
+    n_inputs) tuples in depth-first order. Every record is followed by its
+    children: the members of an object or the inputs and then outputs of a
+    function. size is the number of records in the subtree (including the
+    record itself). name_index and type_index refer to strings.
+    """
+    __slots__ = ('records', 'strings', '_codecs')
+
+    def __init__(self, records, strings):
+        self.records = records
+        self.strings = strings
+        self._codecs = {}
+
+    def get_codec(self, type_index):
+        """
+        Returns the (type, codec) tuple for the specified type string index
+        """
+        codec = self._codecs.get(type_index, None)
+        if codec is None:
+            codec = self._codecs[type_index] = get_codec(self.strings[type_index])
+        return codec
+
+    @staticmethod
+    def from_json(json_data, logger=None):
+        """
+        Flattens the JSON description of an object. Malformed members are
+        skipped, like they were never part of the JSON.
+        """
+        records = []
+        strings = []
+        string_indices = {}
+
+        def intern(string):
+            index = string_indices.get(string, None)
+            if index is None:
+                index = string_indices[string] = len(strings)
+                strings.append(string)
+            return index
+
+        def add_property(json_data, default_name):
+            id_str = json_data.get("id", None)
+            if id_str is None:
+                raise ObjectDefinitionError("unspecified endpoint ID")
+            type_str = json_data.get("type", None)
+            if type_str is None:
+                raise ObjectDefinitionError("unspecified type")
+            get_codec(type_str) # raises ObjectDefinitionError if unsupported
+            access_mode = json_data.get("access", "r")
+            access = (ACCESS_READ if 'r' in access_mode else 0) | (ACCESS_WRITE if 'w' in access_mode else 0)
+            records.append((KIND_PROPERTY, access, int(id_str), intern(json_data.get("name", None) or default_name),
+                            intern(type_str), 1, 0))
+
+        def add_function(json_data, name):
+            id_str = json_data.get("id", None)
+            if id_str is None:
+                raise ObjectDefinitionError("unspecified endpoint ID")
+            inputs = json_data.get("arguments", []) + json_data.get("inputs", []) # TODO: deprecate "arguments" keyword
+            outputs = json_data.get("outputs", [])
+            index = len(records)
+            records.append(None)
+            for param_json in inputs + outputs:
+                add_property(param_json, "[anonymous]")
+            records[index] = (KIND_FUNCTION, 0, int(id_str), intern(name), 0, len(records) - index, len(inputs))
+
+        def add_object(json_data, name):
+            index = len(records)
+            records.append(None)
+            for member_json in json_data.get("members", []):
+                member_name = member_json.get("name", None)
+                if member_name is None:
+                    if not logger is None:
+                        logger.debug("ignoring unnamed attribute")
+                    continue
+
+                length = len(records)
+                try:
+                    type_str = member_json.get("type", None)
+                    if type_str == "object":
+                        add_object(member_json, member_name)
+                    elif type_str == "function":
+                        add_function(member_json, member_name)
+                    elif type_str != None:
+                        add_property(member_json, member_name)
+                    else:
+                        raise ObjectDefinitionError("no type information")
+                except ObjectDefinitionError as ex:
+                    if not logger is None:
+                        logger.debug("malformed member {}: {}".format(member_name, str(ex)))
+                    del records[length:]
+                    continue
+            records[index] = (KIND_OBJECT, 0, 0, intern(name), 0, len(records) - index, 0)
+
+        add_object(json_data, json_data.get("name", None) or "")
+        return InterfaceTable(records, strings)
+
+class PropertyDefinition():
+    """
+    Immutable description of a remote property, shared by all devices that
+    run the same firmware
+    """
+    __slots__ = ('id', 'name', 'property_type', 'codec', 'can_read', 'can_write')
+
+    def __init__(self, table, index):
+        _, access, self.id, name_index, type_index, _, _ = table.records[index]
+        self.name = table.strings[name_index]
+        self.property_type, self.codec = table.get_codec(type_index)
+        self.can_read = bool(access & ACCESS_READ)
+        self.can_write = bool(access & ACCESS_WRITE)
+
 class RemoteProperty():
     """
     Used internally by dynamically created objects to translate
     property assignments and fetches into endpoint operations on the
     object's associated channel
     """
-    def __init__(self, json_data, parent):
+    __slots__ = ('_definition', '_parent')
+
+    def __init__(self, definition, parent):
+        self._definition = definition
         self._parent = parent
-        self.__channel__ = parent.__channel__
-        id_str = json_data.get("id", None)
-        if id_str is None:
-            raise ObjectDefinitionError("unspecified endpoint ID")
-        self._id = int(id_str)
-
-        self._name = json_data.get("name", None)
-        if self._name is None:
-            self._name = "[anonymous]"
-
-        type_str = json_data.get("type", None)
-        if type_str is None:
-            raise ObjectDefinitionError("unspecified type")
-
-        # Find all codecs that match the type_str and build a dictionary
-        # of the form {type1: codec1, type2: codec2}
-        eligible_types = {k: v[type_str] for (k,v) in codecs.items() if type_str in v}
-        
-        if not eligible_types:
-            raise ObjectDefinitionError("unsupported codec {}".format(type_str))
 
-        # TODO: better heuristics to select a matching type (i.e. prefer non lossless)
-        eligible_types = list(eligible_types.items())
-        self._property_type = eligible_types[0][0]
-        self._codec = eligible_types[0][1]
+    # Follows the parent when it is attached to a new channel (see RemoteObject._rebind())
+    __channel__ = property(lambda self: self._parent.__channel__)
 
-        access_mode = json_data.get("access", "r")
-        self._can_read = 'r' in access_mode
-        self._can_write = 'w' in access_mode
+    _id = property(lambda self: self._definition.id)
+    _name = property(lambda self: self._definition.name)
+    _property_type = property(lambda self: self._definition.property_type)
+    _codec = property(lambda self: self._definition.codec)
+    _can_read = property(lambda self: self._definition.can_read)
+    _can_write = property(lambda self: self._definition.can_write)
 
     def get_value(self):
-        buffer = self._parent.__channel__.remote_endpoint_operation(self._id, None, True, self._codec.get_length())
-        return self._codec.deserialize(buffer)
+        definition = self._definition
+        buffer = self._parent.__channel__.remote_endpoint_operation(definition.id, None, True, definition.codec.get_length())
+        return definition.codec.deserialize(buffer)
 
     def set_value(self, value):
-        buffer = self._codec.serialize(value)
+        definition = self._definition
+        buffer = definition.codec.serialize(value)
         # TODO: Currenly we wait for an ack here. Settle on the default guarantee.
-        self._parent.__channel__.remote_endpoint_operation(self._id, buffer, True, 0)
+        self._parent.__channel__.remote_endpoint_operation(definition.id, buffer, True, 0)
+
+    async def get_value_async(self):
+        buffer = await self._parent.__channel__.remote_endpoint_operation_async(self._id, None, self._codec.get_length())
+        return self._codec.deserialize(buffer)
+
+    async def set_value_async(self, value):
+        buffer = self._codec.serialize(value)
+        await self._parent.__channel__.remote_endpoint_operation_async(self._id, buffer, 0)
+
+    async def values_async(self, interval=0.0):
+        """
+        Asynchronous generator that yields the value of this property every
+        interval seconds. Use as:
+            async for value in prop.values_async(0.01):
+                ...
+        If a read takes longer than the interval, the next read starts
+        immediately.
+        """
+        next_time = time.monotonic()
+        while True:
+            yield await self.get_value_async()
+            next_time = max(next_time + interval, time.monotonic())
+            await asyncio.sleep(next_time - time.monotonic())
+
+    def stream(self, **kwargs):
+        """
+        Returns a PropertyStream for high-rate writes to this property.
+        See PropertyStream for the arguments.
+        """
+        return PropertyStream(self, **kwargs)
 
     def _dump(self):
         if self._name == "serial_number":
@@ -92,8 +231,9 @@ class EndpointRefCodec():
     """
     Serializer/deserializer for an endpoint reference
     """
+    _struct = struct.Struct("<HH")
     def get_length(self):
-        return struct.calcsize("<HH")
+        return self._struct.size
     def serialize(self, value):
         if value is None:
             (ep_id, ep_crc) = (0, 0)
@@ -101,9 +241,9 @@ class EndpointRefCodec():
             (ep_id, ep_crc) = (value._id, value.__channel__._interface_definition_crc)
         else:
             raise TypeError("Expected value of type RemoteProperty or None but got '{}'. En example for a RemoteProperty is this expression: odrv0.axis0.controller._remote_attributes['pos_setpoint']".format(type(value).__name__))
-        return struct.pack("<HH", ep_id, ep_crc)
+        return self._struct.pack(ep_id, ep_crc)
     def deserialize(self, buffer):
-        return struct.unpack("<HH", buffer)
+        return self._struct.unpack(buffer)
 
 codecs[int] = {
     'int8': StructCodec("<b", int),
@@ -128,91 +268,538 @@ codecs[RemoteProperty] = {
     'endpoint_ref': EndpointRefCodec()
 }
 
+# Maps type strings to (type, codec) tuples. Built from codecs on first use,
+# so additional codecs must be registered before the first object is created.
+_codec_lookup = None
+
+def get_codec(type_str):
+    """
+    Returns a tuple (type, codec) for the specified JSON type string.
+    """
+    global _codec_lookup
+    if _codec_lookup is None:
+        lookup = {}
+        # TODO: better heuristics to select a matching type (i.e. prefer non lossless)
+        for property_type, type_codecs in codecs.items():
+            for name, codec in type_codecs.items():
+                lookup.setdefault(name, (property_type, codec))
+        _codec_lookup = lookup
+    result = _codec_lookup.get(type_str, None)
+    if result is None:
+        raise ObjectDefinitionError("unsupported codec {}".format(type_str))
+    return result
+
+
+def read_many(properties):
+    """
+    Reads the values of several RemoteProperty instances and returns them as a
+    list in the same order.
+    All requests are sent before waiting for the first response, so the whole
+    batch costs roughly one round trip per channel window rather than one
+    round trip per property. The properties can belong to different objects
+    and channels.
+    """
+    operations = [prop.__channel__.start_remote_endpoint_operation(prop._id, None, prop._codec.get_length())
+                  for prop in properties]
+    return [prop._codec.deserialize(operation.result())
+            for prop, operation in zip(properties, operations)]
+
+def write_many(values):
+    """
+    Writes several RemoteProperty instances at once.
+    values is a dict of the form {RemoteProperty: value} or a list of
+    (RemoteProperty, value) tuples. All values are serialized before the first
+    request is sent, so a value of the wrong type doesn't leave the batch half
+    written.
+    """
+    items = list(values.items()) if isinstance(values, dict) else list(values)
+    buffers = [(prop, prop._codec.serialize(value)) for prop, value in items]
+    operations = [prop.__channel__.start_remote_endpoint_operation(prop._id, buffer, 0)
+                  for prop, buffer in buffers]
+    for operation in operations:
+        operation.result()
+
+
+class PropertyStream():
+    """
+    Write-behind stream of values for a single RemoteProperty, intended for
+    setpoints that are updated at a high rate (e.g. controller.input_pos).
+
+    write() never blocks on the device. Only the newest value that was not yet
+    sent is kept: if a value is written before the previous one was sent, the
+    previous one is dropped. A background thread sends the values.
+
+    expect_ack: If True, values are sent as ACK'd writes with at most
+                max_in_flight unacknowledged writes at a time. If False, values
+                are sent fire-and-forget.
+    max_age: A value counts as late if it was acknowledged (or sent, if
+             expect_ack is False) more than max_age seconds after it was
+             written.
+    timeout: per-write timeout for ACK'd writes (see
+             Channel.remote_endpoint_operation)
+
+    The counters written, sent, dropped, late and failed can be read at any
+    time.
+    """
+    def __init__(self, prop, expect_ack=True, max_in_flight=1, max_age=0.01, timeout=None):
+        if not prop._can_write:
+            raise Exception("Cannot write to property {}".format(prop._name))
+        self._prop = prop
+        self._expect_ack = expect_ack
+        self._max_in_flight = max_in_flight
+        self._max_age = max_age
+        self._timeout = timeout
+        self.written = 0 # values passed to write()
+        self.sent = 0 # values handed to the channel
+        self.dropped = 0 # values superseded before they were sent
+        self.late = 0 # values that took longer than max_age to get through
+        self.failed = 0 # values that timed out or were lost to a broken channel
+        self._pending = None # (buffer, time written) of the newest unsent value
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="stream " + prop._name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, value):
+        """
+        Queues value to be sent, replacing any value that is still pending.
+        """
+        buffer = self._prop._codec.serialize(value)
+        written_at = time.monotonic()
+        with self._cond:
+            if self._closed:
+                if self._prop.__channel__._channel_broken.is_set():
+                    raise fibre.protocol.ChannelBrokenException()
+                raise Exception("stream is closed")
+            self.written += 1
+            if not self._pending is None:
+                self.dropped += 1
+            self._pending = (buffer, written_at)
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Blocks until the newest value was sent and, if expect_ack is True,
+        acknowledged. Returns False if the timeout expired first.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._closed or (self._pending is None and self._in_flight == 0), timeout)
+
+    def close(self, timeout=None):
+        """
+        Sends the pending value (if any) and stops the stream.
+        """
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {'written': self.written, 'sent': self.sent, 'dropped': self.dropped,
+                    'late': self.late, 'failed': self.failed}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        channel = self._prop.__channel__
+        while True:
+            with self._cond:
+                while not self._closed and (self._pending is None or self._in_flight >= self._max_in_flight):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                buffer, written_at = self._pending
+                self._pending = None
+                self._in_flight += 1
+                self.sent += 1
+            try:
+                if self._expect_ack:
+                    operation = channel.start_remote_endpoint_operation(self._prop._id, buffer, 0, self._timeout)
+                    operation.add_done_callback(lambda op, written_at=written_at: self._on_done(op._exception, written_at))
+                else:
+                    channel.remote_endpoint_operation(self._prop._id, buffer, False, 0)
+                    self._on_done(None, written_at)
+            except Exception as ex:
+                self._on_done(ex, written_at)
+
+    def _on_done(self, exception, written_at):
+        with self._cond:
+            self._in_flight -= 1
+            if not exception is None:
+                self.failed += 1
+                if isinstance(exception, fibre.protocol.ChannelBrokenException):
+                    self._closed = True
+            elif time.monotonic() - written_at > self._max_age:
+                self.late += 1
+            self._cond.notify_all()
+
+
+class FunctionDefinition():
+    """
+    Immutable description of a remote function, shared by all devices that
+    run the same firmware
+    """
+    __slots__ = ('id', 'name', 'inputs', 'outputs')
+
+    def __init__(self, table, index):
+        _, _, self.id, name_index, _, size, n_inputs = table.records[index]
+        self.name = table.strings[name_index]
+        self.inputs = [PropertyDefinition(table, i) for i in range(index + 1, index + 1 + n_inputs)]
+        self.outputs = [PropertyDefinition(table, i) for i in range(index + 1 + n_inputs, index + size)]
 
 class RemoteFunction(object):
     """
     Represents a callable function that maps to a function call on a remote object
     """
-    def __init__(self, json_data, parent):
-        self._parent = parent
-        id_str = json_data.get("id", None)
-        if id_str is None:
-            raise ObjectDefinitionError("unspecified endpoint ID")
-        self._trigger_id = int(id_str)
+    __slots__ = ('_definition', '_parent', '_inputs', '_outputs')
 
-        self._name = json_data.get("name", None)
-        if self._name is None:
-            self._name = "[anonymous]"
-
-        self._inputs = []
-        for param_json in json_data.get("arguments", []) + json_data.get("inputs", []): # TODO: deprecate "arguments" keyword
-            param_json["mode"] = "r"
-            self._inputs.append(RemoteProperty(param_json, parent))
+    def __init__(self, definition, parent):
+        self._definition = definition
+        self._parent = parent
+        self._inputs = [RemoteProperty(param, parent) for param in definition.inputs]
+        self._outputs = [RemoteProperty(param, parent) for param in definition.outputs]
 
-        self._outputs = []
-        for param_json in json_data.get("outputs", []): # TODO: deprecate "arguments" keyword
-            param_json["mode"] = "r"
-            self._outputs.append(RemoteProperty(param_json, parent))
+    _trigger_id = property(lambda self: self._definition.id)
+    _name = property(lambda self: self._definition.name)
 
     def __call__(self, *args):
         if (len(self._inputs) != len(args)):
             raise TypeError("expected {} arguments but have {}".format(len(self._inputs), len(args)))
         for i in range(len(args)):
             self._inputs[i].set_value(args[i])
-        self._parent.__channel__.remote_endpoint_operation(self._trigger_id, None, True, 0)
+        self._parent.__channel__.remote_endpoint_operation(self._trigger_id, None, True, 0, idempotent=False)
         if len(self._outputs) > 0:
             return self._outputs[0].get_value()
 
+    async def call_async(self, *args):
+        """
+        Coroutine version of calling this function
+        """
+        if (len(self._inputs) != len(args)):
+            raise TypeError("expected {} arguments but have {}".format(len(self._inputs), len(args)))
+        await asyncio.gather(*[self._inputs[i].set_value_async(args[i]) for i in range(len(args))])
+        await self._parent.__channel__.remote_endpoint_operation_async(self._trigger_id, None, 0, idempotent=False)
+        if len(self._outputs) > 0:
+            return await self._outputs[0].get_value_async()
+
     def _dump(self):
         return "{}({})".format(self._name, ", ".join("{}: {}".format(x._name, x._property_type.__name__) for x in self._inputs))
 
-class RemoteObject(object):
+class RemotePropertyAttribute():
+    """
+    Data descriptor that maps a property of a compiled RemoteObject class to
+    get_value()/set_value() calls on the RemoteProperty stored in one of the
+    object's slots
+    """
+    __slots__ = ('_name', '_slot')
+
+    def __init__(self, name, slot):
+        self._name = name
+        self._slot = slot # member descriptor of the slot
+
+    def _get_property(self, obj):
+        try:
+            return self._slot.__get__(obj)
+        except AttributeError:
+            pass
+        obj._materialize()
+        try:
+            return self._slot.__get__(obj)
+        except AttributeError:
+            raise AttributeError("Attribute {} not found".format(self._name))
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        prop = self._get_property(obj)
+        if prop._can_read:
+            return prop.get_value()
+        else:
+            raise Exception("Cannot read from property {}".format(self._name))
+
+    def __set__(self, obj, value):
+        prop = self._get_property(obj)
+        if prop._can_write:
+            prop.set_value(value)
+        else:
+            raise Exception("Cannot write to property {}".format(self._name))
+
+class ObjectDefinition():
     """
-    Object with functions and properties that map to remote endpoints
+    Immutable description of a remote object, shared by all devices that run
+    the same firmware. The definitions of the members are created on first
+    use.
     """
-    def __init__(self, json_data, parent, channel, logger):
+    __slots__ = ('name', 'object_class', '_table', '_index', '_members')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+        self.name = table.strings[table.records[index][3]]
+        self._members = None
+        signature = tuple((table.strings[record[3]], record[0] == KIND_PROPERTY)
+                          for record in self._get_member_records())
+        self.object_class = get_object_class(signature, self.name)
+
+    @staticmethod
+    def from_json(json_data, logger=None):
+        return ObjectDefinition(InterfaceTable.from_json(json_data, logger), 0)
+
+    def _get_member_records(self):
+        records = self._table.records
+        index = self._index + 1
+        end = self._index + records[self._index][5]
+        while index < end:
+            yield records[index]
+            index += records[index][5]
+
+    def get_members(self):
+        """
+        Returns a list of (name, definition) tuples where definition is an
+        ObjectDefinition, FunctionDefinition or PropertyDefinition.
+        """
+        members = self._members
+        if members is None:
+            table = self._table
+            members = []
+            index = self._index + 1
+            end = self._index + table.records[self._index][5]
+            while index < end:
+                record = table.records[index]
+                if record[0] == KIND_OBJECT:
+                    definition = ObjectDefinition(table, index)
+                elif record[0] == KIND_FUNCTION:
+                    definition = FunctionDefinition(table, index)
+                else:
+                    definition = PropertyDefinition(table, index)
+                members.append((table.strings[record[3]], definition))
+                index += record[5]
+            # Concurrent callers may both build the list, which is harmless
+            self._members = members
+        return members
+
+    def get_member(self, name):
         """
-        Creates an object that implements the specified JSON type description by
-        communicating over the provided channel
+        Returns the definition of the member with the specified name or None
+        if there is no such member. Only the definition of that member is
+        created, which makes this cheap for one-off lookups.
         """
-        # Directly write to __dict__ to avoid calling __setattr__ too early
-        object.__getattribute__(self, "__dict__")["_remote_attributes"] = {}
-        object.__getattribute__(self, "__dict__")["__sealed__"] = False
-        # Assign once more to make linter happy
-        self._remote_attributes = {}
-        self.__sealed__ = False
+        members = self._members
+        if not members is None:
+            return dict(members).get(name, None)
+        table = self._table
+        index = self._index + 1
+        end = self._index + table.records[self._index][5]
+        while index < end:
+            record = table.records[index]
+            if table.strings[record[3]] == name:
+                if record[0] == KIND_OBJECT:
+                    return ObjectDefinition(table, index)
+                elif record[0] == KIND_FUNCTION:
+                    return FunctionDefinition(table, index)
+                else:
+                    return PropertyDefinition(table, index)
+            index += record[5]
+        return None
+
+class Schema():
+    """
+    Interface definition of a firmware. Devices with the same firmware share
+    one Schema (see get_schema()) and thereby one tree of definitions.
+    """
+    def __init__(self, table, json_crc, json_bytes):
+        self.table = table
+        self.json_crc = json_crc
+        self.json_bytes = json_bytes
+        self.root = ObjectDefinition(table, 0)
+        self._json_data = None
+
+    @property
+    def json_data(self):
+        """
+        List of the root object's members as found in the JSON. Only parsed
+        on demand.
+        """
+        if self._json_data is None:
+            self._json_data = json.loads(self.json_bytes.decode("ascii"))
+        return self._json_data
+
+# Schemas by JSON interface definition and by JSON version tag. The table is
+# keyed by the JSON itself rather than its 16-bit CRC, because different
+# firmwares can have colliding CRCs.
+_schemas = {}
+_schemas_by_version_tag = {}
+
+def add_schema(schema):
+    """
+    Registers a schema and returns it. If a schema with the same JSON is
+    already known, that one is returned instead.
+    """
+    return _schemas.setdefault(bytes(schema.json_bytes), schema)
+
+def get_schema(json_bytes, json_crc=None, logger=None):
+    """
+    Returns the Schema for the specified JSON interface definition. The JSON is
+    only parsed if no schema with the same JSON is known yet.
+    Raises UnicodeDecodeError or ValueError if json_bytes is not valid JSON.
+    """
+    json_bytes = bytes(json_bytes)
+    schema = _schemas.get(json_bytes, None)
+    if schema is None:
+        if json_crc is None:
+            json_crc = fibre.protocol.calc_crc16(fibre.protocol.PROTOCOL_VERSION, json_bytes)
+        json_data = json.loads(json_bytes.decode("ascii"))
+        table = InterfaceTable.from_json({"name": "fibre_node", "members": json_data}, logger)
+        schema = Schema(table, json_crc, json_bytes)
+        schema._json_data = json_data
+        schema = add_schema(schema)
+    return schema
+
+def get_schema_by_version_tag(json_version_tag):
+    """
+    Returns the Schema of a device that reported the specified JSON version
+    tag or None if there is no such schema yet (see set_schema_version_tag()).
+    """
+    return _schemas_by_version_tag.get(json_version_tag, None)
+
+def set_schema_version_tag(json_version_tag, schema):
+    _schemas_by_version_tag[json_version_tag] = schema
+
+# Compiled RemoteObject classes by interface signature (see get_object_class())
+_object_classes = {}
+
+def get_object_class(signature, name=""):
+    """
+    Returns the RemoteObject subclass for objects with the specified members.
+    signature is a tuple of (member name, is property) tuples.
+    The class has one slot per member. Properties are exposed through
+    RemotePropertyAttribute descriptors, sub-objects and functions through
+    plain slots. Classes are cached, so objects with the same members (e.g.
+    axis0 and axis1) share a class.
+    A member whose name is taken by RemoteObject itself (e.g. stream or
+    _dump) is exposed with trailing underscores (e.g. stream_), so that it
+    doesn't shadow what the object relies on. _remote_attributes lists it
+    under its own name.
+    """
+    cls = _object_classes.get(signature, None)
+    if cls is None:
+        taken = set(dir(RemoteObject))
+        attribute_names = {}
+        slot_names = {}
+        for member_name, is_property in signature:
+            attribute_name = member_name
+            while attribute_name in taken or (is_property and "_property_" + attribute_name in taken):
+                attribute_name += '_'
+            attribute_names[member_name] = attribute_name
+            slot_names[member_name] = "_property_" + attribute_name if is_property else attribute_name
+            taken.update((attribute_name, slot_names[member_name]))
+        cls = type("RemoteObject[{}]".format(name), (RemoteObject,), {
+            '__slots__': tuple(slot_names.values()),
+            '__module__': __name__,
+            '_slot_names': slot_names,
+            '_attribute_names': attribute_names
+        })
+        for member_name, is_property in signature:
+            if is_property:
+                setattr(cls, attribute_names[member_name], RemotePropertyAttribute(member_name, getattr(cls, slot_names[member_name])))
+        cls = _object_classes.setdefault(signature, cls)
+    return cls
 
+class RemoteObject(object):
+    """
+    Object with functions and properties that map to remote endpoints.
+    Instantiating RemoteObject yields an instance of a compiled subclass that
+    is specific to the interface (see get_object_class()).
+    The members are created when any of them is accessed for the first time,
+    so subtrees that are never used cost little.
+    """
+    __slots__ = ('_definition', '_members', '_pending', '_logger', '_detached', '__channel__', '__parent__', '_schema', '_discovery', '__weakref__')
+    _slot_names = {} # slot by member name
+    _attribute_names = {} # attribute by member name (see get_object_class())
+
+    def __new__(cls, definition, parent, channel, logger):
+        if not isinstance(definition, ObjectDefinition):
+            definition = ObjectDefinition.from_json(definition, logger)
+        obj = object.__new__(definition.object_class)
+        obj._definition = definition
+        return obj
+
+    def __init__(self, definition, parent, channel, logger):
+        """
+        Creates an object that implements the specified type description by
+        communicating over the provided channel.
+        definition: An ObjectDefinition (e.g. the root of a Schema) or a JSON
+                    type description
+        """
+        self._members = {}
+        self._pending = True # cleared once the members are created
+        self._logger = logger
+        self._detached = None
         self.__channel__ = channel
         self.__parent__ = parent
+        channel._channel_broken.subscribe(self._tear_down)
 
-        # Build attribute list from JSON
-        for member_json in json_data.get("members", []):
-            member_name = member_json.get("name", None)
-            if member_name is None:
-                logger.debug("ignoring unnamed attribute")
-                continue
+    def __getattr__(self, name):
+        # Only called if regular attribute lookup failed, e.g. because the
+        # slot of a sub-object or function was not populated yet
+        if self._pending and name in self._slot_names.values():
+            self._materialize()
+            return object.__getattribute__(self, name)
+        raise AttributeError("Attribute {} not found".format(name))
 
-            try:
-                type_str = member_json.get("type", None)
-                if type_str == "object":
-                    attribute = RemoteObject(member_json, self, channel, logger)
-                elif type_str == "function":
-                    attribute = RemoteFunction(member_json, self)
-                elif type_str != None:
-                    attribute = RemoteProperty(member_json, self)
-                else:
-                    raise ObjectDefinitionError("no type information")
-            except ObjectDefinitionError as ex:
-                logger.debug("malformed member {}: {}".format(member_name, str(ex)))
-                continue
+    # Only available on root objects (see discovery)
+    _json_data = property(lambda self: self._schema.json_data)
+    _json_crc = property(lambda self: self._schema.json_crc)
 
-            self._remote_attributes[member_name] = attribute
-            self.__dict__[member_name] = attribute
+    @property
+    def _remote_attributes(self):
+        """
+        Dict of all members of this object
+        """
+        if self._pending:
+            self._materialize()
+        return self._members
 
-        # Ensure that from here on out assignments to undefined attributes
-        # raise an exception
-        self.__sealed__ = True
-        channel._channel_broken.subscribe(self._tear_down)
+    def _materialize(self):
+        """
+        Creates the members of this object unless this already happened.
+        """
+        if not self._pending:
+            return
+        channel = self.__channel__
+        logger = self._logger
+
+        members = {}
+        for member_name, definition in self._definition.get_members():
+            if isinstance(definition, ObjectDefinition):
+                attribute = RemoteObject(definition, self, channel, logger)
+            elif isinstance(definition, FunctionDefinition):
+                attribute = RemoteFunction(definition, self)
+            else:
+                attribute = RemoteProperty(definition, self)
+            members[member_name] = attribute
+
+        _materialize_lock.acquire()
+        try:
+            # Another thread may have materialized or torn down the object
+            # in the meantime
+            if not self._pending:
+                return
+            for member_name, attribute in members.items():
+                object.__setattr__(self, self._slot_names[member_name], attribute)
+            self._members = members
+            self._pending = False
+            self._logger = None
+        finally:
+            _materialize_lock.release()
 
     def _dump(self, indent, depth):
         if depth <= 0:
@@ -232,33 +819,71 @@ class RemoteObject(object):
     def __repr__(self):
         return self.__str__()
 
-    def __getattribute__(self, name):
-        attr = object.__getattribute__(self, "_remote_attributes").get(name, None)
-        if isinstance(attr, RemoteProperty):
-            if attr._can_read:
-                return attr.get_value()
-            else:
-                raise Exception("Cannot read from property {}".format(name))
-        elif attr != None:
-            return attr
-        else:
-            return object.__getattribute__(self, name)
-            #raise AttributeError("Attribute {} not found".format(name))
+    def __dir__(self):
+        # Only list the members that are still available (see _tear_down())
+        names = set(object.__dir__(self)) - set(self._attribute_names.values()) - set(self._slot_names.values())
+        return sorted(names | set(self._attribute_names[name] for name in self._remote_attributes.keys()))
 
-    def __setattr__(self, name, value):
-        attr = object.__getattribute__(self, "_remote_attributes").get(name, None)
-        if isinstance(attr, RemoteProperty):
-            if attr._can_write:
-                attr.set_value(value)
-            else:
-                raise Exception("Cannot write to property {}".format(name))
-        elif not object.__getattribute__(self, "__sealed__") or name in object.__getattribute__(self, "__dict__"):
-            object.__getattribute__(self, "__dict__")[name] = value
-        else:
-            raise AttributeError("Attribute {} not found".format(name))
+    def stream(self, name, **kwargs):
+        """
+        Returns a PropertyStream for high-rate writes to the property with the
+        specified name, e.g. axis.controller.stream('input_pos').
+        See PropertyStream for the arguments.
+        """
+        attr = self._remote_attributes.get(name, None)
+        if not isinstance(attr, RemoteProperty):
+            raise AttributeError("Property {} not found".format(name))
+        return attr.stream(**kwargs)
+
+    def wait_for_reconnect(self, timeout=None, cancellation_token=None):
+        """
+        Waits until the device reconnects (e.g. after a reboot) and returns it.
+        Only available on objects returned by fibre.find_any().
+        See fibre.discovery.wait_for_reconnect() for details.
+        """
+        import fibre.discovery
+        return fibre.discovery.wait_for_reconnect(self, timeout, cancellation_token)
 
     def _tear_down(self):
-        # Clear all remote members
-        for k in self._remote_attributes.keys():
-            self.__dict__.pop(k)
-        self._remote_attributes = {}
+        # Clear all remote members. They are kept aside in case the device
+        # reconnects (see _rebind()).
+        _materialize_lock.acquire()
+        try:
+            if not self.__channel__._channel_broken.is_set():
+                return # already attached to a new channel
+            if self._detached is None:
+                self._detached = (self._pending, self._members, self._logger)
+            self._pending = False
+            self._logger = None
+            for k in self._members.keys():
+                object.__delattr__(self, self._slot_names[k])
+            self._members = {}
+        finally:
+            _materialize_lock.release()
+
+    def _rebind(self, channel):
+        """
+        Attaches this object and all of its members that were created so far
+        to a new channel that leads to a device with the same interface.
+        """
+        _materialize_lock.acquire()
+        try:
+            if not self._detached is None:
+                self._pending, self._members, self._logger = self._detached
+                self._detached = None
+                for k, attribute in self._members.items():
+                    object.__setattr__(self, self._slot_names[k], attribute)
+            old_channel = self.__channel__
+            self.__channel__ = channel
+            children = [attribute for attribute in self._members.values() if isinstance(attribute, RemoteObject)]
+        finally:
+            _materialize_lock.release()
+        # The old channel would otherwise keep this object alive
+        old_channel._channel_broken.unsubscribe(self._tear_down)
+        channel._channel_broken.subscribe(self._tear_down)
+        for child in children:
+            child._rebind(channel)
+
+# Protects the transition of RemoteObject instances from their JSON
+# description to created members
+_materialize_lock = threading.Lock()
@@ -0,0 +1,143 @@
+"""
+On-disk cache of parsed interface definitions (schemas).
+
+Each cache entry is a binary file that holds the flattened interface table
+(see fibre.remote_object.InterfaceTable), the JSON CRC and the original JSON.
+Loading an entry requires neither a CRC pass over the JSON nor JSON parsing.
+Entries are keyed and validated by the JSON version tag that the device
+reports.
+"""
+
+import os
+import struct
+import tempfile
+import zlib
+import fibre.remote_object
+
+# Maximum number of entries in the cache directory. The least recently used
+# entries are deleted first.
+max_entries = 16
+
+_file_prefix = 'fibre_schema_cache_'
+_magic = b'FSC1'
+_header_struct = struct.Struct('<4sIHIII') # magic, version tag, JSON CRC, number of records, length of string table, length of JSON
+_record_struct = struct.Struct('<BBHIHIH') # see InterfaceTable
+_trailer_struct = struct.Struct('<I') # CRC32 of everything before the trailer
+
+def get_cache_path(cache_dir, json_version_tag):
+    return os.path.join(cache_dir, _file_prefix + '{:08x}.bin'.format(json_version_tag))
+
+def encode(schema, json_version_tag):
+    """
+    Serializes a schema into the cache file format
+    """
+    table = schema.table
+    strings = '\0'.join(table.strings).encode('ascii')
+    records = b''.join(_record_struct.pack(*record) for record in table.records)
+    data = (_header_struct.pack(_magic, json_version_tag, schema.json_crc, len(table.records), len(strings), len(schema.json_bytes))
+            + records + strings + schema.json_bytes)
+    return data + _trailer_struct.pack(zlib.crc32(data))
+
+def decode(data, json_version_tag):
+    """
+    Deserializes a schema from the cache file format. Raises a ValueError if
+    the data is corrupted or belongs to a different version tag.
+    """
+    if len(data) < _header_struct.size + _trailer_struct.size:
+        raise ValueError("cache entry too short")
+    if zlib.crc32(data[:-_trailer_struct.size]) != _trailer_struct.unpack_from(data, len(data) - _trailer_struct.size)[0]:
+        raise ValueError("cache entry corrupted")
+    magic, tag, json_crc, n_records, strings_length, json_length = _header_struct.unpack_from(data, 0)
+    if magic != _magic:
+        raise ValueError("unknown cache entry format")
+    if tag != json_version_tag:
+        raise ValueError("cache entry belongs to version tag {:08x}".format(tag))
+
+    offset = _header_struct.size
+    records_length = n_records * _record_struct.size
+    if offset + records_length + strings_length + json_length + _trailer_struct.size != len(data):
+        raise ValueError("cache entry has inconsistent length")
+    records = list(_record_struct.iter_unpack(data[offset:offset + records_length]))
+    offset += records_length
+    strings = data[offset:offset + strings_length].decode('ascii').split('\0')
+    offset += strings_length
+    json_bytes = data[offset:offset + json_length]
+
+    table = fibre.remote_object.InterfaceTable(records, strings)
+    return fibre.remote_object.Schema(table, json_crc, json_bytes)
+
+def load(cache_dir, json_version_tag, logger):
+    """
+    Returns the cached schema for the specified version tag or None if there
+    is no valid cache entry.
+    """
+    cache_path = get_cache_path(cache_dir, json_version_tag)
+    try:
+        with open(cache_path, 'rb') as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return None
+    except OSError as ex:
+        logger.debug("Failed to read schema cache file {}: {}".format(cache_path, ex))
+        return None
+
+    try:
+        schema = decode(data, json_version_tag)
+    except (ValueError, struct.error, UnicodeDecodeError) as ex:
+        logger.debug("Ignoring schema cache file {}: {}".format(cache_path, ex))
+        return None
+
+    # Mark the entry as recently used
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return fibre.remote_object.add_schema(schema)
+
+def save(cache_dir, json_version_tag, schema, logger):
+    """
+    Stores a schema in the cache and evicts the least recently used entries if
+    the cache is full. The file is written atomically, so concurrent processes
+    never see a partially written entry.
+    """
+    cache_path = get_cache_path(cache_dir, json_version_tag)
+    logger.debug("Creating new schema cache file {}".format(cache_path))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix='.' + _file_prefix)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(encode(schema, json_version_tag))
+            os.replace(temp_path, cache_path)
+        except:
+            os.unlink(temp_path)
+            raise
+        logger.debug("Saved schema to cache file {}".format(cache_path))
+    except Exception as ex:
+        logger.warn("Failed to cache schema: {}".format(ex))
+        return
+    prune(cache_dir, logger)
+
+def prune(cache_dir, logger):
+    """
+    Deletes the least recently used cache entries (including raw JSON entries
+    of older versions) until at most max_entries are left.
+    """
+    try:
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.startswith(_file_prefix):
+                path = os.path.join(cache_dir, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    pass # deleted by another process in the meantime
+        entries.sort()
+        for _, path in entries[:max(len(entries) - max_entries, 0)]:
+            logger.debug("Evicting schema cache file {}".format(path))
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    except OSError as ex:
+        logger.debug("Failed to prune schema cache: {}".format(ex))
@@ -5,31 +5,66 @@ PacketSource/PacketSink interfaces for serial ports.
 
 import os
 import re
+import select
+import sys
 import time
 import traceback
 import serial
 import serial.tools.list_ports
 import fibre
+import fibre.hotplug
 from fibre.utils import TimeoutError
 
-# TODO: make this customizable
 DEFAULT_BAUDRATE = 115200
 
 class SerialStreamTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
+    """
+    Stream transport over a serial port.
+    On POSIX platforms the port is read without blocking, directly into the
+    caller's buffer, and only waited on (with poll or select) if no data is
+    buffered by the OS. Elsewhere the read timeout of the port is adjusted to
+    the deadline.
+    """
     def __init__(self, port, baud):
-        self._timeout = 1
+        self._timeout = 0
         self._dev = serial.Serial(port, baud, timeout=self._timeout)
+        self._wait_readable = None
+        try:
+            self._fd = self._dev.fileno()
+            if hasattr(os, 'readv'):
+                self._wait_readable = self._make_waiter(self._fd)
+        except (AttributeError, NotImplementedError, serial.serialutil.SerialException):
+            self._fd = None
+        if self._wait_readable is None:
+            self._timeout = 1
+            self._dev.timeout = self._timeout
 
-    def process_bytes(self, bytes):
-        self._dev.write(bytes)
-
-    def get_bytes(self, n_bytes, deadline):
+    @staticmethod
+    def _make_waiter(fd):
         """
-        Returns n bytes unless the deadline is reached, in which case the bytes
-        that were read up to that point are returned. If deadline is None the
-        function blocks forever. A deadline before the current time corresponds
-        to non-blocking mode.
+        Returns a function that waits until fd is readable or the timeout (in
+        seconds, None for no timeout) expires and returns True if it's
+        readable.
         """
+        # poll() on macOS doesn't support devices and reports POLLNVAL for ttys
+        if hasattr(select, 'poll') and sys.platform != 'darwin':
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            return lambda timeout: len(poller.poll(None if timeout is None else timeout * 1000)) > 0
+        return lambda timeout: len(select.select([fd], [], [], timeout)[0]) > 0
+
+    def fileno(self):
+        # Only available on POSIX platforms
+        return self._dev.fileno()
+
+    def process_bytes(self, bytes):
+        # StreamBasedPacketSink passes a whole frame, which goes out in one write
+        try:
+            self._dev.write(bytes)
+        except (serial.serialutil.SerialException, OSError):
+            raise fibre.protocol.ChannelBrokenException()
+
+    def _set_timeout(self, deadline):
         # Only set new timeout value if it is reasonably different from the old one (e.g. 20% as below)
         # Otherwise it adds significant overhead (at least under Win10) as the port is reset with every reconfiguration
         if deadline is None and self._timeout is not None:
@@ -37,15 +72,64 @@ class SerialStreamTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSi
             self._dev.timeout = None
         elif deadline is not None:
             new_timeout = max(deadline - time.monotonic(), 0)
-            if abs(new_timeout - self._timeout) > self._timeout * 0.2:
+            if self._timeout is None or abs(new_timeout - self._timeout) > self._timeout * 0.2:
                 self._timeout = new_timeout
                 self._dev.timeout = new_timeout
-        return self._dev.read(n_bytes)
+
+    def get_bytes(self, n_bytes, deadline):
+        """
+        Returns n bytes unless the deadline is reached, in which case the bytes
+        that were read up to that point are returned. If deadline is None the
+        function blocks forever. A deadline before the current time corresponds
+        to non-blocking mode.
+        """
+        buffer = bytearray(n_bytes)
+        view = memoryview(buffer)
+        n_received = 0
+        while n_received < n_bytes:
+            try:
+                n_received += self.get_bytes_into(view[n_received:], deadline)
+            except TimeoutError:
+                break
+        return bytes(view[:n_received])
+
+    def get_bytes_into(self, buffer, deadline):
+        """
+        Reads everything that is already buffered by the OS (up to len(buffer)
+        bytes) into buffer or waits for at least one byte until the deadline.
+        """
+        if self._wait_readable is None:
+            n_available = min(self._dev.in_waiting, len(buffer))
+            if not n_available:
+                self._set_timeout(deadline)
+            data = self._dev.read(max(n_available, 1))
+            if len(data) < 1:
+                raise TimeoutError()
+            buffer[0:len(data)] = data
+            return len(data)
+
+        readable = False
+        while True:
+            try:
+                n_received = os.readv(self._fd, [buffer])
+            except BlockingIOError:
+                n_received = 0
+            except OSError:
+                raise fibre.protocol.ChannelBrokenException()
+            if n_received > 0:
+                return n_received
+            if readable:
+                # Like pyserial: readable but no data means disconnected
+                raise fibre.protocol.ChannelBrokenException()
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            readable = self._wait_readable(timeout)
+            if not readable:
+                raise TimeoutError()
 
     def get_bytes_or_fail(self, n_bytes, deadline):
         result = self.get_bytes(n_bytes, deadline)
         if len(result) < n_bytes:
-            raise TimeoutError("expected {} bytes but got only {}", n_bytes, len(result))
+            raise TimeoutError("expected {} bytes but got only {}".format(n_bytes, len(result)))
         return result
 
     def close(self):
@@ -65,10 +149,20 @@ def find_pyserial_ports():
 def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger):
     """
     Scans for serial ports that match the path spec.
+    The path spec is a regular expression for the port name, optionally
+    followed by the baud rate, e.g. "/dev/ttyACM0@921600" or "@921600".
     This function blocks until cancellation_token is set.
     Channels spawned by this function run until channel_termination_token is set.
     """
-    if path == None:
+    baudrate = DEFAULT_BAUDRATE
+    if path != None and '@' in path:
+        path, _, baudrate_str = path.rpartition('@')
+        try:
+            baudrate = int(baudrate_str)
+        except ValueError:
+            raise Exception('"{}" is not a valid baud rate. The format should be something like "/dev/ttyACM0@921600".'
+                            .format(baudrate_str))
+    if path == None or path == "":
         # This regex should match all desired port names on macOS,
         # Linux and Windows but might match some incorrect port names.
         regex = r'^(/dev/tty\.usbmodem.*|/dev/ttyACM.*|COM[0-9]+)$'
@@ -86,16 +180,18 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
         # TODO: yes there is a race condition here in case you wonder.
         known_devices.pop(known_devices.index(port_name))
 
+    watcher = fibre.hotplug.get_backend().watch(('tty',), cancellation_token)
+
     while not cancellation_token.is_set():
         all_ports = find_pyserial_ports() + find_dev_serial_ports()
         new_ports = filter(device_matcher, all_ports)
         for port_name in new_ports:
             try:
-                serial_device = SerialStreamTransport(port_name, DEFAULT_BAUDRATE)
+                serial_device = SerialStreamTransport(port_name, baudrate)
                 input_stream = fibre.protocol.PacketFromStreamConverter(serial_device)
                 output_stream = fibre.protocol.StreamBasedPacketSink(serial_device)
                 channel = fibre.protocol.Channel(
-                        "serial port {}@{}".format(port_name, DEFAULT_BAUDRATE),
+                        "serial port {}@{}".format(port_name, baudrate),
                         input_stream, output_stream, channel_termination_token, logger)
                 channel.serial_device = serial_device
             except serial.serialutil.SerialException:
@@ -103,6 +199,6 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
                 known_devices.append(port_name)
             else:
                 known_devices.append(port_name)
-                channel._channel_broken.subscribe(lambda: did_disconnect(port_name, serial_device))
+                channel._channel_broken.subscribe(lambda port_name=port_name, serial_device=serial_device: did_disconnect(port_name, serial_device))
                 callback(channel)
-        time.sleep(1)
+        watcher.wait()
@@ -0,0 +1,567 @@
+"""
+Serves Fibre endpoints from Python, so that other Fibre nodes can access
+Python objects like a device (e.g. with find_any("tcp:localhost:9910")).
+
+LocalNode implements the device side of the protocol for a table of
+endpoints: endpoint 0 with the interface definition (JSON), the trailer
+check against the interface CRC and the dispatch of endpoint operations.
+PublishedObject is a LocalNode whose interface is generated from a Python
+object tree.
+
+A node is reachable through:
+ - TCPServer or UDPServer
+ - fibre.simulator.attach(), which makes it discoverable as "loopback:"
+ - any Channel that is created with local_node=node, which then answers the
+   requests of its peer
+
+Requests are handled on the thread that receives them, so a handler must not
+wait for a response on the channel that it is serving.
+"""
+
+import collections
+import inspect
+import itertools
+import json
+import socket
+import struct
+import threading
+import traceback
+import types
+import fibre.protocol
+import fibre.remote_object
+import fibre.tcp_transport
+import fibre.utils
+from fibre.utils import Logger
+
+class StoredProperty():
+    """
+    Property endpoint with its own storage, e.g. an argument of a function.
+    Operations behave like Property::exchange() in the firmware: the response
+    holds the old value and the input (if any) becomes the new value. If the
+    input is a new value, hook is called with it.
+    """
+    __slots__ = ('codec', 'can_write', 'hook', '_storage', '_lock')
+
+    def __init__(self, codec, can_write):
+        self.codec = codec
+        self.can_write = can_write
+        self.hook = None
+        self._storage = bytearray(codec.get_length())
+        self._lock = threading.Lock()
+
+    def read(self):
+        self._lock.acquire()
+        try:
+            return self.codec.deserialize(bytes(self._storage))
+        finally:
+            self._lock.release()
+
+    def write(self, value):
+        """
+        Stores a new value without invoking the hook. value can also be the
+        raw bytes (e.g. for endpoint_ref properties).
+        """
+        buffer = value if isinstance(value, (bytes, bytearray)) else self.codec.serialize(value)
+        if len(buffer) != len(self._storage):
+            raise ValueError("expected {} bytes but got {}".format(len(self._storage), len(buffer)))
+        self._lock.acquire()
+        try:
+            self._storage[:] = buffer[:len(self._storage)]
+        finally:
+            self._lock.release()
+
+    def handle(self, input, output_length):
+        size = len(self._storage)
+        self._lock.acquire()
+        try:
+            response = bytes(self._storage[:output_length])
+            written = self.can_write and len(input) >= size
+            if written:
+                self._storage[:] = input[:size]
+        finally:
+            self._lock.release()
+        if written and not self.hook is None:
+            self.hook(self.codec.deserialize(bytes(input[:size])))
+        return response
+
+class BoundProperty():
+    """
+    Property endpoint whose value is fetched with getter() and stored with
+    setter(value) on every operation. setter is None for read-only
+    properties.
+    """
+    __slots__ = ('codec', 'getter', 'setter')
+
+    def __init__(self, codec, getter, setter):
+        self.codec = codec
+        self.getter = getter
+        self.setter = setter
+
+    def read(self):
+        return self.getter()
+
+    def handle(self, input, output_length):
+        # Pure writes don't need the old value
+        response = self.codec.serialize(self.getter())[:output_length] if output_length else b''
+        size = self.codec.get_length()
+        if not self.setter is None and len(input) >= size:
+            self.setter(self.codec.deserialize(bytes(input[:size])))
+        return response
+
+class FunctionEndpoint():
+    """
+    Function endpoint. An operation calls hook with the values of the input
+    properties and stores the result in the output properties. The hook
+    returns None (the outputs keep their values), the value of the only
+    output or a tuple with the values of all outputs.
+    """
+    __slots__ = ('inputs', 'outputs', 'hook')
+
+    def __init__(self, inputs, outputs, hook=None):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.hook = hook
+
+    def handle(self, input, output_length):
+        if self.hook is None:
+            return b''
+        result = self.hook(*[prop.read() for prop in self.inputs])
+        if not result is None:
+            results = result if len(self.outputs) > 1 else (result,)
+            for prop, value in zip(self.outputs, results):
+                prop.write(value)
+        return b''
+
+class LocalNode():
+    """
+    Answers Fibre requests from the specified endpoints (a dict of the form
+    {endpoint_id: endpoint}) and the JSON interface definition.
+    If an endpoint raises an exception, the request is logged and not
+    answered, so that the caller's operation times out or fails instead of
+    decoding a bogus response. Fibre has no way to transport the error itself.
+    Each connection has a session (see create_session()) that remembers the
+    most recent requests, so that a resent request is answered like the
+    original one instead of being executed again. In particular, the resends
+    of a failed request stay unanswered without calling the endpoint again.
+    The counters requests, dropped, failed and duplicates can be read at any
+    time.
+    """
+    # Responses must fit into one packet (including the sequence number)
+    max_response_size = fibre.protocol.MAX_PACKET_SIZE - 3
+
+    # If False, every request is executed, including resends, like the
+    # firmware does
+    dedupe_requests = True
+    # Number of requests per session that are recognized when resent. The
+    # host has at most Channel._window_size requests in flight.
+    _session_size = 128
+
+    def __init__(self, json_bytes, endpoints, logger=Logger(verbose=False)):
+        self.json_bytes = bytes(json_bytes)
+        # Same CRC and version tag as the firmware computes them
+        self.json_crc = fibre.protocol.calc_crc16(fibre.protocol.PROTOCOL_VERSION, self.json_bytes)
+        self.json_version_tag = (self.json_crc << 16) | fibre.protocol.calc_crc16(self.json_crc, self.json_bytes)
+        self._endpoints = endpoints
+        self._logger = logger
+        self._sockets = []
+        self._sockets_lock = threading.Lock()
+        self.requests = 0 # requests handled
+        self.dropped = 0 # requests with a wrong trailer
+        self.failed = 0 # requests whose endpoint raised an exception
+        self.duplicates = 0 # resent requests that were not executed again
+
+    def get_value(self, path):
+        raise KeyError("no property {}".format(path))
+
+    @property
+    def serial_number_str(self):
+        try:
+            return fibre.utils.format_serial_number(self.get_value('serial_number'))
+        except KeyError:
+            return None
+
+    def handle_request(self, endpoint_id, input, output_length):
+        """
+        Executes an operation on the specified endpoint and returns the
+        response (at most output_length bytes)
+        """
+        self.requests += 1
+        if endpoint_id == 0:
+            if len(input) < 4:
+                return b''
+            offset = struct.unpack('<I', input[:4])[0]
+            if offset == 0xffffffff:
+                return struct.pack('<I', self.json_version_tag)[:output_length]
+            return self.json_bytes[offset:offset + output_length]
+
+        endpoint = self._endpoints.get(endpoint_id, None)
+        if endpoint is None:
+            return b'' # unknown endpoint: the firmware sends an empty response
+        return endpoint.handle(input, output_length)
+
+    def create_session(self):
+        """
+        Returns the state that process_request() keeps for one connection
+        (None if requests are not deduplicated). Sequence numbers are chosen
+        by the peer, so a session must not be shared between connections.
+        """
+        return collections.OrderedDict() if self.dedupe_requests else None
+
+    def process_request(self, packet, session=None):
+        """
+        Handles a request packet (without stream framing) and returns the
+        response packet or None if no response is due.
+        session: the session of the connection (see create_session()) or None
+        """
+        packet = bytes(packet)
+        if len(packet) < 8:
+            return None
+        seq_no, endpoint_id, output_length = struct.unpack('<HHH', packet[:6])
+        if seq_no & 0x8000:
+            return None # not a request
+        expect_ack = endpoint_id & 0x8000
+        endpoint_id &= 0x7fff
+
+        # For endpoint 0 the trailer is the protocol version, for all other
+        # endpoints it's the CRC of the interface definition
+        trailer = struct.unpack('<H', packet[-2:])[0]
+        if trailer != (self.json_crc if endpoint_id else fibre.protocol.PROTOCOL_VERSION):
+            self.dropped += 1
+            return None
+
+        if not session is None:
+            # A sequence number that comes with a different request was
+            # reused by the peer and is not a resend
+            previous = session.get(seq_no, None)
+            if not previous is None and previous[0] == packet:
+                self.duplicates += 1
+                return previous[1]
+
+        try:
+            response = self.handle_request(endpoint_id, packet[6:-2], min(output_length, self.max_response_size))
+        except Exception as ex:
+            self.failed += 1
+            self._logger.warn("endpoint {} failed, not responding: {}".format(endpoint_id, ex))
+            self._logger.debug(traceback.format_exc())
+            response = None
+        else:
+            response = struct.pack('<H', seq_no | 0x8000) + response if expect_ack else None
+
+        if not session is None:
+            session.pop(seq_no, None)
+            session[seq_no] = (packet, response)
+            if len(session) > self._session_size:
+                session.popitem(last=False)
+        return response
+
+    def connect(self):
+        """
+        Opens a new in-process connection to this node and returns the other
+        end as a SocketStreamTransport. This node's end is served by a thread
+        until either end is closed.
+        """
+        host_end, device_end = socket.socketpair()
+        self._sockets_lock.acquire()
+        try:
+            self._sockets.append(device_end)
+        finally:
+            self._sockets_lock.release()
+        t = threading.Thread(target=self._serve, args=(device_end,))
+        t.daemon = True
+        t.start()
+        return fibre.tcp_transport.SocketStreamTransport(host_end)
+
+    def disconnect(self):
+        """
+        Closes all connections that were opened with connect(), like
+        unplugging a device.
+        """
+        self._sockets_lock.acquire()
+        try:
+            sockets = self._sockets
+            self._sockets = []
+        finally:
+            self._sockets_lock.release()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _serve(self, sock):
+        node = self
+        session = self.create_session()
+        class Responder(fibre.protocol.PacketSink, fibre.protocol.StreamSink):
+            def __init__(self):
+                self._output = fibre.protocol.StreamBasedPacketSink(self)
+            def process_bytes(self, bytes):
+                sock.sendall(bytes)
+            def process_packet(self, packet):
+                response = node.process_request(packet, session)
+                if not response is None:
+                    self._output.process_packet(response)
+
+        segmenter = fibre.protocol.StreamToPacketSegmenter(Responder())
+        try:
+            while True:
+                data = sock.recv(4096)
+                if not len(data):
+                    break
+                segmenter.process_bytes(data)
+        except OSError:
+            pass
+        except Exception:
+            self._logger.debug("local node closes connection: " + traceback.format_exc())
+        finally:
+            self._sockets_lock.acquire()
+            try:
+                if sock in self._sockets:
+                    self._sockets.remove(sock)
+            finally:
+                self._sockets_lock.release()
+            sock.close()
+
+# Fibre types of unannotated values. Integers get 64 bits because their range
+# is not known in advance.
+_default_types = [(bool, 'bool'), (int, 'int64'), (float, 'float')]
+
+def _get_type_str(annotation, value):
+    """
+    Returns the Fibre type string for a Python type annotation (a type or a
+    Fibre type string such as 'uint32') or, if there is no annotation, for a
+    value. Returns None if the type can't be published.
+    """
+    if isinstance(annotation, str):
+        try:
+            fibre.remote_object.get_codec(annotation)
+        except fibre.remote_object.ObjectDefinitionError:
+            return None
+        return annotation
+    candidates = [annotation] if not annotation is inspect.Parameter.empty else [type(value)]
+    for python_type, type_str in _default_types:
+        if python_type in candidates:
+            return type_str
+    return None
+
+class PublishedObject(LocalNode):
+    """
+    Node that publishes the public attributes of a Python object and of its
+    sub-objects:
+     - bool, int and float attributes become properties. The type comes from
+       the class annotations (a Python type or a Fibre type string such as
+       'uint32'), otherwise from the current value. Python properties
+       without a setter are read-only.
+     - methods become functions. The types of the arguments come from their
+       annotations or default values. A method with a return annotation
+       other than None has one output named "result".
+     - attributes that hold other objects become sub-objects
+    Attributes with an underscore prefix and attributes of other types are
+    not published. The interface is generated once, but values are read and
+    written on each request.
+    Function arguments are stored in the node like on a device, so concurrent
+    calls of the same function from different peers can get mixed up.
+    """
+    def __init__(self, obj, logger=Logger(verbose=False)):
+        self._obj = obj
+        self._paths = {}
+        endpoints = {}
+        ids = itertools.count(1)
+        members = self._describe(obj, '', endpoints, ids, [id(obj)], logger)
+        json_data = [{"name": "", "id": 0, "type": "json", "access": "r"}] + members
+        json_bytes = json.dumps(json_data, separators=(',', ':')).encode('ascii')
+        super(PublishedObject, self).__init__(json_bytes, endpoints, logger)
+
+    def _add_property(self, endpoints, ids, path, name, type_str, endpoint, can_write):
+        endpoint_id = next(ids)
+        endpoints[endpoint_id] = endpoint
+        self._paths[path] = endpoint
+        return {"name": name, "id": endpoint_id, "type": type_str, "access": "rw" if can_write else "r"}
+
+    def _describe(self, obj, prefix, endpoints, ids, parents, logger):
+        annotations = {}
+        for cls in reversed(type(obj).__mro__):
+            annotations.update(getattr(cls, '__annotations__', {}))
+
+        members = []
+        for name in dir(obj):
+            if name.startswith('_'):
+                continue
+            path = prefix + name
+            try:
+                value = getattr(obj, name)
+            except Exception:
+                continue
+
+            if inspect.ismethod(value):
+                member = self._describe_function(value, path, endpoints, ids, logger)
+                if not member is None:
+                    members.append(member)
+
+            elif isinstance(value, (bool, int, float)) or name in annotations:
+                type_str = _get_type_str(annotations.get(name, inspect.Parameter.empty), value)
+                if type_str is None:
+                    logger.debug("not publishing {}: unsupported type".format(path))
+                    continue
+                static = inspect.getattr_static(type(obj), name, None)
+                can_write = not (isinstance(static, property) and static.fset is None)
+                _, codec = fibre.remote_object.get_codec(type_str)
+                endpoint = BoundProperty(codec, lambda obj=obj, name=name: getattr(obj, name),
+                                         (lambda value, obj=obj, name=name: setattr(obj, name, value)) if can_write else None)
+                members.append(self._add_property(endpoints, ids, path, name, type_str, endpoint, can_write))
+
+            elif (hasattr(value, '__dict__') and not callable(value)
+                    and not isinstance(value, types.ModuleType) and not id(value) in parents):
+                members.append({"name": name, "type": "object",
+                                "members": self._describe(value, path + '.', endpoints, ids, parents + [id(value)], logger)})
+
+        return members
+
+    def _describe_function(self, method, path, endpoints, ids, logger):
+        try:
+            signature = inspect.signature(method)
+        except (TypeError, ValueError):
+            return None
+        arg_types = []
+        for param in signature.parameters.values():
+            type_str = None
+            if param.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD):
+                type_str = _get_type_str(param.annotation, param.default)
+            if type_str is None:
+                logger.debug("not publishing {}: argument {} has no supported type".format(path, param.name))
+                return None
+            arg_types.append((param.name, type_str))
+        result_type = None
+        if not signature.return_annotation in (inspect.Signature.empty, None):
+            result_type = _get_type_str(signature.return_annotation, None)
+            if result_type is None:
+                logger.debug("not publishing {}: unsupported return type".format(path))
+                return None
+
+        function_id = next(ids)
+        inputs = []
+        input_endpoints = []
+        for name, type_str in arg_types:
+            endpoint = StoredProperty(fibre.remote_object.get_codec(type_str)[1], True)
+            inputs.append(self._add_property(endpoints, ids, path + '.' + name, name, type_str, endpoint, True))
+            input_endpoints.append(endpoint)
+        outputs = []
+        output_endpoints = []
+        if not result_type is None:
+            endpoint = StoredProperty(fibre.remote_object.get_codec(result_type)[1], False)
+            outputs.append(self._add_property(endpoints, ids, path + '.result', 'result', result_type, endpoint, False))
+            output_endpoints.append(endpoint)
+        endpoints[function_id] = FunctionEndpoint(input_endpoints, output_endpoints, method)
+        return {"name": path.split('.')[-1], "id": function_id, "type": "function", "inputs": inputs, "outputs": outputs}
+
+    def get_value(self, path):
+        endpoint = self._paths.get(path, None)
+        if endpoint is None:
+            raise KeyError("no property {}".format(path))
+        return endpoint.read()
+
+class TCPServer():
+    """
+    Accepts TCP connections on the specified address and port and serves the
+    node on each of them until close() is called. Use port 0 to pick a free
+    port (see self.port).
+    """
+    def __init__(self, node, address='', port=0, logger=Logger(verbose=False)):
+        self._node = node
+        self._logger = logger
+        self._cancellation_token = fibre.utils.Event()
+        self._listener = socket.socket(socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listener.bind((address, port))
+            self._listener.listen(16)
+            # accept() doesn't return when the socket is closed, so poll
+            self._listener.settimeout(0.5)
+        except:
+            self._listener.close()
+            raise
+        self.port = self._listener.getsockname()[1]
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        try:
+            while not self._cancellation_token.is_set():
+                try:
+                    sock, address = self._listener.accept()
+                except socket.timeout:
+                    continue
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                transport = fibre.tcp_transport.SocketStreamTransport(sock)
+                channel = fibre.protocol.Channel("TCP client {}".format(address),
+                        fibre.protocol.PacketFromStreamConverter(transport),
+                        fibre.protocol.StreamBasedPacketSink(transport),
+                        self._cancellation_token, self._logger, local_node=self._node)
+                channel._channel_broken.subscribe(transport.close)
+                self._logger.debug("serving TCP client {}".format(address))
+        except OSError:
+            self._logger.debug("TCP server stopped: " + traceback.format_exc())
+        finally:
+            self._listener.close()
+
+    def close(self):
+        """
+        Stops accepting connections and closes the existing ones.
+        """
+        self._cancellation_token.set()
+
+class UDPServer():
+    """
+    Serves the node to any number of peers on one UDP socket until close() is
+    called. Each datagram holds one request and the response is sent back to
+    its source. Use port 0 to pick a free port (see self.port).
+    Each source address gets its own session (see LocalNode.create_session()).
+    """
+    max_packet_size = 1500 # [bytes]
+    max_sessions = 64 # sessions of the least recently active peers are dropped
+
+    def __init__(self, node, address='', port=0, logger=Logger(verbose=False)):
+        self._node = node
+        self._logger = logger
+        self._closed = False
+        self._sock = socket.socket(socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._sock.bind((address, port))
+            self._sock.settimeout(0.5)
+        except:
+            self._sock.close()
+            raise
+        self.port = self._sock.getsockname()[1]
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        buffer = bytearray(self.max_packet_size)
+        view = memoryview(buffer)
+        sessions = collections.OrderedDict() # by address
+        try:
+            while not self._closed:
+                try:
+                    length, address = self._sock.recvfrom_into(buffer)
+                except (socket.timeout, ConnectionResetError):
+                    continue
+                session = sessions.pop(address, None)
+                if session is None:
+                    session = self._node.create_session()
+                sessions[address] = session
+                if len(sessions) > self.max_sessions:
+                    sessions.popitem(last=False)
+                response = self._node.process_request(view[:length], session)
+                if not response is None:
+                    try:
+                        self._sock.sendto(response, address)
+                    except OSError:
+                        pass # the peer is gone, it will resend if it comes back
+        except OSError:
+            self._logger.debug("UDP server stopped: " + traceback.format_exc())
+        finally:
+            self._sock.close()
+
+    def close(self):
+        self._closed = True
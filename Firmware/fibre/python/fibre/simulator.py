@@ -0,0 +1,207 @@
+"""
+Simulates Fibre devices in-process, based on their interface definition, so
+that the host side can be exercised without hardware.
+
+A SimulatedDevice serves the same endpoints as firmware built from the same
+interface definition:
+ - endpoint 0 returns the JSON version tag (at offset 0xffffffff) and the
+   JSON in chunks of at most max_response_size bytes
+ - every property has storage and behaves like Property::exchange(): the
+   response holds the old value and an input (if any) becomes the new value
+ - functions read their inputs from the input properties, invoke a hook (see
+   set_hook()) and store its result in the output properties
+Requests go through the real stream framing (sync byte, CRC8, CRC16) and
+requests with a wrong trailer (interface CRC) are dropped, like the firmware
+does.
+
+The serving side (endpoint 0, trailer check, connections) is shared with
+all other local nodes (see fibre.server).
+
+Devices that are attached (see attach()) can be found with the path spec
+"loopback:". The path spec "loopback:FILE" creates a device from an interface
+file (see SimulatedDevice.from_file()).
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import fibre.hotplug
+import fibre.protocol
+import fibre.remote_object
+import fibre.server
+from fibre.utils import Logger
+
+_interface_generator = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))),
+                                    'tools', 'interface_generator.py')
+
+def load_interface_file(path, root_interface='ODrive'):
+    """
+    Returns the JSON interface definition (as embedded in the firmware) that
+    corresponds to the specified file.
+    JSON files are returned as they are. YAML files (such as
+    Firmware/odrive-interface.yaml) are converted by the interface generator
+    of the firmware build, which requires jinja2 and jsonschema. The endpoint
+    table is generated for root_interface.
+    """
+    if not path.endswith(('.yaml', '.yml')):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The firmware embeds the JSON as a C string literal. Generating the
+        # same literal and decoding it yields the exact same bytes (and
+        # therefore the same CRC and version tag) as the firmware.
+        template_path = os.path.join(temp_dir, 'json.j2')
+        output_path = os.path.join(temp_dir, 'json.txt')
+        with open(template_path, 'w') as fp:
+            fp.write('[[embedded_endpoint_definitions | to_c_string]]')
+        result = subprocess.run([sys.executable, _interface_generator, '--definitions', path,
+                                 '--generate-endpoints', root_interface,
+                                 '--template', template_path, '--output', output_path],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception("failed to convert {}: {}".format(path, result.stderr.decode(errors='replace')))
+        with open(output_path, 'r') as fp:
+            lines = fp.read().split('\n')
+    return ''.join(line.strip()[1:-1].replace('\\"', '"') for line in lines if line.strip()).encode('ascii')
+
+class SimulatedDevice(fibre.server.LocalNode):
+    """
+    Simulated Fibre device that serves the endpoints of the specified JSON
+    interface definition.
+    values: initial property values by path, e.g. {'serial_number': 0x1234,
+            'axis0.motor.config.pole_pairs': 7}. Properties that are not
+            listed start out as zero.
+    hooks: hooks by path (see set_hook())
+    processing_time: time in seconds that the device takes to handle each
+                     request
+    """
+    # The firmware's TX buffer minus the sequence number
+    max_response_size = 30
+    # The firmware executes resent requests again
+    dedupe_requests = False
+
+    def __init__(self, json_bytes, values=None, hooks=None, processing_time=0.0, logger=Logger(verbose=False)):
+        self.processing_time = processing_time
+        self._paths = {} # by path
+        super(SimulatedDevice, self).__init__(json_bytes, {}, logger)
+
+        self._add_members(json.loads(self.json_bytes.decode('ascii')), '')
+        for path, value in (values or {}).items():
+            self.set_value(path, value)
+        for path, hook in (hooks or {}).items():
+            self.set_hook(path, hook)
+
+    @staticmethod
+    def from_file(path, root_interface='ODrive', **kwargs):
+        """
+        Creates a device from an interface file (see load_interface_file()).
+        The keyword arguments are passed to the constructor.
+        """
+        return SimulatedDevice(load_interface_file(path, root_interface), **kwargs)
+
+    def _add_property(self, json_data, path):
+        _, codec = fibre.remote_object.get_codec(json_data["type"])
+        prop = fibre.server.StoredProperty(codec, 'w' in json_data.get("access", "r"))
+        self._endpoints[int(json_data["id"])] = prop
+        self._paths[path] = prop
+        return prop
+
+    def _add_members(self, members, prefix):
+        for member in members:
+            name = member.get("name", None)
+            type_str = member.get("type", None)
+            if not name:
+                continue # e.g. the entry of endpoint 0
+            path = prefix + name
+            try:
+                if type_str == "object":
+                    self._add_members(member.get("members", []), path + '.')
+                elif type_str == "function":
+                    inputs = [self._add_property(arg, path + '.' + arg["name"])
+                              for arg in member.get("arguments", []) + member.get("inputs", [])]
+                    outputs = [self._add_property(arg, path + '.' + arg["name"])
+                               for arg in member.get("outputs", [])]
+                    function = fibre.server.FunctionEndpoint(inputs, outputs)
+                    self._endpoints[int(member["id"])] = function
+                    self._paths[path] = function
+                else:
+                    self._add_property(member, path)
+            except (KeyError, ValueError, fibre.remote_object.ObjectDefinitionError) as ex:
+                self._logger.debug("simulated device ignores malformed member {}: {}".format(path, ex))
+
+    def _get_property(self, path):
+        prop = self._paths.get(path, None)
+        if not isinstance(prop, fibre.server.StoredProperty):
+            raise KeyError("no property {}".format(path))
+        return prop
+
+    def get_value(self, path):
+        return self._get_property(path).read()
+
+    def set_value(self, path, value):
+        """
+        Sets the value of a property without invoking its hook. value can
+        also be the raw bytes (e.g. for endpoint_ref properties).
+        """
+        self._get_property(path).write(value)
+
+    def set_hook(self, path, hook):
+        """
+        Sets the hook of a function or property.
+        Function hooks are called with the input values and return None
+        (the outputs stay as they are), the value of the only output or a
+        tuple with the values of all outputs.
+        Property hooks are called with the new value after the host wrote the
+        property.
+        Hooks run on the thread that serves the connection.
+        """
+        if not path in self._paths:
+            raise KeyError("no function or property {}".format(path))
+        self._paths[path].hook = hook
+
+    def handle_request(self, endpoint_id, input, output_length):
+        if self.processing_time:
+            time.sleep(self.processing_time)
+        return super(SimulatedDevice, self).handle_request(endpoint_id, input, output_length)
+
+_attached_devices = []
+_attached_devices_lock = threading.Lock()
+
+def attach(device):
+    """
+    Makes the device (a SimulatedDevice or any other fibre.server.LocalNode)
+    discoverable with the path spec "loopback:", like plugging it in.
+    """
+    _attached_devices_lock.acquire()
+    try:
+        if not device in _attached_devices:
+            _attached_devices.append(device)
+    finally:
+        _attached_devices_lock.release()
+    fibre.hotplug.get_backend().post_event(fibre.hotplug.HotplugEvent('add', 'loopback', {}))
+
+def detach(device):
+    """
+    Removes the device from the discoverable devices and closes all of its
+    connections, like unplugging it.
+    """
+    _attached_devices_lock.acquire()
+    try:
+        if device in _attached_devices:
+            _attached_devices.remove(device)
+    finally:
+        _attached_devices_lock.release()
+    device.disconnect()
+    fibre.hotplug.get_backend().post_event(fibre.hotplug.HotplugEvent('remove', 'loopback', {}))
+
+def get_attached_devices():
+    _attached_devices_lock.acquire()
+    try:
+        return list(_attached_devices)
+    finally:
+        _attached_devices_lock.release()
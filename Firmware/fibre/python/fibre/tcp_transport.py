@@ -1,5 +1,6 @@
 
 import sys
+import select
 import socket
 import time
 import traceback
@@ -9,21 +10,53 @@ from fibre.utils import wait_any, TimeoutError
 def noprint(x):
   pass
 
-class TCPTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
-  def __init__(self, dest_addr, dest_port, logger):
-    # TODO: FIXME: use IPv6
-    # Problem: getaddrinfo fails if the resolver returns an
-    # IPv4 address, but we are using AF_INET6
-    #family = socket.AF_INET6 if socket.has_ipv6 else socket.AF_INET
-    family = socket.AF_INET
-    self.sock = socket.socket(family, socket.SOCK_STREAM)
-    # TODO: Determine the right address to use from the list
-    self.target = socket.getaddrinfo(dest_addr, dest_port, family)[0][4]
-    # TODO: this blocks until a connection is established, or the system cancels it
-    self.sock.connect(self.target)
+class SocketStreamTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
+  """
+  Stream transport over a connected stream socket, e.g. a TCP connection or
+  one end of a socket.socketpair().
+  The socket is non-blocking: reads take whatever the kernel has buffered
+  and only wait (with select) if there is nothing.
+  """
+  def __init__(self, sock):
+    self.sock = sock
+    self.sock.setblocking(False)
+    if hasattr(select, 'poll'):
+      self._readable_poller = select.poll()
+      self._readable_poller.register(self.sock, select.POLLIN)
+      self._writable_poller = select.poll()
+      self._writable_poller.register(self.sock, select.POLLOUT)
+    else:
+      self._readable_poller = self._writable_poller = None # e.g. Windows
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def _wait(self, readable, deadline):
+    """
+    Waits until the socket is readable (or writable) or the deadline is
+    reached. Returns False if the deadline was reached.
+    """
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    poller = self._readable_poller if readable else self._writable_poller
+    if not poller is None:
+      # unlike select(), poll() also works with file descriptors >= 1024
+      return len(poller.poll(None if timeout is None else timeout * 1000)) > 0
+    elif readable:
+      return len(select.select([self.sock], [], [], timeout)[0]) > 0
+    else:
+      return len(select.select([], [self.sock], [], timeout)[1]) > 0
 
   def process_bytes(self, buffer):
-    self.sock.send(buffer)
+    # Equivalent of sendall() for a non-blocking socket
+    view = memoryview(buffer)
+    try:
+      while len(view):
+        try:
+          view = view[self.sock.send(view):]
+        except BlockingIOError:
+          self._wait(False, None)
+    except OSError:
+      raise fibre.protocol.ChannelBrokenException()
 
   def get_bytes(self, n_bytes, deadline):
     """
@@ -32,19 +65,33 @@ class TCPTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
     function blocks forever. A deadline before the current time corresponds
     to non-blocking mode.
     """
-    # convert deadline to seconds (floating point)
-    deadline = None if deadline is None else max(deadline - time.monotonic(), 0)
-    self.sock.settimeout(deadline)
-    try:
-      data = self.sock.recv(n_bytes, socket.MSG_WAITALL) # receive n_bytes
-      return data
-    except socket.timeout:
-      # if we got a timeout data will still be none, so we call recv again
-      # this time in non blocking state and see if we can get some data
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    n_received = 0
+    while n_received < n_bytes:
+      try:
+        n_received += self.get_bytes_into(view[n_received:], deadline)
+      except TimeoutError:
+        break
+    return bytes(view[:n_received])
+
+  def get_bytes_into(self, buffer, deadline):
+    """
+    Receives everything that is available (up to len(buffer) bytes) into
+    buffer and returns the number of bytes received.
+    """
+    while True:
       try:
-        return self.sock.recv(n_bytes, socket.MSG_DONTWAIT)
-      except socket.timeout:
-        raise TimeoutError
+        n_received = self.sock.recv_into(buffer)
+      except BlockingIOError:
+        if not self._wait(True, deadline):
+          raise TimeoutError
+        continue
+      except OSError:
+        raise fibre.protocol.ChannelBrokenException()
+      if n_received == 0:
+        raise fibre.protocol.ChannelBrokenException() # connection closed by peer
+      return n_received
 
   def get_bytes_or_fail(self, n_bytes, deadline):
     result = self.get_bytes(n_bytes, deadline)
@@ -52,6 +99,23 @@ class TCPTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
       raise TimeoutError("expected {} bytes but got only {}".format(n_bytes, len(result)))
     return result
 
+  def close(self):
+    self.sock.close()
+
+class TCPTransport(SocketStreamTransport):
+  """
+  Stream transport over a TCP connection. TCP_NODELAY is set because each
+  packet is written with a single call and should go out right away.
+  """
+  connect_timeout = 5.0 # [s]
+
+  def __init__(self, dest_addr, dest_port, logger):
+    # Tries all addresses that the name resolves to (IPv6 and IPv4)
+    sock = socket.create_connection((dest_addr, dest_port), self.connect_timeout)
+    self.target = sock.getpeername()
+    logger.debug("TCP connection established to {}".format(self.target))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    super(TCPTransport, self).__init__(sock)
 
 
 def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger):
@@ -64,8 +128,10 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
     dest_addr = ':'.join(path.split(":")[:-1])
     dest_port = int(path.split(":")[-1])
   except (ValueError, IndexError):
-    raise Exception('"{}" is not a valid TCP destination. The format should be something like "localhost:1234".'
+    raise Exception('"{}" is not a valid TCP destination. The format should be something like "localhost:1234" or "[::1]:1234".'
                     .format(path))
+  if dest_addr.startswith('[') and dest_addr.endswith(']'):
+    dest_addr = dest_addr[1:-1] # IPv6 address
 
   while not cancellation_token.is_set():
     try:
@@ -80,6 +146,7 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
       #logger.debug("TCP channel init failed. More info: " + traceback.format_exc())
       pass
     else:
+      channel._channel_broken.subscribe(tcp_transport.close)
       callback(channel)
       wait_any(None, cancellation_token, channel._channel_broken)
     time.sleep(1)
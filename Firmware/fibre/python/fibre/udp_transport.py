@@ -1,32 +1,106 @@
 
 import sys
+import collections
+import select
 import socket
 import time
 import traceback
 import fibre.protocol
-from fibre.utils import wait_any
+from fibre.utils import wait_any, TimeoutError
 
 def noprint(x):
   pass
 
 class UDPTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
+  """
+  Packet transport over UDP. Each datagram holds one packet.
+  The socket is connected to the destination, so datagrams from other
+  sources are dropped by the kernel. It is non-blocking: get_packet() reads
+  all datagrams that are queued in the kernel at once (into a fixed set of
+  reusable buffers) and only waits (up to the deadline) if there are none.
+  """
+  max_packet_size = 1500 # [bytes] larger datagrams are truncated
+  n_buffers = 16 # max number of datagrams that are read in one go
+
   def __init__(self, dest_addr, dest_port, logger):
-    # TODO: FIXME: use IPv6
-    # Problem: getaddrinfo fails if the resolver returns an
-    # IPv4 address, but we are using AF_INET6
-    #family = socket.AF_INET6 if socket.has_ipv6 else socket.AF_INET
-    family = socket.AF_INET
-    self.sock = socket.socket(family, socket.SOCK_DGRAM)
-    # TODO: Determine the right address to use from the list
-    self.target = socket.getaddrinfo(dest_addr,dest_port, family)[0][4]
+    # Try all addresses that the name resolves to (IPv6 and IPv4)
+    self.sock = None
+    error = None
+    for family, socktype, proto, _, address in socket.getaddrinfo(dest_addr, dest_port, socket.AF_UNSPEC, socket.SOCK_DGRAM):
+      sock = socket.socket(family, socktype, proto)
+      try:
+        sock.connect(address)
+      except OSError as ex:
+        sock.close()
+        error = ex
+        continue
+      self.sock = sock
+      self.target = address
+      break
+    if self.sock is None:
+      raise error or OSError("no address found for {}".format(dest_addr))
+    self.sock.setblocking(False)
+    if hasattr(select, 'poll'):
+      self._poller = select.poll()
+      self._poller.register(self.sock, select.POLLIN)
+    else:
+      self._poller = None # e.g. Windows
+
+    self._buffers = [bytearray(self.max_packet_size) for _ in range(self.n_buffers)]
+    self._received = collections.deque() # datagrams that were read but not returned yet
+
+  def fileno(self):
+    return self.sock.fileno()
 
   def process_packet(self, buffer):
-    self.sock.sendto(buffer, self.target)
+    try:
+      self.sock.send(buffer)
+    except ConnectionRefusedError:
+      pass # ICMP port unreachable from a previous datagram, the peer may come back
+    except BlockingIOError:
+      pass # socket buffer full, the packet is lost like on the wire
+    except OSError:
+      raise fibre.protocol.ChannelBrokenException()
+
+  def _wait(self, deadline):
+    """
+    Waits until a datagram is available or the deadline is reached. Returns
+    False if the deadline was reached.
+    """
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    if not self._poller is None:
+      return len(self._poller.poll(None if timeout is None else timeout * 1000)) > 0
+    else:
+      return len(select.select([self.sock], [], [], timeout)[0]) > 0
+
+  def _drain(self):
+    """
+    Reads all queued datagrams into the receive buffers.
+    """
+    for buffer in self._buffers:
+      try:
+        length = self.sock.recv_into(buffer)
+      except (BlockingIOError, ConnectionRefusedError):
+        break
+      except OSError:
+        raise fibre.protocol.ChannelBrokenException()
+      self._received.append(memoryview(buffer)[:length])
 
   def get_packet(self, deadline):
-    # TODO: implement deadline
-    data, _ = self.sock.recvfrom(1024)
-    return data
+    """
+    Returns the next packet or raises a TimeoutError if no packet arrives
+    before the deadline. If deadline is None the function blocks forever. A
+    deadline before the current time corresponds to non-blocking mode.
+    The returned packet is only valid until the next call to get_packet().
+    """
+    while not len(self._received):
+      self._drain()
+      if not len(self._received) and not self._wait(deadline):
+        raise TimeoutError()
+    return self._received.popleft()
+
+  def close(self):
+    self.sock.close()
 
 def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger):
   """
@@ -38,8 +112,10 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
     dest_addr = ':'.join(path.split(":")[:-1])
     dest_port = int(path.split(":")[-1])
   except (ValueError, IndexError):
-    raise Exception('"{}" is not a valid UDP destination. The format should be something like "localhost:1234".'
+    raise Exception('"{}" is not a valid UDP destination. The format should be something like "localhost:1234" or "[::1]:1234".'
                     .format(path))
+  if dest_addr.startswith('[') and dest_addr.endswith(']'):
+    dest_addr = dest_addr[1:-1] # IPv6 address
 
   while not cancellation_token.is_set():
     try:
@@ -52,6 +128,7 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
       logger.debug("UDP channel init failed. More info: " + traceback.format_exc())
       pass
     else:
+      channel._channel_broken.subscribe(udp_transport.close)
       callback(channel)
       wait_any(None, cancellation_token, channel._channel_broken)
     time.sleep(1)
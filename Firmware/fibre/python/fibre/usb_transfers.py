@@ -0,0 +1,437 @@
+"""
+Keeps several USB IN transfers queued on an endpoint, so that the device can
+send its next packet while the host is still processing the previous one.
+
+With synchronous reads, a transfer is only pending while a read() call is
+blocked in the host, so every packet additionally pays the time it takes to
+submit a transfer and for the host controller to schedule it. The
+InTransferQueue submits a fixed number of transfers up front, hands out the
+completed ones as packets and resubmits their buffers once they are consumed,
+so no memory is allocated per packet.
+
+The transfers are handled by a pluggable backend: LibusbBackend uses the
+asynchronous transfer API of libusb through pyusb's libusb1 backend,
+FakeBackend emulates an endpoint for tests and benchmarks.
+"""
+
+import collections
+import ctypes
+import threading
+import time
+import fibre.protocol
+from fibre.utils import TimeoutError
+
+# Transfer status codes (same values as enum libusb_transfer_status)
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_TIMED_OUT = 2
+TRANSFER_CANCELLED = 3
+TRANSFER_STALL = 4
+TRANSFER_NO_DEVICE = 5
+TRANSFER_OVERFLOW = 6
+
+class Transfer():
+    """
+    A transfer buffer that can be submitted to its backend any number of
+    times. callback(transfer, status, length) is invoked from within
+    backend.handle_events() when the transfer completes, fails or is
+    cancelled.
+    """
+    __slots__ = ('buffer', 'callback', 'handle')
+
+    def __init__(self, buffer, callback, handle=None):
+        self.buffer = buffer
+        self.callback = callback
+        self.handle = handle # backend specific
+
+class TransferBackend():
+    """
+    Interface of the transfer backends. Apart from handle_events(), all
+    functions return without waiting for the device.
+    """
+    def create_transfer(self, size, callback):
+        raise NotImplementedError()
+
+    def submit(self, transfer):
+        """
+        Queues the transfer on the endpoint. Raises ChannelBrokenException if
+        the device is gone and ChannelDamagedException on other errors.
+        """
+        raise NotImplementedError()
+
+    def cancel(self, transfer):
+        """
+        Requests the cancellation of a submitted transfer. Its callback is
+        still invoked (with TRANSFER_CANCELLED unless it completed in the
+        meantime).
+        """
+        raise NotImplementedError()
+
+    def free(self, transfer):
+        """
+        Releases a transfer that is not submitted.
+        """
+        pass
+
+    def handle_events(self, timeout):
+        """
+        Invokes the callbacks of the transfers that finished. Blocks for at
+        most timeout seconds (None: forever) if none did.
+        """
+        raise NotImplementedError()
+
+    def clear_halt(self):
+        """
+        Clears a stall condition on the endpoint.
+        """
+        pass
+
+class InTransferQueue(fibre.protocol.PacketSource):
+    """
+    Packet source that keeps up to depth transfers of packet_size bytes
+    queued on an IN endpoint. The transfers must only be consumed by one
+    thread at a time (usually the receiver thread of the channel).
+    """
+    # Time to wait for cancelled transfers in close()
+    close_timeout = 1.0
+
+    def __init__(self, backend, packet_size, depth=4):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._completed = collections.deque() # (transfer, status, length)
+        self._in_flight = set()
+        self._closed = False
+        self._lent = None # transfer whose buffer was returned by the last get_packet()
+        self._transfers = [backend.create_transfer(packet_size, self._did_finish) for _ in range(max(depth, 1))]
+        self._idle = list(self._transfers)
+        self.packets = 0
+        self._submit_idle()
+
+    def _did_finish(self, transfer, status, length):
+        self._lock.acquire()
+        try:
+            self._in_flight.discard(transfer)
+            if self._closed:
+                self._idle.append(transfer)
+            else:
+                self._completed.append((transfer, status, length))
+        finally:
+            self._lock.release()
+
+    def _submit_idle(self):
+        while len(self._idle):
+            transfer = self._idle[-1]
+            self._lock.acquire()
+            try:
+                if self._closed:
+                    return
+                self._in_flight.add(transfer)
+            finally:
+                self._lock.release()
+            try:
+                self._backend.submit(transfer)
+            except:
+                self._lock.acquire()
+                try:
+                    self._in_flight.discard(transfer)
+                finally:
+                    self._lock.release()
+                raise
+            self._idle.pop()
+
+    def get_packet(self, deadline):
+        """
+        Returns the next packet that the device sent.
+        The returned packet is only valid until the next call to get_packet().
+        """
+        if self._closed:
+            raise fibre.protocol.ChannelDamagedException()
+
+        # Recycle the buffer of the previous packet
+        if not self._lent is None:
+            self._idle.append(self._lent)
+            self._lent = None
+        self._submit_idle()
+
+        while not len(self._completed):
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if not timeout is None and timeout <= 0:
+                # Deadline is over (or was in the past to begin with), but
+                # give the backend one chance to report finished transfers
+                self._backend.handle_events(0)
+                if not len(self._completed):
+                    raise TimeoutError()
+                break
+            self._backend.handle_events(timeout)
+            if self._closed:
+                raise fibre.protocol.ChannelDamagedException()
+
+        transfer, status, length = self._completed.popleft()
+        if status == TRANSFER_COMPLETED:
+            self._lent = transfer
+            self.packets += 1
+            return memoryview(transfer.buffer)[:length]
+
+        self._idle.append(transfer)
+        if status == TRANSFER_NO_DEVICE:
+            raise fibre.protocol.ChannelBrokenException()
+        if status == TRANSFER_STALL:
+            self._backend.clear_halt()
+        raise fibre.protocol.ChannelDamagedException()
+
+    def close(self):
+        """
+        Cancels all queued transfers and releases their buffers.
+        Transfers that are still in flight after close_timeout are leaked
+        rather than released, because the backend may still write to them.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            for transfer, _, _ in self._completed:
+                self._idle.append(transfer)
+            self._completed.clear()
+            in_flight = list(self._in_flight)
+        finally:
+            self._lock.release()
+        for transfer in in_flight:
+            try:
+                self._backend.cancel(transfer)
+            except Exception:
+                pass
+
+        deadline = time.monotonic() + self.close_timeout
+        while len(self._in_flight) and time.monotonic() < deadline:
+            try:
+                self._backend.handle_events(0.01)
+            except Exception:
+                break
+
+        if not self._lent is None:
+            self._idle.append(self._lent)
+            self._lent = None
+        for transfer in self._idle:
+            if not transfer in self._in_flight:
+                self._backend.free(transfer)
+        self._idle = []
+
+class FakeBackend(TransferBackend):
+    """
+    Emulates an IN endpoint for tests and benchmarks.
+    The device side queues packets with send(). A packet is delivered to the
+    oldest submitted transfer once that transfer has been pending for
+    submit_latency seconds, which models the time it takes the host to submit
+    a transfer and the host controller to schedule it.
+    Tests can also finish any submitted transfer directly with complete(),
+    e.g. to emulate completions that arrive out of order.
+    The number of buffers that were ever allocated, freed and submitted are
+    counted in allocations, frees and submissions.
+    """
+    def __init__(self, submit_latency=0.0):
+        self._submit_latency = submit_latency
+        self._cond = threading.Condition()
+        self._fifo = collections.deque() # packets sent by the device
+        self._pending = collections.deque() # (transfer, time when it becomes active)
+        self._finished = [] # (transfer, status, length)
+        self._disconnected = False
+        self.allocations = 0
+        self.frees = 0
+        self.submissions = 0
+
+    def create_transfer(self, size, callback):
+        self.allocations += 1
+        return Transfer(bytearray(size), callback)
+
+    def free(self, transfer):
+        self.frees += 1
+
+    def submit(self, transfer):
+        self._cond.acquire()
+        try:
+            if self._disconnected:
+                raise fibre.protocol.ChannelBrokenException()
+            self.submissions += 1
+            self._pending.append((transfer, time.monotonic() + self._submit_latency))
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def cancel(self, transfer):
+        self._cond.acquire()
+        try:
+            for item in self._pending:
+                if item[0] is transfer:
+                    self._pending.remove(item)
+                    self._finished.append((transfer, TRANSFER_CANCELLED, 0))
+                    self._cond.notify_all()
+                    break
+        finally:
+            self._cond.release()
+
+    def get_pending_transfers(self):
+        """
+        Returns the submitted transfers that haven't finished yet, oldest
+        first.
+        """
+        self._cond.acquire()
+        try:
+            return [transfer for transfer, _ in self._pending]
+        finally:
+            self._cond.release()
+
+    def complete(self, transfer, status=TRANSFER_COMPLETED, data=b''):
+        """
+        Finishes the specified submitted transfer with the specified status
+        and data, regardless of its position in the queue.
+        """
+        self._cond.acquire()
+        try:
+            for item in self._pending:
+                if item[0] is transfer:
+                    self._pending.remove(item)
+                    break
+            else:
+                raise ValueError("transfer is not pending")
+            length = min(len(data), len(transfer.buffer))
+            transfer.buffer[:length] = data[:length]
+            self._finished.append((transfer, status, length))
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def send(self, packet):
+        """
+        Called by the emulated device to send a packet to the host.
+        """
+        self._cond.acquire()
+        try:
+            self._fifo.append(bytes(packet))
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def disconnect(self):
+        """
+        Fails all pending and future transfers with TRANSFER_NO_DEVICE.
+        """
+        self._cond.acquire()
+        try:
+            self._disconnected = True
+            while len(self._pending):
+                self._finished.append((self._pending.popleft()[0], TRANSFER_NO_DEVICE, 0))
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def handle_events(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._cond.acquire()
+        try:
+            while True:
+                now = time.monotonic()
+                while len(self._fifo) and len(self._pending) and self._pending[0][1] <= now:
+                    transfer, _ = self._pending.popleft()
+                    packet = self._fifo.popleft()
+                    length = min(len(packet), len(transfer.buffer))
+                    transfer.buffer[:length] = packet[:length]
+                    status = TRANSFER_COMPLETED if length == len(packet) else TRANSFER_OVERFLOW
+                    self._finished.append((transfer, status, length))
+                if len(self._finished):
+                    break
+                wait_time = None if deadline is None else deadline - now
+                if len(self._fifo) and len(self._pending):
+                    activation_time = self._pending[0][1] - now
+                    wait_time = activation_time if wait_time is None else min(wait_time, activation_time)
+                if not wait_time is None and wait_time <= 0:
+                    break
+                self._cond.wait(wait_time)
+            finished = self._finished
+            self._finished = []
+        finally:
+            self._cond.release()
+
+        for transfer, status, length in finished:
+            transfer.callback(transfer, status, length)
+
+class LibusbBackend(TransferBackend):
+    """
+    Submits bulk IN transfers to the specified endpoint of a pyusb device with
+    the asynchronous libusb API. This requires pyusb's libusb1 backend,
+    otherwise NotImplementedError is raised.
+    """
+    _LIBUSB_TRANSFER_TYPE_BULK = 2
+    _LIBUSB_ERROR_NO_DEVICE = -4
+    _LIBUSB_ERROR_INTERRUPTED = -10
+
+    class _Timeval(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+    def __init__(self, dev, endpoint):
+        import usb.backend.libusb1 as libusb1
+        backend = dev._ctx.backend
+        if not isinstance(backend, libusb1._LibUSB):
+            raise NotImplementedError("queued transfers require the libusb1 backend of pyusb")
+        self._libusb1 = libusb1
+        self._lib = backend.lib
+        self._ctx = backend.ctx
+        self._dev = dev
+        self._endpoint = endpoint
+        self._handle = dev._ctx.managed_open().handle
+        self._transfers = {} # transfers by address of the libusb transfer
+
+        transfer_p = ctypes.POINTER(libusb1._libusb_transfer)
+        self._lib.libusb_cancel_transfer.argtypes = [transfer_p]
+        self._lib.libusb_handle_events_timeout.argtypes = [ctypes.c_void_p, ctypes.POINTER(LibusbBackend._Timeval)]
+        # Must stay referenced for as long as transfers can complete
+        self._callback = libusb1._libusb_transfer_cb_fn_p(self._did_finish)
+
+    def create_transfer(self, size, callback):
+        buffer = (ctypes.c_ubyte * size)()
+        handle = self._lib.libusb_alloc_transfer(0)
+        if not handle:
+            raise MemoryError()
+        t = handle.contents
+        t.dev_handle = self._handle
+        t.endpoint = self._endpoint.bEndpointAddress
+        t.type = self._LIBUSB_TRANSFER_TYPE_BULK
+        t.timeout = 0 # stay queued until the device sends something
+        t.length = size
+        t.callback = self._callback
+        t.buffer = ctypes.addressof(buffer)
+        transfer = Transfer(buffer, callback, handle)
+        self._transfers[ctypes.addressof(t)] = transfer
+        return transfer
+
+    def _did_finish(self, handle):
+        t = handle.contents
+        transfer = self._transfers.get(ctypes.addressof(t), None)
+        if not transfer is None:
+            transfer.callback(transfer, t.status, t.actual_length)
+
+    def submit(self, transfer):
+        result = self._lib.libusb_submit_transfer(transfer.handle)
+        if result == self._LIBUSB_ERROR_NO_DEVICE:
+            raise fibre.protocol.ChannelBrokenException()
+        elif result != 0:
+            raise fibre.protocol.ChannelDamagedException()
+
+    def cancel(self, transfer):
+        self._lib.libusb_cancel_transfer(transfer.handle)
+
+    def free(self, transfer):
+        self._transfers.pop(ctypes.addressof(transfer.handle.contents), None)
+        self._lib.libusb_free_transfer(transfer.handle)
+        transfer.handle = None
+
+    def handle_events(self, timeout):
+        if timeout is None:
+            timeout = 1.0 # returns to the caller, which simply calls again
+        tv = LibusbBackend._Timeval(int(timeout), int((timeout % 1) * 1e6))
+        result = self._lib.libusb_handle_events_timeout(self._ctx, ctypes.byref(tv))
+        if result == self._LIBUSB_ERROR_NO_DEVICE:
+            raise fibre.protocol.ChannelBrokenException()
+        elif result != 0 and result != self._LIBUSB_ERROR_INTERRUPTED:
+            raise fibre.protocol.ChannelDamagedException()
+
+    def clear_halt(self):
+        self._dev.clear_halt(self._endpoint)
@@ -6,6 +6,8 @@ import usb.util
 import sys
 import time
 import fibre.protocol
+import fibre.hotplug
+import fibre.usb_transfers
 import traceback
 import platform
 from fibre.utils import TimeoutError
@@ -19,10 +21,17 @@ WELL_KNOWN_VID_PID_PAIRS = [
 ]
 
 class USBBulkTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
+  # Number of IN transfers that are kept queued on the device (see
+  # fibre.usb_transfers). 0 means that packets are read with one synchronous
+  # read at a time. Queued transfers require pyusb's libusb1 backend,
+  # otherwise the transport falls back to synchronous reads.
+  in_transfer_depth = 0
+
   def __init__(self, dev, logger):
     self._logger = logger
     self.dev = dev
     self.intf = None
+    self._in_queue = None
     self._name = "USB device {}:{}".format(dev.idVendor, dev.idProduct)
     self._was_damaged = False
 
@@ -89,7 +98,17 @@ class USBBulkTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
     assert self.epr is not None
     self._logger.debug("EndpointAddress for reading {}".format(self.epr.bEndpointAddress))
 
+    if self.in_transfer_depth > 0:
+      try:
+        backend = fibre.usb_transfers.LibusbBackend(self.dev, self.epr)
+        self._in_queue = fibre.usb_transfers.InTransferQueue(backend, self.epr.wMaxPacketSize, self.in_transfer_depth)
+      except (NotImplementedError, AttributeError, OSError) as ex:
+        self._logger.debug("Queued IN transfers not available, using synchronous reads: {}".format(ex))
+
   def deinit(self):
+    if not self._in_queue is None:
+      self._in_queue.close()
+      self._in_queue = None
     if not self.intf is None:
       usb.util.release_interface(self.dev, self.intf)
 
@@ -121,6 +140,13 @@ class USBBulkTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
         raise fibre.protocol.ChannelDamagedException()
 
   def get_packet(self, deadline):
+    in_queue = self._in_queue
+    if not in_queue is None:
+      packet = in_queue.get_packet(deadline)
+      if self._was_damaged:
+        self._logger.debug("Recovered from USB halt/stall condition")
+        self._was_damaged = False
+      return packet
     try:
       bufferLen = self.epr.wMaxPacketSize
       timeout = max(int((deadline - time.monotonic()) * 1000), 0)
@@ -169,25 +195,44 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
                       "and DEVICE are integers.".format(path))
   
   known_devices = []
+  # Serial numbers by (bus, address). Reading the serial number requires a
+  # string descriptor request, so it's only done once per device.
+  serial_numbers = {}
+  present_devices = set()
   def device_matcher(device):
     #print("  test {:04X}:{:04X}".format(device.idVendor, device.idProduct))
     try:
-      if (device.bus, device.address) in known_devices:
+      key = (device.bus, device.address)
+      present_devices.add(key)
+      if key in known_devices:
         return False
       if bus != None and device.bus != bus:
         return False
       if address != None and device.address != address:
         return False
-      if serial_number != None and device.serial_number != serial_number:
-        return False
+      # The device descriptor is cached by libusb, so check it first
       if (device.idVendor, device.idProduct) not in WELL_KNOWN_VID_PID_PAIRS:
         return False
+      if serial_number != None:
+        if not key in serial_numbers:
+          serial_numbers[key] = device.serial_number
+        if serial_numbers[key] != serial_number:
+          return False
     except:
       return False
     return True
 
+  def forget_device(key):
+    serial_numbers.pop(key, None)
+    if key in known_devices:
+      known_devices.remove(key)
+
+  watcher = fibre.hotplug.get_backend().watch(('usb',), cancellation_token)
+  retry = False
+
   while not cancellation_token.is_set():
     # logger.debug("USB discover loop")
+    present_devices.clear()
     devices = usb.core.find(find_all=True, custom_match=device_matcher)
     for usb_device in devices:
       try:
@@ -198,6 +243,10 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
                 "USB device bus {} device {}".format(usb_device.bus, usb_device.address),
                 bulk_device, bulk_device, channel_termination_token, logger)
         channel.usb_device = usb_device # for debugging only
+        try:
+          channel.serial_number_str = usb_device.serial_number
+        except (usb.core.USBError, ValueError):
+          pass
       except usb.core.USBError as ex:
         if ex.errno == 13:
           # TODO: this is an ODrive specific message and should live outside of the fibre library
@@ -206,6 +255,7 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
         elif ex.errno == 16:
           logger.debug("USB device busy. I'll reset it and try again.")
           usb_device.reset()
+          retry = True
           continue
         else:
           logger.warn("USB device init failed (bus {}, device {}). Ignoring this device. More info: ".format(usb_device.bus, usb_device.address) + traceback.format_exc())
@@ -213,4 +263,16 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
       else:
         known_devices.append((usb_device.bus, usb_device.address))
         callback(channel)
-    time.sleep(1)
+
+    # Forget devices that disappeared, their address may be reused
+    for key in list(serial_numbers.keys()) + known_devices:
+      if not key in present_devices:
+        forget_device(key)
+
+    for event in watcher.wait(1.0 if retry else None):
+      if event.action == 'remove' and 'BUSNUM' in event.properties and 'DEVNUM' in event.properties:
+        try:
+          forget_device((int(event.properties['BUSNUM']), int(event.properties['DEVNUM'])))
+        except ValueError:
+          pass
+    retry = False
@@ -23,9 +23,12 @@ if sys.version_info < (3, 3):
 else:
     TimeoutError = TimeoutError
 
+def format_serial_number(serial_number):
+    return format(serial_number, 'x').upper()
+
 def get_serial_number_str(device):
     if hasattr(device, 'serial_number'):
-        return format(device.serial_number, 'x').upper()
+        return format_serial_number(device.serial_number)
     else:
         return "[unknown serial number]"
 
@@ -123,6 +126,88 @@ def wait_any(timeout=None, *events):
     raise TimeoutError()
 
 
+## Statistics utils ##
+
+class LatencyHistogram():
+    """
+    HDR-style histogram for latencies with microsecond resolution.
+    Each power-of-two range is split into 2**sub_bucket_bits linear
+    sub-buckets, so every recorded value is off by at most 1/2**sub_bucket_bits
+    (12.5% by default) while the memory stays small for any value range.
+    Recording a value is O(1) and doesn't allocate.
+    """
+    def __init__(self, sub_bucket_bits=3):
+        self._sub_bucket_bits = sub_bucket_bits
+        self._sub_bucket_count = 1 << sub_bucket_bits
+        self._counts = []
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _get_index(self, value_us):
+        if value_us < 2 * self._sub_bucket_count:
+            return value_us
+        shift = value_us.bit_length() - self._sub_bucket_bits - 1
+        return (shift + 1) * self._sub_bucket_count + (value_us >> shift) - self._sub_bucket_count
+
+    def _get_upper_bound(self, index):
+        """Returns the largest value (in microseconds) that falls into the specified bucket"""
+        if index < 2 * self._sub_bucket_count:
+            return index
+        shift = index // self._sub_bucket_count - 1
+        mantissa = index % self._sub_bucket_count + self._sub_bucket_count
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        """
+        Records a latency given in seconds
+        """
+        index = self._get_index(max(int(value * 1e6), 0))
+        if index >= len(self._counts):
+            self._counts.extend([0] * (index + 1 - len(self._counts)))
+        self._counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_percentile(self, percentile):
+        """
+        Returns the value (in seconds) below which the specified percentage of
+        the recorded values lie, or None if nothing was recorded.
+        """
+        if self.count == 0:
+            return None
+        threshold = self.count * percentile / 100.0
+        accumulated = 0
+        for index, count in enumerate(self._counts):
+            accumulated += count
+            if accumulated >= threshold and count:
+                return min(self._get_upper_bound(index) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        """
+        Returns a snapshot of the histogram as a plain dict.
+        The "buckets" entry is a list of (upper bound in seconds, count) tuples
+        of all non-empty buckets.
+        """
+        counts = list(self._counts)
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.get_percentile(50),
+            'p90': self.get_percentile(90),
+            'p99': self.get_percentile(99),
+            'buckets': [(self._get_upper_bound(i) / 1e6, c) for i, c in enumerate(counts) if c]
+        }
+
+
 ## Log utils ##
 
 class Logger():
@@ -0,0 +1,331 @@
+"""
+Tests for fibre.protocol.Channel.
+"""
+
+import asyncio
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import unittest
+import fibre.protocol
+import fibre.server
+import fibre.tcp_transport
+from fibre.utils import Event, Logger, TimeoutError
+
+class FakeDevice(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
+    """
+    Packet level stand-in for a device. The requests that the channel sends
+    are collected in a queue and answered when the test says so.
+    """
+    def __init__(self):
+        self.requests = queue.Queue()
+        self._responses = queue.Queue()
+
+    def process_packet(self, packet):
+        self.requests.put(bytes(packet))
+
+    def get_packet(self, deadline):
+        try:
+            return self._responses.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            raise TimeoutError()
+
+    def get_request(self):
+        return self.requests.get(timeout=1.0)
+
+    def respond(self, request, payload):
+        seq_no = struct.unpack('<H', request[0:2])[0]
+        self._responses.put(struct.pack('<H', seq_no | 0x8000) + payload)
+
+def open_channel(device, cancellation_token, channel_class=fibre.protocol.Channel):
+    return channel_class("test channel", device, device, cancellation_token, Logger(verbose=False))
+
+def open_stream_channel(transport, cancellation_token, node=None):
+    channel = fibre.protocol.Channel("test channel", fibre.protocol.PacketFromStreamConverter(transport),
+                                     fibre.protocol.StreamBasedPacketSink(transport),
+                                     cancellation_token, Logger(verbose=False))
+    if not node is None:
+        channel._interface_definition_crc = node.json_crc
+    return channel
+
+def get_endpoint_id(node, name):
+    members = json.loads(node.json_bytes.decode('ascii'))
+    return next(member["id"] for member in members if member["name"] == name)
+
+class SlowDevice():
+    def __init__(self):
+        self.value = 0
+        self.calls = 0
+    def slow_function(self):
+        self.calls += 1
+        time.sleep(0.6)
+
+class PipeliningTest(unittest.TestCase):
+    def setUp(self):
+        self.cancellation_token = Event()
+        self.device = FakeDevice()
+
+    def tearDown(self):
+        self.cancellation_token.set()
+
+    def test_out_of_order_acks(self):
+        channel = open_channel(self.device, self.cancellation_token)
+        operations = [channel.start_remote_endpoint_operation(1, None, 4) for _ in range(3)]
+        requests = [self.device.get_request() for _ in operations]
+        self.assertEqual(len(set(request[0:2] for request in requests)), 3) # distinct sequence numbers
+        for i in reversed(range(3)):
+            self.device.respond(requests[i], struct.pack('<I', i))
+        self.assertEqual([struct.unpack('<I', operation.result(timeout=1.0))[0] for operation in operations], [0, 1, 2])
+
+    def test_window_limit(self):
+        class SmallWindowChannel(fibre.protocol.Channel):
+            _window_size = 2
+        channel = open_channel(self.device, self.cancellation_token, SmallWindowChannel)
+        operations = [channel.start_remote_endpoint_operation(1, None, 4) for _ in range(2)]
+        first_request = self.device.get_request()
+        self.device.get_request()
+
+        # The third operation waits for a free slot
+        third = []
+        thread = threading.Thread(target=lambda: third.append(channel.start_remote_endpoint_operation(1, None, 4)))
+        thread.start()
+        with self.assertRaises(queue.Empty):
+            self.device.requests.get(timeout=0.1)
+
+        self.device.respond(first_request, b'\x01\x00\x00\x00')
+        self.assertEqual(operations[0].result(timeout=1.0), b'\x01\x00\x00\x00')
+        third_request = self.device.get_request()
+        thread.join()
+        self.device.respond(third_request, b'\x03\x00\x00\x00')
+        self.assertEqual(third[0].result(timeout=1.0), b'\x03\x00\x00\x00')
+        self.assertFalse(operations[1].done())
+
+    def test_blocking_call(self):
+        channel = open_channel(self.device, self.cancellation_token)
+        def responder():
+            self.device.respond(self.device.get_request(), b'\x2a\x00')
+        thread = threading.Thread(target=responder)
+        thread.start()
+        self.assertEqual(channel.remote_endpoint_operation(1, None, True, 2), b'\x2a\x00')
+        thread.join()
+
+class ResendTest(unittest.TestCase):
+    def setUp(self):
+        self.cancellation_token = Event()
+        self.device = FakeDevice()
+
+    def tearDown(self):
+        self.cancellation_token.set()
+
+    def test_timeout_adapts_to_round_trip_time(self):
+        class SteadyChannel(fibre.protocol.Channel):
+            # Keeps scheduling hiccups of the responder thread from causing resends
+            _min_resend_timeout = 0.2
+        channel = open_channel(self.device, self.cancellation_token, SteadyChannel)
+        def responder():
+            for _ in range(20):
+                self.device.respond(self.device.get_request(), b'')
+        thread = threading.Thread(target=responder)
+        thread.start()
+        for _ in range(20):
+            channel.remote_endpoint_operation(1, None, True, 0)
+        thread.join()
+        self.assertLess(channel.stats()['srtt'], 0.1)
+        self.assertLess(channel._rto, channel._resend_timeout)
+        self.assertEqual(channel.stats()['resends'], 0)
+
+    def test_resend_with_backoff(self):
+        class FastChannel(fibre.protocol.Channel):
+            _resend_timeout = 0.05
+        channel = open_channel(self.device, self.cancellation_token, FastChannel)
+        operation = channel.start_remote_endpoint_operation(1, None, 2)
+        first = self.device.get_request()
+        with self.assertRaises(TimeoutError):
+            operation.result(timeout=0.07) # resends once after 50 ms
+        self.assertEqual(self.device.get_request(), first)
+        self.assertEqual(channel._rto, 0.1)
+        self.device.respond(first, b'ok')
+        self.assertEqual(operation.result(timeout=1.0), b'ok')
+        # The ACK of a resent operation is no RTT sample (Karn's rule)
+        self.assertIsNone(channel.stats()['srtt'])
+        self.assertEqual(channel.stats()['resends'], 1)
+
+    def test_expiry_is_handled_once(self):
+        class FastChannel(fibre.protocol.Channel):
+            _resend_timeout = 0.05
+        channel = open_channel(self.device, self.cancellation_token, FastChannel)
+        operation = channel.start_remote_endpoint_operation(1, None, 2)
+        first = self.device.get_request()
+        time.sleep(0.07)
+        # E.g. a waiting thread and a thread that waits for a window slot
+        channel._timer_expired(operation)
+        channel._timer_expired(operation)
+        self.assertEqual(self.device.get_request(), first)
+        with self.assertRaises(queue.Empty):
+            self.device.requests.get(timeout=0.01)
+        self.assertEqual(channel.stats()['resends'], 1)
+        self.assertEqual(channel._rto, 0.1)
+
+    def test_per_call_timeout(self):
+        channel = open_channel(self.device, self.cancellation_token)
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            channel.remote_endpoint_operation(1, None, True, 0, timeout=0.1)
+        self.assertLess(time.monotonic() - start, channel._resend_timeout)
+        self.assertEqual(channel.stats()['expired_operations'], 1)
+        self.assertEqual(channel.stats()['resends'], 0)
+
+    def test_function_call_is_not_resent_on_rtt_timer(self):
+        device = SlowDevice()
+        node = fibre.server.PublishedObject(device)
+        channel = open_stream_channel(node.connect(), self.cancellation_token, node)
+        # A fast link drives the resend timeout down to its minimum
+        for _ in range(50):
+            channel.remote_endpoint_operation(get_endpoint_id(node, 'value'), None, True, 8)
+        self.assertLess(channel._rto, 0.1)
+
+        start = time.monotonic()
+        channel.remote_endpoint_operation(get_endpoint_id(node, 'slow_function'), None, True, 0, idempotent=False)
+        self.assertGreaterEqual(time.monotonic() - start, 0.6)
+        self.assertEqual(device.calls, 1)
+        self.assertEqual(channel.stats()['resends'], 0)
+
+    def test_retry_budget_on_fast_link(self):
+        # The peer never answers
+        host_end, self.peer = socket.socketpair()
+        channel = open_stream_channel(fibre.tcp_transport.SocketStreamTransport(host_end), self.cancellation_token)
+        channel._retry_budget = 0.5
+        channel._rto = channel._min_resend_timeout
+        start = time.monotonic()
+        with self.assertRaises(fibre.protocol.ChannelBrokenException):
+            channel.remote_endpoint_operation(1, None, True, 4)
+        self.assertGreaterEqual(time.monotonic() - start, channel._retry_budget)
+        self.assertGreaterEqual(channel.stats()['resends'], channel._send_attempts - 1)
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.cancellation_token = Event()
+        self.device = FakeDevice()
+        self.channel = open_channel(self.device, self.cancellation_token)
+
+    def tearDown(self):
+        self.cancellation_token.set()
+
+    def test_concurrent_operations(self):
+        def responder():
+            requests = [self.device.get_request() for _ in range(3)]
+            for request in reversed(requests):
+                self.device.respond(request, request[0:2])
+        thread = threading.Thread(target=responder)
+        thread.start()
+
+        async def read_all():
+            # The fake device has no file descriptor, so the receiver thread stays in charge
+            self.assertFalse(await self.channel.attach_event_loop())
+            return await asyncio.gather(*[self.channel.remote_endpoint_operation_async(1, None, 2) for _ in range(3)])
+        results = asyncio.run(read_all())
+        thread.join()
+        self.assertEqual(len(set(results)), 3)
+
+    def test_resend_is_not_sent_from_event_loop(self):
+        class FastChannel(fibre.protocol.Channel):
+            _resend_timeout = 0.05
+        device = FakeDevice()
+        channel = open_channel(device, self.cancellation_token, FastChannel)
+        resend_threads = []
+        timer_expired = channel._timer_expired
+        def recording_timer_expired(operation):
+            resend_threads.append(threading.current_thread())
+            timer_expired(operation)
+        channel._timer_expired = recording_timer_expired
+        def responder():
+            device.get_request()
+            device.respond(device.get_request(), b'ok') # answer the resend
+        thread = threading.Thread(target=responder)
+        thread.start()
+        self.assertEqual(asyncio.run(channel.remote_endpoint_operation_async(1, None, 2)), b'ok')
+        thread.join()
+        self.assertGreater(len(resend_threads), 0)
+        self.assertNotIn(threading.main_thread(), resend_threads)
+
+class AsyncWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.cancellation_token = Event()
+        self.device = SlowDevice()
+        self.node = fibre.server.PublishedObject(self.device)
+        self.channel = open_stream_channel(self.node.connect(), self.cancellation_token, self.node)
+        self.channel._window_size = 2
+        self.channel._window = threading.BoundedSemaphore(self.channel._window_size)
+        self.value_id = get_endpoint_id(self.node, 'value')
+
+    def tearDown(self):
+        self.cancellation_token.set()
+
+    def assert_window_free(self):
+        slots = 0
+        while self.channel._window.acquire(timeout=1.0):
+            slots += 1
+            if slots == self.channel._window_size:
+                break
+        for _ in range(slots):
+            self.channel._window.release()
+        self.assertEqual(slots, self.channel._window_size)
+
+    def test_several_event_loops(self):
+        async def read_many():
+            operations = [self.channel.remote_endpoint_operation_async(self.value_id, None, 8) for _ in range(5)]
+            return await asyncio.gather(*operations)
+        for _ in range(2):
+            self.assertEqual(len(asyncio.run(read_many())), 5)
+        self.assert_window_free()
+
+    def test_one_semaphore_per_event_loop(self):
+        loop_a, loop_b = asyncio.new_event_loop(), asyncio.new_event_loop()
+        try:
+            window_a = self.channel._get_async_window(loop_a)
+            window_b = self.channel._get_async_window(loop_b)
+            self.assertIsNot(window_a, window_b)
+            self.assertIs(self.channel._get_async_window(loop_a), window_a)
+        finally:
+            loop_a.close()
+            loop_b.close()
+
+    def test_concurrent_event_loops(self):
+        async def read_many():
+            operations = [self.channel.remote_endpoint_operation_async(self.value_id, None, 8) for _ in range(20)]
+            return await asyncio.gather(*operations)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(asyncio.run(read_many()))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([len(result) for result in results], [20] * 3)
+        self.assert_window_free()
+
+    def test_cancel_while_window_is_full(self):
+        # Blocking callers occupy the whole window
+        slow_function_id = get_endpoint_id(self.node, 'slow_function')
+        threads = [threading.Thread(target=self.channel.remote_endpoint_operation,
+                                    args=(slow_function_id, None, True, 0), kwargs={'idempotent': False})
+                   for _ in range(self.channel._window_size)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+
+        async def cancelled_read():
+            task = asyncio.ensure_future(self.channel.remote_endpoint_operation_async(self.value_id, None, 8))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(cancelled_read())
+        for thread in threads:
+            thread.join()
+        self.assert_window_free()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Tests for the CRC functions in fibre.protocol.
+Run from Firmware/fibre/python with "python -m pytest tests" or
+"python -m unittest discover tests".
+"""
+
+import random
+import unittest
+import fibre.protocol
+from fibre.protocol import calc_crc, calc_crc8, calc_crc16, CRC8_DEFAULT, CRC16_DEFAULT
+
+def reference_crc8(remainder, data):
+    for byte in data:
+        remainder = calc_crc(remainder, byte, CRC8_DEFAULT, 8)
+    return remainder
+
+def reference_crc16(remainder, data):
+    for byte in data:
+        remainder = calc_crc(remainder, byte, CRC16_DEFAULT, 16)
+    return remainder
+
+class CrcTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.buffers = [b'', b'\x00', b'\xff' * 7] + \
+                       [bytes(rng.randrange(256) for _ in range(rng.randrange(1, 200))) for _ in range(50)]
+
+    def check_against_reference(self):
+        for data in self.buffers:
+            for remainder in [0, fibre.protocol.CRC8_INIT, 0xff]:
+                self.assertEqual(calc_crc8(remainder, data), reference_crc8(remainder, data))
+            for remainder in [0, fibre.protocol.CRC16_INIT, 0xffff]:
+                self.assertEqual(calc_crc16(remainder, data), reference_crc16(remainder, data))
+
+    def test_table_driven(self):
+        crc8_fun, crc16_fun = fibre.protocol._crc8_fun, fibre.protocol._crc16_fun
+        fibre.protocol._crc8_fun = fibre.protocol._crc16_fun = None
+        try:
+            self.check_against_reference()
+        finally:
+            fibre.protocol._crc8_fun, fibre.protocol._crc16_fun = crc8_fun, crc16_fun
+
+    @unittest.skipIf(fibre.protocol._crc8_fun is None, "crcmod is not installed")
+    def test_crcmod(self):
+        self.check_against_reference()
+
+    def test_input_types(self):
+        data = self.buffers[10]
+        expected = reference_crc16(fibre.protocol.CRC16_INIT, data)
+        for value in [data, bytearray(data), memoryview(data), list(data)]:
+            self.assertEqual(calc_crc16(fibre.protocol.CRC16_INIT, value), expected)
+        # A memoryview with a wider item size is processed byte by byte
+        self.assertEqual(calc_crc16(fibre.protocol.CRC16_INIT, memoryview(bytes(data[:8])).cast('H')),
+                         reference_crc16(fibre.protocol.CRC16_INIT, data[:8]))
+        self.assertEqual(calc_crc8(fibre.protocol.CRC8_INIT, 0x5a),
+                         reference_crc8(fibre.protocol.CRC8_INIT, [0x5a]))
+        self.assertEqual(calc_crc16(fibre.protocol.CRC16_INIT, 0x5a),
+                         reference_crc16(fibre.protocol.CRC16_INIT, [0x5a]))
+
+    def test_incremental(self):
+        data = self.buffers[20]
+        self.assertEqual(calc_crc16(calc_crc16(fibre.protocol.CRC16_INIT, data[:5]), data[5:]),
+                         calc_crc16(fibre.protocol.CRC16_INIT, data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+"""
+Tests for fibre.discovery with stand-in devices.
+"""
+
+import json
+import struct
+import threading
+import time
+import unittest
+import zlib
+import fibre
+import fibre.discovery
+import fibre.loopback_transport
+import fibre.protocol
+from fibre.utils import Event, Logger
+
+json_bytes = json.dumps([
+    {"name": "", "id": 0, "type": "json", "access": "r"},
+    {"name": "serial_number", "id": 1, "type": "uint64", "access": "r"},
+], separators=(',', ':')).encode('ascii')
+
+class FakeNode():
+    """
+    Stand-in device that serves the JSON interface definition on endpoint 0
+    and answers reads from other endpoints with the bytes in values (a dict
+    of the form {endpoint_id: bytes}). If json_bytes is None, the device
+    never answers.
+    """
+    def __init__(self, json_bytes, values=None, latency=0.0):
+        self.host_end, self._device_end = fibre.loopback_transport.create_pair(latency=latency / 2)
+        self._json_bytes = json_bytes
+        self._values = {} if values is None else values
+        if not json_bytes is None:
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+
+    def _run(self):
+        while True:
+            try:
+                packet = self._device_end.get_packet(None)
+            except fibre.protocol.ChannelBrokenException:
+                return
+            seq_no, endpoint_id, output_length = struct.unpack('<HHH', packet[:6])
+            if not endpoint_id & 0x8000:
+                continue
+            endpoint_id &= 0x7fff
+            if endpoint_id == 0:
+                offset = struct.unpack('<I', packet[6:10])[0]
+                if offset == 0xffffffff:
+                    response = struct.pack('<I', zlib.crc32(self._json_bytes)) # version tag
+                else:
+                    response = self._json_bytes[offset:offset + output_length]
+            else:
+                response = self._values.get(endpoint_id, bytes(output_length))
+            try:
+                self._device_end.process_packet(struct.pack('<H', seq_no | 0x8000) + response)
+            except fibre.protocol.ChannelBrokenException:
+                return
+
+    def open_channel(self, cancellation_token):
+        return fibre.protocol.Channel("fake node", self.host_end, self.host_end, cancellation_token, Logger(verbose=False))
+
+    def close(self):
+        self.host_end.close()
+
+def make_node(serial_number, **kwargs):
+    return FakeNode(json_bytes, {1: struct.pack('<Q', serial_number)}, **kwargs)
+
+class DiscoveryTest(unittest.TestCase):
+    """
+    Registers the channel type "test", which discovers the devices in
+    self.devices
+    """
+    def setUp(self):
+        self.devices = []
+        self.channel_termination_token = Event()
+        fibre.discovery.channel_types['test'] = self.discover_channels
+
+    def tearDown(self):
+        self.channel_termination_token.set()
+        del fibre.discovery.channel_types['test']
+        for device in self.devices:
+            device.close()
+
+    def discover_channels(self, path, serial_number, callback, cancellation_token, channel_termination_token, logger):
+        announced = []
+        while not cancellation_token.is_set():
+            for device in list(self.devices):
+                if not device in announced:
+                    announced.append(device)
+                    callback(device.open_channel(channel_termination_token))
+            time.sleep(0.01)
+
+    def find(self):
+        obj = fibre.find_any('test', timeout=5.0, channel_termination_token=self.channel_termination_token)
+        self.assertIsNotNone(obj)
+        return obj
+
+class FindAllTest(DiscoveryTest):
+    n_devices = 8
+    max_parallel = 4
+    init_timeout = 0.5
+
+    def setUp(self):
+        super(FindAllTest, self).setUp()
+        # A device that never responds comes first and must not hold up the others
+        self.devices.append(FakeNode(None))
+        self.devices.extend(make_node(0x1000 + i, latency=0.004) for i in range(self.n_devices))
+        self.init_channel = fibre.discovery.init_channel
+        self.init_lock = threading.Lock()
+        self.active_inits = 0
+        self.max_active_inits = 0
+        fibre.discovery.init_channel = self.counting_init_channel
+        self.cancellation_token = Event()
+
+    def tearDown(self):
+        self.cancellation_token.set()
+        fibre.discovery.init_channel = self.init_channel
+        super(FindAllTest, self).tearDown()
+
+    def counting_init_channel(self, *args):
+        with self.init_lock:
+            self.active_inits += 1
+            self.max_active_inits = max(self.max_active_inits, self.active_inits)
+        try:
+            return self.init_channel(*args)
+        finally:
+            with self.init_lock:
+                self.active_inits -= 1
+
+    def test_find_all(self):
+        discovered = []
+        lock = threading.Lock()
+        done = Event()
+        def did_discover_object(obj):
+            with lock:
+                discovered.append(obj.serial_number)
+                if len(discovered) == self.n_devices:
+                    done.set()
+
+        start = time.monotonic()
+        fibre.discovery.find_all('test', None, did_discover_object, self.cancellation_token,
+                                 self.channel_termination_token, Logger(verbose=False),
+                                 max_parallel=self.max_parallel, init_timeout=self.init_timeout)
+        done.wait(timeout=10.0)
+
+        self.assertEqual(sorted(discovered), [0x1000 + i for i in range(self.n_devices)])
+        self.assertGreater(self.max_active_inits, 1)
+        self.assertLessEqual(self.max_active_inits, self.max_parallel)
+        # The dead device occupies one slot until its init times out
+        self.assertLess(time.monotonic() - start, self.init_timeout + 2.0)
+        while self.active_inits and time.monotonic() - start < self.init_timeout + 2.0:
+            time.sleep(0.05)
+        self.assertEqual(self.active_inits, 0)
+        self.assertEqual(len(discovered), self.n_devices)
+
+    def test_callback_runs_for_one_object_at_a_time(self):
+        names = {}
+        discovered = []
+        in_callback = [0]
+        overlaps = []
+        done = Event()
+        def did_discover_object(obj):
+            # Not thread-safe on purpose, like fibre.shell.did_discover_device
+            in_callback[0] += 1
+            if in_callback[0] > 1:
+                overlaps.append(obj.serial_number)
+            discovered.append(obj.serial_number)
+            time.sleep(0.01)
+            names[obj.serial_number] = "odrv{}".format(len(discovered) - 1)
+            in_callback[0] -= 1
+            if len(discovered) == self.n_devices:
+                done.set()
+
+        fibre.discovery.find_all('test', None, did_discover_object, self.cancellation_token,
+                                 self.channel_termination_token, Logger(verbose=False),
+                                 max_parallel=self.max_parallel, init_timeout=self.init_timeout)
+        done.wait(timeout=10.0)
+
+        self.assertEqual(sorted(discovered), [0x1000 + i for i in range(self.n_devices)])
+        self.assertEqual(overlaps, [])
+        self.assertEqual(len(set(names.values())), self.n_devices)
+
+class ReconnectTest(DiscoveryTest):
+    def test_reconnect_to_same_device(self):
+        device = make_node(0x1000)
+        self.devices.append(device)
+        obj = self.find()
+        old_channel = obj.__channel__
+
+        def reboot():
+            self.devices.remove(device)
+            device.close()
+            time.sleep(0.1)
+            # Another device shows up first
+            self.devices.append(make_node(0x2000))
+            time.sleep(0.1)
+            self.devices.append(make_node(0x1000))
+        thread = threading.Thread(target=reboot)
+        thread.start()
+        self.assertIs(obj.wait_for_reconnect(timeout=5.0), obj)
+        thread.join()
+        self.assertEqual(obj.serial_number, 0x1000)
+        self.assertFalse(obj.__channel__._channel_broken.is_set())
+        # The old channel no longer refers to the object
+        self.assertNotIn(obj._tear_down, old_channel._channel_broken._subscribers)
+
+    def test_timeout(self):
+        device = make_node(0x1000)
+        self.devices.append(device)
+        obj = self.find()
+        self.devices.remove(device)
+        device.close()
+        with self.assertRaises(fibre.TimeoutError):
+            obj.wait_for_reconnect(timeout=0.3)
+
+    def test_timeout_covers_disconnect_and_reconnect(self):
+        device = make_node(0x1000)
+        self.devices.append(device)
+        obj = self.find()
+        def unplug():
+            self.devices.remove(device)
+            device.close()
+        timer = threading.Timer(0.2, unplug)
+        timer.start()
+        start = time.monotonic()
+        with self.assertRaises(fibre.TimeoutError):
+            obj.wait_for_reconnect(timeout=0.4)
+        self.assertLess(time.monotonic() - start, 0.6)
+        timer.join()
+
+    def test_device_without_serial_number(self):
+        no_serial_json = json.dumps([{"name": "", "id": 0, "type": "json", "access": "r"},
+                                     {"name": "value", "id": 1, "type": "uint32", "access": "rw"}]).encode('ascii')
+        self.devices.append(FakeNode(no_serial_json))
+        obj = self.find()
+        # Any device on the path would match, so the call must fail right away
+        with self.assertRaises(ValueError):
+            obj.wait_for_reconnect(timeout=2.0)
+
+if __name__ == '__main__':
+    unittest.main()
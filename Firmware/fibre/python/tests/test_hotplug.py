@@ -0,0 +1,92 @@
+"""
+Tests for fibre.hotplug with the synthetic backend.
+"""
+
+import threading
+import time
+import unittest
+import fibre.hotplug
+import fibre.serial_transport
+from fibre.utils import Event, Logger
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = fibre.hotplug.SyntheticBackend()
+
+    def test_events_are_merged(self):
+        watcher = self.backend.watch(('usb',))
+        self.backend.add('usb', BUSNUM='001', DEVNUM='005')
+        self.backend.add('tty', DEVNAME='/dev/ttyACM0')
+        self.backend.remove('usb', BUSNUM='001', DEVNUM='004')
+        events = watcher.wait(timeout=1.0)
+        self.assertEqual([(event.action, event.properties['DEVNUM']) for event in events], [('add', '005'), ('remove', '004')])
+        self.assertEqual(watcher.wait(timeout=0.1), [])
+
+    def test_only_new_events_are_reported(self):
+        self.backend.add('usb')
+        watcher = self.backend.watch()
+        self.assertEqual(watcher.wait(timeout=0.1), [])
+
+    def test_poll_interval(self):
+        watcher = fibre.hotplug.SyntheticBackend(poll_interval=0.1).watch()
+        start = time.monotonic()
+        self.assertEqual(watcher.wait(), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertLess(time.monotonic() - start, 1.0)
+        # Event based backends only poll as a safety net
+        self.assertGreater(fibre.hotplug.NetlinkBackend.poll_interval, fibre.hotplug.PollingBackend.poll_interval)
+
+    def test_cancellation(self):
+        cancellation_token = Event()
+        watcher = self.backend.watch(None, cancellation_token)
+        threading.Timer(0.1, cancellation_token.set).start()
+        start = time.monotonic()
+        self.assertEqual(watcher.wait(), [])
+        self.assertLess(time.monotonic() - start, 1.0)
+
+class SerialScannerTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = fibre.hotplug.SyntheticBackend()
+        fibre.hotplug.set_backend(self.backend)
+        self.scans = 0
+        self.find_pyserial_ports = fibre.serial_transport.find_pyserial_ports
+        self.find_dev_serial_ports = fibre.serial_transport.find_dev_serial_ports
+        fibre.serial_transport.find_pyserial_ports = lambda: []
+        fibre.serial_transport.find_dev_serial_ports = self.count_scan
+        self.cancellation_token = Event()
+        self.thread = threading.Thread(target=fibre.serial_transport.discover_channels,
+                                       args=(None, None, None, self.cancellation_token, Event(), Logger(verbose=False)))
+        self.thread.start()
+
+    def tearDown(self):
+        self.cancellation_token.set()
+        self.thread.join()
+        fibre.serial_transport.find_pyserial_ports = self.find_pyserial_ports
+        fibre.serial_transport.find_dev_serial_ports = self.find_dev_serial_ports
+        fibre.hotplug.set_backend(None)
+
+    def count_scan(self):
+        self.scans += 1
+        return []
+
+    def wait_for_scans(self, n_scans):
+        deadline = time.monotonic() + 1.0
+        while self.scans < n_scans and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2) # no further scans follow
+        self.assertEqual(self.scans, n_scans)
+
+    def test_one_rescan_per_burst_of_events(self):
+        self.wait_for_scans(1)
+        self.backend.add('tty', DEVNAME='/dev/ttyACM0')
+        self.backend.add('tty', DEVNAME='/dev/ttyACM1')
+        self.backend.remove('tty', DEVNAME='/dev/ttyACM0')
+        self.wait_for_scans(2)
+
+    def test_other_subsystems_are_ignored(self):
+        self.wait_for_scans(1)
+        self.backend.add('usb', BUSNUM='001', DEVNUM='005')
+        self.wait_for_scans(1)
+
+if __name__ == '__main__':
+    unittest.main()
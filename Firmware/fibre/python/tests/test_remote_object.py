@@ -0,0 +1,131 @@
+"""
+Tests for fibre.remote_object.
+"""
+
+import json
+import struct
+import time
+import unittest
+import fibre.protocol
+import fibre.remote_object
+from fibre.utils import Event
+from test_channel import FakeDevice, open_channel
+
+class FakeProperty():
+    """
+    Provides what PropertyStream uses of a RemoteProperty
+    """
+    def __init__(self, channel):
+        self.__channel__ = channel
+        self._id = 1
+        self._name = "input_pos"
+        self._codec = fibre.remote_object.StructCodec("<f", float)
+        self._can_write = True
+
+class PropertyStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.cancellation_token = Event()
+        self.device = FakeDevice()
+        self.prop = FakeProperty(open_channel(self.device, self.cancellation_token))
+
+    def tearDown(self):
+        self.cancellation_token.set()
+
+    def get_value(self):
+        request = self.device.get_request()
+        return request, struct.unpack('<f', request[6:10])[0]
+
+    def test_latest_value_wins(self):
+        stream = fibre.remote_object.PropertyStream(self.prop, max_age=1.0)
+        stream.write(1.0)
+        request, value = self.get_value()
+        self.assertEqual(value, 1.0)
+        # While the first write is in flight, 2.0 is superseded by 3.0
+        stream.write(2.0)
+        stream.write(3.0)
+        self.device.respond(request, b'')
+        request, value = self.get_value()
+        self.assertEqual(value, 3.0)
+        self.device.respond(request, b'')
+        self.assertTrue(stream.flush(timeout=1.0))
+        self.assertEqual(stream.stats(), {'written': 3, 'sent': 2, 'dropped': 1, 'late': 0, 'failed': 0})
+        stream.close()
+
+    def test_late_values(self):
+        stream = fibre.remote_object.PropertyStream(self.prop, max_age=0.05)
+        stream.write(1.0)
+        request, _ = self.get_value()
+        time.sleep(0.1)
+        self.device.respond(request, b'')
+        self.assertTrue(stream.flush(timeout=1.0))
+        self.assertEqual(stream.late, 1)
+
+        stream.write(2.0)
+        request, _ = self.get_value()
+        self.device.respond(request, b'')
+        self.assertTrue(stream.flush(timeout=1.0))
+        self.assertEqual(stream.late, 1)
+        self.assertEqual(stream.dropped, 0)
+        stream.close()
+
+    def test_fire_and_forget(self):
+        stream = fibre.remote_object.PropertyStream(self.prop, expect_ack=False)
+        stream.write(1.0)
+        request, value = self.get_value()
+        self.assertEqual(value, 1.0)
+        self.assertFalse(struct.unpack('<H', request[2:4])[0] & 0x8000)
+        self.assertTrue(stream.flush(timeout=1.0))
+        self.assertEqual(stream.sent, 1)
+        stream.close()
+
+    def test_broken_channel_closes_stream(self):
+        stream = fibre.remote_object.PropertyStream(self.prop)
+        stream.write(1.0)
+        self.get_value()
+        self.cancellation_token.set()
+        self.assertTrue(stream.flush(timeout=1.0))
+        self.assertEqual(stream.failed, 1)
+        with self.assertRaises(fibre.protocol.ChannelBrokenException):
+            stream.write(2.0)
+
+    def test_read_only_property(self):
+        self.prop._can_write = False
+        with self.assertRaises(Exception):
+            fibre.remote_object.PropertyStream(self.prop)
+
+class ObjectClassTest(unittest.TestCase):
+    def setUp(self):
+        self.cancellation_token = Event()
+        self.channel = open_channel(FakeDevice(), self.cancellation_token)
+
+    def tearDown(self):
+        self.cancellation_token.set()
+
+    def test_member_names_taken_by_remote_object(self):
+        json_bytes = json.dumps([
+            {"name": "", "id": 0, "type": "json", "access": "r"},
+            {"name": "stream", "id": 1, "type": "float", "access": "rw"},
+            {"name": "_rebind", "id": 2, "type": "function", "inputs": [], "outputs": []},
+            {"name": "wait_for_reconnect", "type": "object", "members": [
+                {"name": "pos", "id": 3, "type": "float", "access": "rw"}]},
+            {"name": "vel", "id": 4, "type": "float", "access": "rw"},
+        ]).encode('ascii')
+        schema = fibre.remote_object.get_schema(json_bytes)
+        obj = fibre.remote_object.RemoteObject(schema.root, None, self.channel, None)
+        # The methods of RemoteObject are not shadowed
+        self.assertEqual(obj.stream.__func__, fibre.remote_object.RemoteObject.stream)
+        self.assertEqual(obj._rebind.__func__, fibre.remote_object.RemoteObject._rebind)
+        self.assertEqual(obj.wait_for_reconnect.__func__, fibre.remote_object.RemoteObject.wait_for_reconnect)
+        # The members get a trailing underscore
+        self.assertIsInstance(obj.wait_for_reconnect_, fibre.remote_object.RemoteObject)
+        self.assertIsInstance(obj._rebind_, fibre.remote_object.RemoteFunction)
+        self.assertIsInstance(obj._remote_attributes['stream'], fibre.remote_object.RemoteProperty)
+        stream = obj.stream('vel')
+        self.assertIsInstance(stream, fibre.remote_object.PropertyStream)
+        stream.close()
+        self.assertIn('stream_', dir(obj))
+        self.assertIn('vel', dir(obj))
+        self.assertNotIn('_property_vel', dir(obj))
+
+if __name__ == '__main__':
+    unittest.main()
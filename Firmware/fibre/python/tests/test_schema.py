@@ -0,0 +1,38 @@
+"""
+Tests for the schema flyweight in fibre.remote_object.
+"""
+
+import unittest
+import fibre.protocol
+import fibre.remote_object
+
+def make_json(property_name):
+    return ('[{"name":"","id":0,"type":"json","access":"r"},'
+            '{"name":"' + property_name + '","id":1,"type":"uint32","access":"r"}]').encode('ascii')
+
+class SchemaTest(unittest.TestCase):
+    def test_same_json_shares_schema(self):
+        self.assertIs(fibre.remote_object.get_schema(make_json("foo")),
+                      fibre.remote_object.get_schema(bytearray(make_json("foo"))))
+
+    def test_different_json(self):
+        schema_a = fibre.remote_object.get_schema(make_json("foo"))
+        schema_b = fibre.remote_object.get_schema(make_json("bar"))
+        self.assertIsNot(schema_a, schema_b)
+        self.assertIsNot(schema_a.root, schema_b.root)
+
+    def test_crc_collision(self):
+        # These two interface definitions have the same JSON CRC
+        json_a, json_b = make_json("akay"), make_json("apad")
+        crc = lambda json_bytes: fibre.protocol.calc_crc16(fibre.protocol.PROTOCOL_VERSION, json_bytes)
+        self.assertEqual(crc(json_a), crc(json_b))
+
+        schema_a = fibre.remote_object.get_schema(json_a)
+        schema_b = fibre.remote_object.get_schema(json_b)
+        self.assertIsNot(schema_a, schema_b)
+        self.assertEqual(schema_a.root.get_member('akay').id, 1)
+        self.assertEqual(schema_b.root.get_member('apad').id, 1)
+        self.assertIsNone(schema_b.root.get_member('akay'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests for the on-disk schema cache in fibre.schema_cache.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import fibre.remote_object
+import fibre.schema_cache
+from fibre.utils import Logger
+
+json_bytes = (b'[{"name":"","id":0,"type":"json","access":"r"},'
+              b'{"name":"vbus_voltage","id":1,"type":"float","access":"r"},'
+              b'{"name":"axis0","type":"object","members":['
+              b'{"name":"pos","id":2,"type":"float","access":"rw"},'
+              b'{"name":"reset","id":3,"type":"function","inputs":[],"outputs":[]}]}]')
+
+class SchemaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.logger = Logger(verbose=False)
+        self.schema = fibre.remote_object.get_schema(json_bytes)
+        self.max_entries = fibre.schema_cache.max_entries
+
+    def tearDown(self):
+        fibre.schema_cache.max_entries = self.max_entries
+        shutil.rmtree(self.cache_dir)
+
+    def list_cache_dir(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def set_mtime(self, json_version_tag, mtime):
+        os.utime(fibre.schema_cache.get_cache_path(self.cache_dir, json_version_tag), (mtime, mtime))
+
+    def test_round_trip(self):
+        fibre.schema_cache.save(self.cache_dir, 0x1234, self.schema, self.logger)
+        self.assertIsNotNone(fibre.schema_cache.load(self.cache_dir, 0x1234, self.logger))
+        self.assertIsNone(fibre.schema_cache.load(self.cache_dir, 0x5678, self.logger))
+
+        with open(fibre.schema_cache.get_cache_path(self.cache_dir, 0x1234), 'rb') as fp:
+            schema = fibre.schema_cache.decode(fp.read(), 0x1234)
+        self.assertEqual(schema.json_crc, self.schema.json_crc)
+        self.assertEqual(schema.json_bytes, json_bytes)
+        self.assertEqual(schema.table.records, self.schema.table.records)
+        self.assertEqual(schema.table.strings, self.schema.table.strings)
+
+    def test_corrupted_entry_is_ignored(self):
+        fibre.schema_cache.save(self.cache_dir, 0x1234, self.schema, self.logger)
+        path = fibre.schema_cache.get_cache_path(self.cache_dir, 0x1234)
+        with open(path, 'rb') as fp:
+            data = bytearray(fp.read())
+        for corrupted in [data[:len(data) // 2], data[:-1] + bytes([data[-1] ^ 1]),
+                          data[:30] + bytes([data[30] ^ 1]) + data[31:]]:
+            with open(path, 'wb') as fp:
+                fp.write(corrupted)
+            self.assertIsNone(fibre.schema_cache.load(self.cache_dir, 0x1234, self.logger))
+
+    def test_entry_of_other_version_tag_is_ignored(self):
+        fibre.schema_cache.save(self.cache_dir, 0x1234, self.schema, self.logger)
+        os.replace(fibre.schema_cache.get_cache_path(self.cache_dir, 0x1234),
+                   fibre.schema_cache.get_cache_path(self.cache_dir, 0x5678))
+        self.assertIsNone(fibre.schema_cache.load(self.cache_dir, 0x5678, self.logger))
+
+    def test_failed_write_keeps_old_entry(self):
+        fibre.schema_cache.save(self.cache_dir, 0x1234, self.schema, self.logger)
+        entries = self.list_cache_dir()
+        encode = fibre.schema_cache.encode
+        def failing_encode(schema, json_version_tag):
+            raise OSError("disk full")
+        fibre.schema_cache.encode = failing_encode
+        try:
+            fibre.schema_cache.save(self.cache_dir, 0x1234, self.schema, self.logger)
+        finally:
+            fibre.schema_cache.encode = encode
+        # No temporary file is left behind and the old entry is still valid
+        self.assertEqual(self.list_cache_dir(), entries)
+        self.assertIsNotNone(fibre.schema_cache.load(self.cache_dir, 0x1234, self.logger))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        fibre.schema_cache.max_entries = 3
+        now = time.time()
+        # A leftover raw JSON entry counts towards the limit
+        with open(os.path.join(self.cache_dir, 'fibre_schema_cache_00000001.json'), 'wb') as fp:
+            fp.write(json_bytes)
+        os.utime(os.path.join(self.cache_dir, 'fibre_schema_cache_00000001.json'), (now - 50, now - 50))
+        for i, json_version_tag in enumerate([0x10, 0x20, 0x30]):
+            fibre.schema_cache.save(self.cache_dir, json_version_tag, self.schema, self.logger)
+            self.set_mtime(json_version_tag, now - 40 + i * 10)
+        self.assertEqual(len(self.list_cache_dir()), 3)
+        self.assertNotIn('fibre_schema_cache_00000001.json', self.list_cache_dir())
+
+        # Loading 0x10 makes 0x20 the least recently used entry
+        self.assertIsNotNone(fibre.schema_cache.load(self.cache_dir, 0x10, self.logger))
+        fibre.schema_cache.save(self.cache_dir, 0x40, self.schema, self.logger)
+        self.assertEqual(self.list_cache_dir(), [os.path.basename(fibre.schema_cache.get_cache_path(self.cache_dir, json_version_tag))
+                                                 for json_version_tag in [0x10, 0x30, 0x40]])
+
+if __name__ == '__main__':
+    unittest.main()
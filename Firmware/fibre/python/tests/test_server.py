@@ -0,0 +1,125 @@
+"""
+Round trip tests for Python objects that are published with fibre.server.
+"""
+
+import struct
+import unittest
+import fibre
+import fibre.protocol
+import fibre.server
+import fibre.simulator
+from fibre.utils import Event, Logger
+
+class Motor():
+    kv: 'uint16' = 270
+    def __init__(self):
+        self.pos = 1.5
+        self.enabled = False
+        self._private = 3
+        self._failures = 0
+    def add(self, a: float, b: float) -> float:
+        return a + b
+    def reset(self):
+        self.pos = 0.0
+    def fail(self) -> int:
+        self._failures += 1
+        raise ValueError("handler error")
+
+class Device():
+    def __init__(self):
+        self.serial_number = 0x1234
+        self.count = 5
+        self.motor = Motor()
+        self.root = self # cycles are not followed
+    @property
+    def uptime(self) -> int:
+        return 42
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.device = Device()
+        self.node = fibre.server.PublishedObject(self.device, Logger(verbose=False))
+        self.tcp_server = fibre.server.TCPServer(self.node, '127.0.0.1', 0)
+        self.udp_server = fibre.server.UDPServer(self.node, '127.0.0.1', 0)
+        fibre.simulator.attach(self.node)
+        self.channel_termination_token = Event()
+
+    def tearDown(self):
+        self.channel_termination_token.set()
+        fibre.simulator.detach(self.node)
+        self.tcp_server.close()
+        self.udp_server.close()
+
+    def find(self, path):
+        obj = fibre.find_any(path, timeout=5.0, channel_termination_token=self.channel_termination_token)
+        self.assertIsNotNone(obj)
+        return obj
+
+    def check_round_trip(self, obj):
+        self.assertEqual(obj.serial_number, 0x1234)
+        self.assertEqual(obj.count, 5)
+        self.assertEqual(obj.uptime, 42)
+        self.assertEqual(obj.motor.kv, 270)
+        self.assertEqual(obj.motor.add(2, 3.5), 5.5)
+        self.assertFalse(hasattr(obj.motor, '_private'))
+        self.assertFalse(hasattr(obj, 'root'))
+
+        obj.motor.pos = 7.25
+        self.assertEqual(self.device.motor.pos, 7.25)
+        obj.motor.reset()
+        self.assertEqual(self.device.motor.pos, 0.0)
+        obj.motor.enabled = True
+        self.assertIs(self.device.motor.enabled, True)
+        with self.assertRaises(Exception):
+            obj.uptime = 3 # read-only
+
+    def test_tcp(self):
+        self.check_round_trip(self.find("tcp:127.0.0.1:{}".format(self.tcp_server.port)))
+
+    def test_udp(self):
+        self.check_round_trip(self.find("udp:127.0.0.1:{}".format(self.udp_server.port)))
+
+    def test_loopback(self):
+        self.check_round_trip(self.find("loopback:"))
+
+    def test_failing_handler_is_not_answered(self):
+        obj = self.find("loopback:")
+        channel = obj.__channel__
+        with self.assertRaises(fibre.TimeoutError):
+            channel.remote_endpoint_operation(obj.motor._remote_attributes['fail']._trigger_id, None, True, 0,
+                                              timeout=0.3, idempotent=False)
+        self.assertEqual(self.node.failed, 1)
+        # The channel keeps working
+        self.assertEqual(obj.count, 5)
+
+    def test_failing_handler_runs_once(self):
+        obj = self.find("loopback:")
+        channel = obj.__channel__
+        channel._retry_budget = 0.5
+        channel._non_idempotent_resend_timeout = 0.1
+        with self.assertRaises(fibre.protocol.ChannelBrokenException):
+            obj.motor.fail()
+        # The resends were recognized and not executed again
+        self.assertEqual(self.device.motor._failures, 1)
+        self.assertEqual(self.node.failed, 1)
+        self.assertGreaterEqual(self.node.duplicates, channel._send_attempts - 1)
+
+    def test_resent_request_is_answered_again(self):
+        obj = self.find("loopback:")
+        trigger_id = obj.motor._remote_attributes['reset']._trigger_id
+        request = struct.pack('<HHH', 1, trigger_id | 0x8000, 0) + struct.pack('<H', self.node.json_crc)
+        session = self.node.create_session()
+        response = self.node.process_request(request, session)
+        self.assertEqual(response, struct.pack('<H', 0x8001))
+        self.assertEqual(self.device.motor.pos, 0.0)
+        # The response got lost and the peer resends the request
+        self.device.motor.pos = 2.0
+        self.assertEqual(self.node.process_request(request, session), response)
+        self.assertEqual(self.device.motor.pos, 2.0)
+        self.assertEqual(self.node.duplicates, 1)
+        # Another session executes the same request
+        self.node.process_request(request, self.node.create_session())
+        self.assertEqual(self.device.motor.pos, 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests for fibre.simulator and the "loopback:" path spec.
+"""
+
+import json
+import struct
+import time
+import unittest
+import fibre
+import fibre.protocol
+import fibre.simulator
+from fibre.utils import Event
+
+json_bytes = json.dumps([
+    {"name": "", "id": 0, "type": "json", "access": "r"},
+    {"name": "serial_number", "id": 1, "type": "uint64", "access": "r"},
+    {"name": "vbus_voltage", "id": 2, "type": "float", "access": "r"},
+    {"name": "axis0", "type": "object", "members": [
+        {"name": "pos", "id": 3, "type": "float", "access": "rw"},
+        {"name": "move", "id": 4, "type": "function",
+         "inputs": [{"name": "delta", "id": 5, "type": "float", "access": "rw"}],
+         "outputs": [{"name": "new_pos", "id": 6, "type": "float", "access": "r"}]},
+    ]},
+], separators=(',', ':')).encode('ascii')
+
+class SimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.device = fibre.simulator.SimulatedDevice(json_bytes, values={'serial_number': 0x1234, 'vbus_voltage': 24.0})
+        self.channel_termination_token = Event()
+        fibre.simulator.attach(self.device)
+        self.obj = fibre.find_any('loopback:', timeout=5.0, channel_termination_token=self.channel_termination_token)
+        self.assertIsNotNone(self.obj)
+
+    def tearDown(self):
+        fibre.simulator.detach(self.device)
+        self.channel_termination_token.set()
+
+    def test_properties(self):
+        self.assertEqual(self.obj.serial_number, 0x1234)
+        self.assertEqual(self.obj.vbus_voltage, 24.0)
+        written = []
+        self.device.set_hook('axis0.pos', written.append)
+        self.obj.axis0.pos = 1.5
+        self.assertEqual(written, [1.5])
+        self.assertEqual(self.device.get_value('axis0.pos'), 1.5)
+        self.assertEqual(self.obj.axis0.pos, 1.5)
+        with self.assertRaises(ValueError):
+            self.device.set_value('axis0.pos', b'\x00\x00')
+
+    def test_function(self):
+        def move(delta):
+            self.device.set_value('axis0.pos', self.device.get_value('axis0.pos') + delta)
+            return self.device.get_value('axis0.pos')
+        self.device.set_hook('axis0.move', move)
+        self.assertEqual(self.obj.axis0.move(2.0), 2.0)
+        self.assertEqual(self.obj.axis0.move(0.5), 2.5)
+
+    def test_json_is_served_in_chunks(self):
+        request = struct.pack('<HHHI', 1, 0x8000, 64, 0) + struct.pack('<H', fibre.protocol.PROTOCOL_VERSION)
+        response = self.device.process_request(request)
+        self.assertEqual(response, struct.pack('<H', 0x8001) + json_bytes[:self.device.max_response_size])
+
+    def test_request_with_wrong_trailer_is_dropped(self):
+        dropped = self.device.dropped
+        request = struct.pack('<HHH', 1, 0x8002, 4) + struct.pack('<H', self.device.json_crc ^ 1)
+        self.assertIsNone(self.device.process_request(request))
+        self.assertEqual(self.device.dropped, dropped + 1)
+
+    def test_detach_breaks_the_channel(self):
+        fibre.simulator.detach(self.device)
+        deadline = time.monotonic() + 2.0
+        while not self.obj.__channel__._channel_broken.is_set() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.obj.__channel__._channel_broken.is_set())
+
+if __name__ == '__main__':
+    unittest.main()
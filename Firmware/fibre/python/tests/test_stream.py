@@ -0,0 +1,102 @@
+"""
+Tests for the stream framing in fibre.protocol.
+"""
+
+import random
+import unittest
+import fibre.protocol
+from fibre.protocol import SYNC_BYTE
+from fibre.utils import TimeoutError
+
+class ByteCollector(fibre.protocol.StreamSink):
+    def __init__(self):
+        self.data = bytearray()
+    def process_bytes(self, bytes):
+        self.data += bytes
+
+class PacketCollector(fibre.protocol.PacketSink):
+    def __init__(self):
+        self.packets = []
+    def process_packet(self, packet):
+        self.packets.append(bytes(packet))
+
+class ByteSource(fibre.protocol.StreamSource):
+    """Returns one byte per call, so the default get_bytes_into() is used"""
+    def __init__(self, data):
+        self.data = bytearray(data)
+    def get_bytes(self, n_bytes, deadline):
+        result, self.data = self.data[:min(n_bytes, 1)], self.data[min(n_bytes, 1):]
+        return result
+
+def encode(*packets):
+    collector = ByteCollector()
+    sink = fibre.protocol.StreamBasedPacketSink(collector)
+    for packet in packets:
+        sink.process_packet(packet)
+    return bytes(collector.data)
+
+class DecoderTest(unittest.TestCase):
+    def decode(self, *chunks):
+        collector = PacketCollector()
+        segmenter = fibre.protocol.StreamToPacketSegmenter(collector)
+        for chunk in chunks:
+            segmenter.process_bytes(chunk)
+        return collector.packets
+
+    def test_round_trip(self):
+        packets = [b'', b'\x00', bytes([SYNC_BYTE] * 10), bytes(range(127))]
+        self.assertEqual(self.decode(encode(*packets)), packets)
+
+    def test_split_into_single_bytes(self):
+        data = encode(b'abc', b'defgh')
+        self.assertEqual(self.decode(*[data[i:i + 1] for i in range(len(data))]), [b'abc', b'defgh'])
+
+    def test_resync_after_garbage(self):
+        # Garbage that contains a sync byte but no valid header
+        garbage = bytes([0x01, SYNC_BYTE, 0x05, 0x00, SYNC_BYTE])
+        self.assertEqual(self.decode(garbage + encode(b'abc') + garbage + encode(b'def')), [b'abc', b'def'])
+
+    def test_resync_after_bad_header(self):
+        data = bytearray(encode(b'abc'))
+        data[2] ^= 0x01 # header CRC
+        self.assertEqual(self.decode(bytes(data) + encode(b'def')), [b'def'])
+
+    def test_resync_after_bad_payload_crc(self):
+        data = bytearray(encode(b'abc'))
+        data[-1] ^= 0x01
+        self.assertEqual(self.decode(bytes(data) + encode(b'def')), [b'def'])
+
+    def test_packet_inside_corrupted_packet(self):
+        # A valid packet inside the payload of a corrupted packet is found
+        # when the decoder resyncs from the byte after the bad sync byte
+        inner = encode(b'inner')
+        outer = bytearray(encode(inner))
+        outer[-1] ^= 0x01
+        self.assertEqual(self.decode(bytes(outer) + encode(b'def')), [b'inner', b'def'])
+
+    def test_oversized_length_is_rejected(self):
+        header = bytearray([SYNC_BYTE, 0x80])
+        header.append(fibre.protocol.calc_crc8(fibre.protocol.CRC8_INIT, header))
+        self.assertEqual(self.decode(bytes(header) + encode(b'abc')), [b'abc'])
+
+    def test_buffer_is_reused(self):
+        rng = random.Random(0)
+        packets = [bytes(rng.randrange(256) for _ in range(rng.randrange(100))) for _ in range(500)]
+        data = encode(*packets)
+        chunks = []
+        while data:
+            n = rng.randrange(1, 300)
+            chunks.append(data[:n])
+            data = data[n:]
+        self.assertEqual(self.decode(*chunks), packets)
+
+    def test_packet_from_stream_converter(self):
+        garbage = bytes([SYNC_BYTE, 0x7f])
+        converter = fibre.protocol.PacketFromStreamConverter(ByteSource(garbage + encode(b'abc', b'de')))
+        self.assertEqual(bytes(converter.get_packet(None)), b'abc')
+        self.assertEqual(bytes(converter.get_packet(None)), b'de')
+        with self.assertRaises(TimeoutError):
+            converter.get_packet(None)
+
+if __name__ == '__main__':
+    unittest.main()
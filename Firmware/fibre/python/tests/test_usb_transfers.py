@@ -0,0 +1,112 @@
+"""
+Tests for fibre.usb_transfers.InTransferQueue with the synthetic backend.
+"""
+
+import time
+import unittest
+import fibre.protocol
+from fibre.usb_transfers import FakeBackend, InTransferQueue, TRANSFER_STALL
+from fibre.utils import TimeoutError
+
+class InTransferQueueTest(unittest.TestCase):
+    packet_size = 64
+    depth = 3
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.queue = InTransferQueue(self.backend, self.packet_size, self.depth)
+
+    def get_packet(self):
+        return bytes(self.queue.get_packet(time.monotonic() + 1.0))
+
+    def test_transfers_are_queued_up_front(self):
+        self.assertEqual(self.backend.allocations, self.depth)
+        self.assertEqual(len(self.backend.get_pending_transfers()), self.depth)
+
+    def test_short_transfers(self):
+        full_packet = bytes(range(self.packet_size))
+        for packet in [b'ab', full_packet, b'', b'x']:
+            self.backend.send(packet)
+        self.assertEqual(self.get_packet(), b'ab')
+        self.assertEqual(self.get_packet(), full_packet)
+        self.assertEqual(self.get_packet(), b'')
+        self.assertEqual(self.get_packet(), b'x')
+        self.assertEqual(self.queue.packets, 4)
+        # Buffers are recycled, not reallocated
+        self.assertEqual(self.backend.allocations, self.depth)
+
+    def test_out_of_order_completions(self):
+        first, second, third = self.backend.get_pending_transfers()
+        self.backend.complete(third, data=b'c')
+        self.backend.complete(first, data=b'a')
+        self.assertEqual(self.get_packet(), b'c')
+        self.backend.complete(second, data=b'b')
+        self.assertEqual(self.get_packet(), b'a')
+        self.assertEqual(self.get_packet(), b'b')
+        # All but the transfer holding the last packet are queued again
+        self.assertEqual(len(self.backend.get_pending_transfers()), self.depth - 1)
+        self.backend.send(b'd')
+        self.assertEqual(self.get_packet(), b'd')
+        self.assertEqual(self.backend.allocations, self.depth)
+
+    def test_packet_stays_valid_until_next_call(self):
+        first, second, _ = self.backend.get_pending_transfers()
+        self.backend.complete(first, data=b'first')
+        packet = self.queue.get_packet(time.monotonic() + 1.0)
+        self.backend.complete(second, data=b'second')
+        self.backend.handle_events(0) # the queue must not touch the lent buffer
+        self.assertEqual(bytes(packet), b'first')
+        self.assertEqual(self.get_packet(), b'second')
+
+    def test_cancelled_transfer(self):
+        first, second, _ = self.backend.get_pending_transfers()
+        self.backend.cancel(second)
+        self.backend.complete(first, data=b'a')
+        # Completions are reported in the order in which they happened
+        with self.assertRaises(fibre.protocol.ChannelDamagedException):
+            self.get_packet()
+        self.assertEqual(self.get_packet(), b'a')
+        # The cancelled transfer is resubmitted and the queue keeps working
+        self.backend.send(b'b')
+        self.assertEqual(self.get_packet(), b'b')
+        self.assertEqual(len(self.backend.get_pending_transfers()), self.depth - 1)
+
+    def test_stall(self):
+        cleared = []
+        self.backend.clear_halt = lambda: cleared.append(True)
+        self.backend.complete(self.backend.get_pending_transfers()[0], TRANSFER_STALL)
+        with self.assertRaises(fibre.protocol.ChannelDamagedException):
+            self.get_packet()
+        self.assertEqual(cleared, [True])
+
+    def test_timeout(self):
+        with self.assertRaises(TimeoutError):
+            self.queue.get_packet(time.monotonic() - 1.0)
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.queue.get_packet(start + 0.1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_disconnect(self):
+        self.backend.disconnect()
+        with self.assertRaises(fibre.protocol.ChannelBrokenException):
+            self.get_packet()
+
+    def test_close_cancels_and_frees_all_transfers(self):
+        self.backend.send(b'a')
+        self.backend.send(b'b')
+        self.assertEqual(self.get_packet(), b'a') # one lent, one completed, one pending
+        self.queue.close()
+        self.assertEqual(self.backend.get_pending_transfers(), [])
+        self.assertEqual(self.backend.frees, self.depth)
+        with self.assertRaises(fibre.protocol.ChannelDamagedException):
+            self.get_packet()
+
+    def test_close_leaks_transfers_that_are_not_cancelled(self):
+        self.backend.cancel = lambda transfer: None # the cancellation never completes
+        self.queue.close_timeout = 0.1
+        self.queue.close()
+        self.assertEqual(self.backend.frees, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,14 +2,18 @@
 import json
 import os
 import tempfile
+import fibre
 import fibre.remote_object
 from odrive.utils import OperationAbortedException, yes_no_prompt
 
 def get_dict(obj, is_config_object):
     result = {}
+    properties = [(k, v) for (k,v) in obj._remote_attributes.items()
+                  if isinstance(v, fibre.remote_object.RemoteProperty) and is_config_object]
+    values = dict(zip([k for k, _ in properties], fibre.read_many([v for _, v in properties])))
     for (k,v) in obj._remote_attributes.items():
-        if isinstance(v, fibre.remote_object.RemoteProperty) and is_config_object:
-            result[k] = v.get_value()
+        if k in values:
+            result[k] = values[k]
         elif isinstance(v, fibre.remote_object.RemoteObject):
             sub_dict = get_dict(v, k == 'config')
             if sub_dict != {}:
@@ -236,16 +236,19 @@ class ODriveComponent(Component):
             return
 
         logger.debug('waiting for {} ({})'.format(self.yaml['name'], self.yaml['serial-number']))
-        self.handle = odrive.find_any(
-            path="usb", serial_number=self.yaml['serial-number'], timeout=60)#, printer=print)
-        assert(self.handle)
+        self.attach(odrive.find_any(
+            path="usb", serial_number=self.yaml['serial-number'], timeout=60))#, printer=print)
+
+    def attach(self, handle):
+        assert(handle)
+        self.handle = handle
         #for axis_idx, axis_ctx in enumerate(self.axes):
-        #    axis_ctx.handle = self.handle.__dict__['axis{}'.format(axis_idx)]
+        #    axis_ctx.handle = self.handle._remote_attributes['axis{}'.format(axis_idx)]
         for encoder_idx, encoder_ctx in enumerate(self.encoders):
-            encoder_ctx.handle = self.handle.__dict__['axis{}'.format(encoder_idx)].encoder
+            encoder_ctx.handle = self.handle._remote_attributes['axis{}'.format(encoder_idx)].encoder
         # TODO: distinguish between axis and motor context
         for axis_idx, axis_ctx in enumerate(self.axes):
-            axis_ctx.handle = self.handle.__dict__['axis{}'.format(axis_idx)]
+            axis_ctx.handle = self.handle._remote_attributes['axis{}'.format(axis_idx)]
 
     def disable_mappings(self):
         self.handle.config.gpio1_pwm_mapping.endpoint = None # here
@@ -261,18 +264,14 @@ class ODriveComponent(Component):
             self.handle.reboot()
         except fibre.ChannelBrokenException:
             pass # this is expected
-        self.handle = None
-        time.sleep(2)
-        self.prepare(logger)
+        self.attach(self.handle.wait_for_reconnect(timeout=60))
 
     def erase_config_and_reboot(self):
         try:
             self.handle.erase_configuration()
         except fibre.ChannelBrokenException:
             pass # this is expected
-        self.handle = None
-        time.sleep(2)
-        self.prepare(logger)
+        self.attach(self.handle.wait_for_reconnect(timeout=60))
 
 class MotorComponent(Component):
     def __init__(self, yaml: dict):